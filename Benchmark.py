@@ -0,0 +1,311 @@
+import argparse
+import functools
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import Computing
+import NumbaBackend as nb
+import Instrumentation
+import Headless
+
+# Phases of a simulation step, as named by the recorder of Computing. The scalar engine times pressure, viscosity and positions as one
+PHASES = ["externalForces", "spatialHash", "neighbours", "density", "pressure", "viscosity", "positions", "pressureViscosityPositions"]
+
+
+def ParseArguments(argv=None):
+    """
+    Parses the command line of the benchmark.
+
+    Returns: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks simulation steps over particle counts, spawn layouts and smoothing radii.")
+    parser.add_argument("--particles", type=int, nargs="+", default=[200, 1000, 10000, 100000])
+    parser.add_argument("--spawn", choices=Headless.SPAWN_OPTIONS, nargs="+", default=["grid", "random"])
+    parser.add_argument("--smoothing-radius", type=float, nargs="+", default=[50])
+    parser.add_argument("--engine", choices=Headless.ENGINES, nargs="+", default=["vectorized"])
+    parser.add_argument("--precision", choices=Headless.PRECISIONS, nargs="+", default=["float64", "float32"],
+                        help="float types of the particle arrays, cases below float64 also report their accuracy against a float64 run")
+    parser.add_argument("--reorder-every", type=int, nargs="+", default=[0], metavar="STEPS",
+                        help="steps between reorders of the particles in memory by the Morton order of their cells, 0 never")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes of the parallel engine, 0 uses one per core")
+    parser.add_argument("--verlet", action="store_true", help="reuse neighbour candidates across steps")
+    parser.add_argument("--steps", type=int, default=20, help="number of timed steps per case")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed steps before the timed ones")
+    parser.add_argument("--memory-steps", type=int, default=2, help="steps traced for peak allocations after the timed ones, 0 skips tracing")
+    parser.add_argument("--render", action="store_true", help="also times drawing the final particles offscreen, batched, one by one, velocity colored and splatted, needs pygame")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="writes the results to this JSON file, which can serve as a baseline")
+    parser.add_argument("--compare", default=None, help="compares the results with a baseline JSON file and fails on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+
+    return parser.parse_args(argv)
+
+
+def GetScenarioArea(numOfParticles, particleSize, particleSpacing, width=930, height=720):
+    """
+    Grows the default simulation area when the spawn grid of the given number of particles would not fit inside,
+    keeping its aspect ratio, so large particle counts start as the same fluid instead of piled against the walls.
+
+    Returns: A pair (width, height).
+    """
+    gridSize = math.sqrt(numOfParticles) * (particleSize + particleSpacing) * 1.25
+    scale = max(1.0, gridSize / min(width, height))
+
+    return int(width * scale), int(height * scale)
+
+
+def GetCaseArguments(engine, numOfParticles, spawn, smoothingRadius, precision, reorderInterval, args):
+    """
+    Returns: The command line of the headless runner for one case.
+    """
+    width, height = GetScenarioArea(numOfParticles, 8, 25)
+    argv = [
+        "--particles", str(numOfParticles), "--spawn", spawn, "--smoothing-radius", str(smoothingRadius),
+        "--width", str(width), "--height", str(height), "--engine", engine, "--workers", str(args.workers), "--seed", str(args.seed),
+        "--precision", precision, "--reorder-every", str(reorderInterval),
+    ]
+    if args.verlet:
+        argv.append("--verlet")
+
+    return argv
+
+
+def MeasureAccuracy(particles, engine, numOfParticles, spawn, smoothingRadius, reorderInterval, args):
+    """
+    Runs the same case in float64 for as many steps as the case ran, and compares the final particles with it, particle by particle id.
+
+    Returns: A dictionary with the largest and root mean square position difference, and the largest density difference
+             relative to the target density.
+    """
+    try:
+        Headless.Setup(Headless.ParseArguments(GetCaseArguments(engine, numOfParticles, spawn, smoothingRadius, "float64", reorderInterval, args)))
+        Headless.Run(args.warmup + args.steps + args.memory_steps)
+        reference = Computing.GetParticles()
+    finally:
+        Computing.Shutdown()
+
+    positionErrors = np.linalg.norm(particles.InIdOrder(particles.positions).astype(np.float64) - reference.InIdOrder(reference.positions), axis=1)
+    densityErrors = np.abs(particles.InIdOrder(particles.densities).astype(np.float64) - reference.InIdOrder(reference.densities)) / Computing.targetDensity
+
+    return {
+        "maxPositionError": float(positionErrors.max(initial=0)),
+        "rmsPositionError": float(np.sqrt(np.mean(positionErrors ** 2))) if len(positionErrors) else 0.0,
+        "maxDensityError": float(densityErrors.max(initial=0)),
+    }
+
+
+def RunCase(engine, numOfParticles, spawn, smoothingRadius, args, precision="float64", reorderInterval=0):
+    """
+    Sets up one scenario with the headless runner, runs the warmup and timed steps, then traces the allocations of a few more.
+    Phase times come from the recorder of Computing, enabled for the timed steps only. The traced peak only sees memory allocated
+    during those steps, so the particle arrays and the shared memory of the parallel engine are reported next to it.
+
+    Returns: A dictionary with the case and its results.
+    """
+    width, height = GetScenarioArea(numOfParticles, 8, 25)
+
+    try:
+        Headless.Setup(Headless.ParseArguments(GetCaseArguments(engine, numOfParticles, spawn, smoothingRadius, precision, reorderInterval, args)))
+        # As the engine runs them, it may ignore some of the options asked for
+        settings = Computing.GetSettings()
+        Headless.Run(args.warmup)
+
+        stats = Instrumentation.RollingStats(window=max(1, args.steps))
+        Computing.recorder.Enable(stats)
+        try:
+            elapsed = Headless.Run(args.steps)
+        finally:
+            Computing.recorder.Disable()
+            Computing.recorder.RemoveSink(stats)
+
+        stepStats = stats.GetStats()
+        phaseSeconds = {phase: stepStats[phase]["total"] if phase in stepStats else 0.0 for phase in PHASES}
+        counters = {name: values["mean"] for name, values in stepStats.items() if name not in PHASES and name != "stepTime"}
+
+        peakAllocation = None
+        if args.memory_steps > 0:
+            tracemalloc.start()
+            Headless.Run(args.memory_steps)
+            peakAllocation = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        sharedMemory = Computing.workerPool.MemoryFootprint() if Computing.workerPool is not None else 0
+    finally:
+        Computing.Shutdown()
+
+    particles = Computing.GetParticles()
+    particleSteps = max(1, numOfParticles * args.steps)
+    render = TimeRendering(particles, (width, height), args.steps) if args.render else {}
+    accuracy = MeasureAccuracy(particles, engine, numOfParticles, spawn, smoothingRadius, reorderInterval, args) if precision != "float64" else None
+
+    return {
+        "engine": engine,
+        "precision": precision,
+        "reorderInterval": reorderInterval,
+        "verlet": settings["useVerletList"],
+        "symmetricPairs": settings["useSymmetricPairs"],
+        "particles": numOfParticles,
+        "spawn": spawn,
+        "smoothingRadius": smoothingRadius,
+        "area": [width, height],
+        "steps": args.steps,
+        "seconds": elapsed,
+        "stepsPerSecond": args.steps / elapsed if elapsed > 0 else None,
+        "nsPerParticle": elapsed * 1e9 / particleSteps,
+        "phases": {phase: {"seconds": seconds, "nsPerParticle": seconds * 1e9 / particleSteps} for phase, seconds in phaseSeconds.items()},
+        "counters": counters,
+        "render": {name: {"seconds": seconds, "nsPerParticle": seconds * 1e9 / particleSteps} for name, seconds in render.items()},
+        "peakStepAllocationBytes": peakAllocation,
+        "particleBytes": particles.MemoryFootprint(),
+        "sharedMemoryBytes": sharedMemory,
+        "accuracy": accuracy,
+    }
+
+
+def TimeRendering(particles, area, frames):
+    """
+    Times drawing the particles on an offscreen surface, with the batched sprite path, the per particle path,
+    the velocity colored path, and splatting into the pixels in solid and speed colors.
+
+    Returns: A dictionary of the total seconds of each path over the given number of frames.
+    """
+    # Imported here, so the solver benchmark runs where pygame is not installed
+    import pygame
+    from Rendering import Rendering
+
+    screen = pygame.Surface(area)
+    render = Rendering(screen, *area)
+
+    seconds = {}
+    paths = (("batched", render.DrawAllParticles), ("oneByOne", render.DrawAllParticlesOneByOne), ("velocityColors", render.DrawAllParticlesWithVelColors),
+             ("splatted", render.DrawAllParticlesSplatted), ("splattedSpeed", functools.partial(render.DrawAllParticlesSplatted, mode="speed")))
+    for name, DrawAllParticles in paths:
+        seconds[name] = 0.0
+        for frame in range(frames):
+            screen.fill((10, 10, 14))
+
+            start = time.perf_counter()
+            DrawAllParticles(particles, (10, 130, 255), 8)
+            seconds[name] += time.perf_counter() - start
+
+    return seconds
+
+
+def GetCaseKey(result):
+    """
+    Returns: The tuple identifying the case of a result, used to match results with a baseline.
+    """
+    # Results written before the precision and reorder options ran in float64 and never reordered
+    return (result["engine"], result.get("precision", "float64"), result.get("reorderInterval", 0), result.get("verlet", False),
+            result["particles"], result["spawn"], result["smoothingRadius"])
+
+
+def CompareResults(results, baseline, threshold):
+    """
+    Compares results with the baseline results of the same cases. A case regressed when its time per particle,
+    or the time per particle of one of its phases, grew by more than the threshold.
+
+    Returns: A list of regression messages, empty when nothing regressed.
+    """
+    # Baseline results written before cases were labelled with the Verlet list ran with the option of the whole run
+    baselineVerlet = baseline.get("settings", {}).get("verlet", False)
+    baselineResults = {GetCaseKey({"verlet": baselineVerlet, **result}): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        base = baselineResults.get(GetCaseKey(result))
+        if base is None: continue
+
+        measures = [("total", result["nsPerParticle"], base["nsPerParticle"])]
+        for phase, timing in result["phases"].items():
+            if phase in base["phases"]:
+                measures.append((phase, timing["nsPerParticle"], base["phases"][phase]["nsPerParticle"]))
+        for name, timing in result.get("render", {}).items():
+            if name in base.get("render", {}):
+                measures.append((f"render {name}", timing["nsPerParticle"], base["render"][name]["nsPerParticle"]))
+
+        for name, value, baseValue in measures:
+            # Phases too short to measure reliably are skipped
+            if baseValue <= 0 or value * result["particles"] * result["steps"] < 1e6: continue
+
+            if value > baseValue * (1 + threshold):
+                regressions.append(f"{GetCaseKey(result)} {name}: {value:.1f} ns/particle, baseline {baseValue:.1f} ({value / baseValue - 1:+.0%})")
+
+    return regressions
+
+
+def PrintResult(result):
+    phases = ", ".join(f"{phase} {timing['nsPerParticle']:.0f}" for phase, timing in result["phases"].items() if timing["seconds"] > 0)
+    memory = f", particles {result['particleBytes'] / 2 ** 20:.1f} MiB"
+    memory += f", shared {result['sharedMemoryBytes'] / 2 ** 20:.1f} MiB" if result["sharedMemoryBytes"] > 0 else ""
+    memory += f", step allocations peak {result['peakStepAllocationBytes'] / 2 ** 20:.1f} MiB" if result["peakStepAllocationBytes"] is not None else ""
+    render = "".join(f", render {name} {timing['nsPerParticle']:.0f}" for name, timing in result["render"].items())
+    accuracy = result["accuracy"]
+    delta = (f", against float64 position max {accuracy['maxPositionError']:.3g} rms {accuracy['rmsPositionError']:.3g},"
+             f" density max {accuracy['maxDensityError']:.3g}") if accuracy is not None else ""
+    options = f" reorder/{result['reorderInterval']}" if result["reorderInterval"] > 0 else ""
+    options += " verlet" if result["verlet"] else ""
+    print(f"{result['engine']:>10} {result['precision']:>7}{options} {result['particles']:>7} {result['spawn']:>6} r={result['smoothingRadius']:g}: "
+          f"{result['stepsPerSecond']:.2f} steps/sec, {result['nsPerParticle']:.0f} ns/particle ({phases}){memory}{render}{delta}")
+
+
+def Main(argv=None):
+    """
+    Runs every combination of engine, precision, reorder interval, particle count, spawn layout and smoothing radius, prints and optionally
+    writes the results, and compares them with a baseline.
+
+    Returns: The exit code, 1 when some case regressed against the baseline.
+    """
+    args = ParseArguments(argv)
+
+    results = []
+    for engine in args.engine:
+        for precision in args.precision:
+            for reorderInterval in args.reorder_every:
+                for numOfParticles in args.particles:
+                    for spawn in args.spawn:
+                        for smoothingRadius in args.smoothing_radius:
+                            result = RunCase(engine, numOfParticles, spawn, smoothingRadius, args, precision, reorderInterval)
+                            PrintResult(result)
+                            results.append(result)
+
+    report = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "numba": nb.numba.__version__ if nb.available else None,
+            "cpuCount": os.cpu_count(),
+        },
+        "settings": {"steps": args.steps, "warmup": args.warmup, "verlet": args.verlet, "workers": args.workers, "seed": args.seed},
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        regressions = CompareResults(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+
+    return 0
+
+
+# Guarded, so worker processes of the PARALLEL engine started with spawn do not run the benchmark
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,155 @@
+import os
+import json
+import random
+import struct
+import numpy as np
+
+import Computing
+from Particles import Particles
+
+# A checkpoint file is a fixed prefix, a JSON header, then the raw arrays, each starting at a multiple of ALIGNMENT.
+# The header holds the settings, the step state, the random number generator states, and the dtype, shape and offset of every array,
+# so restoring maps the arrays in place instead of parsing them.
+MAGIC = b"FLUIDCKP"
+VERSION = 1
+PREFIX = struct.Struct("<8sII") # Magic, version, byte length of the JSON header
+ALIGNMENT = 64
+
+
+def Align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def EncodeSetting(value):
+    """
+    Returns: The setting as a JSON value, float types by name.
+    """
+    if isinstance(value, type) and issubclass(value, np.floating):
+        return {"dtype": np.dtype(value).name}
+    if isinstance(value, tuple):
+        return {"tuple": [EncodeSetting(item) for item in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def DecodeSetting(value):
+    if isinstance(value, dict):
+        if "dtype" in value:
+            return np.dtype(value["dtype"]).type
+        return tuple(DecodeSetting(item) for item in value["tuple"])
+    return value
+
+
+def SaveCheckpoint(path, particles=None):
+    """
+    Writes the complete state of the computing module: every setting, the particle arrays, the step state
+    and the states of the random number generators of this process.
+    The file is written next to the path first and then moved over it, so a failed write never leaves half a checkpoint.
+
+    Args:
+        particles: The particle store written, by default the one of the computing module.
+    """
+    if particles is None:
+        particles = Computing.GetParticles()
+
+    numpyRandomState = np.random.get_state()
+    pythonRandomState = random.getstate()
+
+    arrays = dict(particles.GetArrays())
+    if particles.ids is not None:
+        # The slots particles were reordered into, so the restored run walks them in the same order
+        arrays["ids"] = particles.ids
+    arrays["numpyRandomKeys"] = numpyRandomState[1]
+
+    header = {
+        "settings": {name: EncodeSetting(value) for name, value in Computing.GetSettings().items()},
+        "stepState": Computing.GetStepState(),
+        "numpyRandom": {"position": int(numpyRandomState[2]), "hasGauss": int(numpyRandomState[3]), "cachedGaussian": float(numpyRandomState[4])},
+        "pythonRandom": [pythonRandomState[0], list(pythonRandomState[1]), pythonRandomState[2]],
+        "arrays": {},
+    }
+
+    # The offsets depend on the header length, which depends on the offsets, so the header is laid out until it fits
+    headerBytes = b""
+    while True:
+        offset = Align(PREFIX.size + len(headerBytes))
+        for arrayName, array in arrays.items():
+            header["arrays"][arrayName] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = Align(offset + array.nbytes)
+
+        newHeaderBytes = json.dumps(header).encode()
+        fits = len(newHeaderBytes) <= len(headerBytes)
+        headerBytes = newHeaderBytes
+        if fits:
+            break
+    headerBytes = headerBytes.ljust(header["arrays"]["positions"]["offset"] - PREFIX.size)
+
+    temporaryPath = f"{path}.tmp"
+    with open(temporaryPath, "wb") as file:
+        file.write(PREFIX.pack(MAGIC, VERSION, len(headerBytes)))
+        file.write(headerBytes)
+
+        for arrayName, array in arrays.items():
+            file.seek(header["arrays"][arrayName]["offset"])
+            file.write(np.ascontiguousarray(array).data)
+        file.truncate(offset)
+
+    os.replace(temporaryPath, path)
+
+
+def ReadCheckpoint(path):
+    """
+    Maps the arrays of a checkpoint file without reading them, they are paged in as they are used.
+    The mapping is copy on write, stepping the restored particles never changes the file.
+
+    Returns: A tuple (settings, state, particles), settings for Computing.InitializeValues, state a dictionary with the
+             step state and the random number generator states, particles a particle store over the mapped arrays.
+    """
+    with open(path, "rb") as file:
+        magic, version, headerLength = PREFIX.unpack(file.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a checkpoint file")
+        if version != VERSION:
+            raise ValueError(f"{path} is a version {version} checkpoint, expected version {VERSION}")
+        header = json.loads(file.read(headerLength))
+
+    arrays = {}
+    for arrayName, layout in header["arrays"].items():
+        shape = tuple(layout["shape"])
+        if 0 in shape:
+            # Empty arrays can not be mapped
+            arrays[arrayName] = np.empty(shape, dtype=layout["dtype"])
+        else:
+            arrays[arrayName] = np.memmap(path, dtype=layout["dtype"], mode="c", offset=layout["offset"], shape=shape).view(np.ndarray)
+
+    numpyRandom = header["numpyRandom"]
+    pythonRandom = header["pythonRandom"]
+    state = {
+        "stepState": header["stepState"],
+        "numpyRandom": ("MT19937", arrays.pop("numpyRandomKeys"), numpyRandom["position"], numpyRandom["hasGauss"], numpyRandom["cachedGaussian"]),
+        "pythonRandom": (pythonRandom[0], tuple(pythonRandom[1]), pythonRandom[2]),
+    }
+    settings = {name: DecodeSetting(value) for name, value in header["settings"].items()}
+
+    return settings, state, Particles.FromArrays(arrays)
+
+
+def LoadCheckpoint(path):
+    """
+    Restores the computing module from a checkpoint file, so stepping on continues the run it was written from bit for bit.
+    Verlet candidates are gathered anew and worker processes of the PARALLEL engine keep their own random number generators,
+    so runs using those may differ in rounding after the restore.
+
+    Returns: The restored particle store.
+    """
+    settings, state, particles = ReadCheckpoint(path)
+
+    Computing.InitializeValues(**settings)
+    Computing.InitializeArrays(particles)
+    Computing.SetStepState(**state["stepState"])
+
+    np.random.set_state(state["numpyRandom"])
+    random.setstate(state["pythonRandom"])
+
+    return particles
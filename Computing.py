@@ -1,11 +1,25 @@
+import os
+import warnings
 import numpy as np
 
 import FluidMaths as fm
 import SpatialHash as sh
+import NumbaBackend as nb
+import ParallelComputing as pc
+import Instrumentation
+from Particles import Particles
 
 SCREEN_SIZE = 0
 GUI_SIZE = 0
 
+# Engines
+SCALAR = 0 # Reference engine, loops over particles one by one
+VECTORIZED = 1 # Every phase works on the whole particle set as array operations
+NUMBA = 2 # Density, pressure and viscosity loops compiled to native code, falls back to VECTORIZED without Numba
+PARALLEL = 3 # Density, pressure and viscosity sweeps split over a pool of worker processes sharing the particle arrays
+SYMMETRIC_PAIR_ENGINES = [VECTORIZED, NUMBA] # Engines evaluating every pair once with useSymmetricPairs. PARALLEL workers only write the particles of their own range,
+                                             # so they gather from both sides instead of writing to both particles of a pair
+
 # Settings
 numOfParticles = 0
 gravity = 0
@@ -20,20 +34,90 @@ densityThreshhold = 0
 mouseInput = 0 # 1 - pushing appart, -1 pulling in
 mouseInteractionStrength = 0 
 mouseInteractionRadius = 0
+engine = SCALAR
+useVerletList = False # Reuse neighbour candidates across steps until particles moved too far
+verletSkin = 0 # Extra distance added to smoothingRadius when gathering Verlet candidates
+numOfWorkers = 0 # Worker processes of the PARALLEL engine, 0 uses one per core
+useSymmetricPairs = True # Every pair is evaluated once and both particles get equal and opposite contributions, on the SYMMETRIC_PAIR_ENGINES only
+deltaTime = 1 # Simulated time of one step, scaling every change of velocity and position. The other settings were tuned for 1
+floatType = np.float64 # Float type of the particle arrays and per pair values, np.float32 halves their memory and bandwidth. Sums over pairs still accumulate in float64
+useAdaptiveTimeStep = False # Chooses deltaTime every step, the largest one the CFL condition and the force limit allow
+courantFactor = 0.4 # Fraction of smoothingRadius pressure waves and the fastest particle may travel in a step
+forceFactor = 0.25 # The step stays below forceFactor * sqrt(smoothingRadius / largest acceleration)
+minDeltaTime = 0.05
+maxDeltaTime = 4
+maxDeltaTimeGrowth = 1.25 # Largest factor the step grows by from one step to the next
+reorderInterval = 0 # Steps between moves of the particles in memory into the Morton order of their cells, at the next spatial hash. 0 keeps the spawn order
+denseGridMaxCellsPerParticle = 16 # The bounded area uses a dense cell grid, unless it has more cells per particle than this, then the scene counts as sparse and is hashed
+
+# Every setting of InitializeValues and UpdateSettings, the ones a checkpoint holds
+SETTING_NAMES = [
+    "SCREEN_SIZE", "GUI_SIZE", "gravity", "collisionDamping", "particleSize", "particleMass", "smoothingRadius", "targetDensity", "pressureMultiplier",
+    "viscosityStrength", "densityThreshhold", "mouseInput", "mouseInteractionStrength", "mouseInteractionRadius", "engine", "useVerletList", "verletSkin",
+    "numOfWorkers", "useSymmetricPairs", "denseGridMaxCellsPerParticle", "floatType", "deltaTime", "useAdaptiveTimeStep", "courantFactor", "forceFactor",
+    "minDeltaTime", "maxDeltaTime", "maxDeltaTimeGrowth", "reorderInterval",
+]
 
 # Init particle arrays
-positions = []
-predictedPositions = []
-velocities = []
-densities = [] # Density
+particles = None # Particle store owning the arrays below
+positions = [] # (N, 2)
+predictedPositions = [] # (N, 2)
+velocities = [] # (N, 2)
+densities = [] # (N,)
 
 # Init special lookup array
 
-spatialIndecies = [] # [particleIndex, cellHash, cellKey] sorted by cellKey, holding data for finding near particles, which particle in what cell 
+spatialCellSize = 0 # Size of the cells the spatial hash was built with
+spatialGridShape = None # (cellsX, cellsY) when the cells are a dense grid over the bounded area, None when cells are hashed
+spatialIndecies = [] # (N, 3) integer array of rows [particleIndex, cellHash, cellKey] sorted by cellKey, holding data for finding near particles, which particle in what cell 
+                     # In the dense grid the cellKey is the row by row index of the cell and the cellHash equals it
 spatialOffsets = [] # When looking for points in given cell, spatialOffsets[cellKey] returns an index of spatialIndecies where there is the first occurance of particle in a given cell:
                     #     cellKey -> the cell key of the cell where we want to what points are inside
                     #     index = spatialOffsets[cellKey] ex. 4
-                    #     indexData = spatialIndecies[index] -> [particleIndex, cellHash, cellKey], index = 4, is the fisrt entry of point in given cell, points in cell continiue (index++) until original cellKey != cellKey from indexData 
+                    #     indexData = spatialIndecies[index] -> [particleIndex, cellHash, cellKey], index = 4, is the fisrt entry of point in given cell
+spatialEnds = [] # spatialEnds[cellKey] is one past the last entry of the cell key, so points in the cell are spatialIndecies[spatialOffsets[cellKey]:spatialEnds[cellKey]]
+
+# Init neighbour list, compressed sparse rows of all pairs within smoothingRadius, rebuilt every step after the spatial hash
+
+neighbourOffsets = [] # (N + 1,) neighbours of particle i are the entries neighbourOffsets[i]:neighbourOffsets[i + 1] of the arrays below, particle itself included
+neighbourParticleIndecies = [] # (P,) particle index each entry belongs to, the row of the entry
+neighbourIndecies = [] # (P,) particle index of the neighbour
+neighbourDistances = [] # (P,) distance to the neighbour
+neighbourDirections = [] # (P, 2) unit vector pointing to the neighbour, random direction if distance is zero
+
+# Init pair list, every pair within smoothingRadius once in one direction, used instead of the neighbour list with useSymmetricPairs
+
+pairParticleIndecies = [] # (H,) particle index of the first particle of each pair
+pairNeighbourIndecies = [] # (H,) particle index of the second particle of each pair
+pairDistances = [] # (H,) distance between the two particles
+pairDirections = [] # (H, 2) unit vector pointing from the first to the second particle, random direction if distance is zero
+
+# Init Verlet list, candidate pairs within smoothingRadius + verletSkin, reused until a particle moved more than half the skin
+
+candidateParticleIndecies = [] # (C,) particle index of each candidate pair
+candidateIndecies = [] # (C,) neighbour index of each candidate pair
+candidatesSymmetric = False # Whether the candidates hold every pair once, from the half stencil
+verletPositions = None # Predicted positions at the last rebuild, None forces a rebuild
+verletSearchRadius = 0 # Search radius the candidates were gathered with
+verletSteps = 0 # Steps since InitializeArrays
+verletRebuilds = 0 # Rebuilds since InitializeArrays
+
+# Init adaptive time step
+stepStartVelocities = None # (N, 2) velocities at the start of the step, telling the accelerations of the step
+maxAcceleration = 0 # Largest acceleration of the last step, 0 before the first one
+simulatedTime = 0 # Simulated time since InitializeArrays
+
+# Init particle order
+stepsSinceReorder = 0 # Steps since the particles were last reordered, see ReorderParticles
+
+# Worker pool of the PARALLEL engine, started on the first parallel step
+workerPool = None
+
+# Trajectory.TrajectoryWriter fed every step, None while not recording
+trajectoryWriter = None
+
+# Phase times and counters of every step, see Instrumentation. Disabled by default
+recorder = Instrumentation.Recorder()
 
 ## Functions
 def DensityFunction(radius, distance):
@@ -57,38 +141,71 @@ def ViscosityFunction(radius, distance):
     return fm.SmoothFunctionPow3(radius, distance)
 
 ## Variable Initialazation
-def InitializeArrays(initialPositions):
+def InitializeArrays(initialParticles):
     """
-    Run once at the start, initializes the particle arrays with the given initial positions.
+    Run once at the start, initializes the particle arrays with the given initial particles.
+    The module level arrays are views into the particle store, so updates are visible to every holder of the store.
+    The store's arrays are converted to floatType first. A trajectory being recorded ends, it belonged to the run before.
     
     Args:
-        initialPositions: A list of initial particle positions generated by Simulation Setup.
+        initialParticles: A particle store generated by Simulation Setup, or a list of initial particle positions.
     """
-    global numOfParticles, positions, predictedPositions, velocities, densities, spatialIndecies, spatialOffsets
+    global particles, numOfParticles, verletPositions, verletSteps, verletRebuilds, maxAcceleration, simulatedTime, stepsSinceReorder
+
+    if not isinstance(initialParticles, Particles):
+        initialParticles = Particles.FromPositions(initialParticles, floatType)
+    initialParticles.SetFloatType(floatType)
+    SetTrajectoryWriter(None)
+
+    particles = initialParticles
+    numOfParticles = len(particles)
+    BindParticleArrays()
+
+    verletPositions = None
+    verletSteps = 0
+    verletRebuilds = 0
+
+    maxAcceleration = 0
+    simulatedTime = 0
+    stepsSinceReorder = 0
+
 
-    positions = initialPositions
-    numOfParticles = len(positions)
+def BindParticleArrays():
+    """
+    Points the module level arrays at the arrays of the particle store.
+    """
+    global positions, predictedPositions, velocities, densities
 
-    predictedPositions = np.empty(numOfParticles, dtype=object)
-    velocities = np.array([np.zeros(2, dtype=float) for x in range(numOfParticles)])
-    densities = np.empty(numOfParticles, dtype=object)
-  
-    spatialIndecies = np.empty(numOfParticles, dtype=object)
-    spatialOffsets = np.empty(numOfParticles, dtype=int)
+    positions = particles.positions
+    predictedPositions = particles.predictedPositions
+    velocities = particles.velocities
+    densities = particles.densities
 
 
 def InitializeValues(**values):
     """
     Initializes simulation settings with the provided values.
+    The engine or the neighbour search may change, so the Verlet list is rebuilt at the next step.
 
     Args:
         **values: Keyword arguments representing the settings to initialize.
     """
 
-    global SCREEN_SIZE, GUI_SIZE, gravity, collisionDamping, particleSize, particleMass, smoothingRadius, targetDensity, pressureMultiplier, viscosityStrength, densityThreshhold, mouseInteractionStrength, mouseInteractionRadius
+    global SCREEN_SIZE, GUI_SIZE, gravity, collisionDamping, particleSize, particleMass, smoothingRadius, targetDensity, pressureMultiplier, viscosityStrength, densityThreshhold, mouseInput, mouseInteractionStrength, mouseInteractionRadius, engine, useVerletList, verletSkin, numOfWorkers, useSymmetricPairs, denseGridMaxCellsPerParticle, floatType, deltaTime, useAdaptiveTimeStep, courantFactor, forceFactor, minDeltaTime, maxDeltaTime, maxDeltaTimeGrowth, reorderInterval, verletPositions
 
     for key, value in values.items():
-        globals()[key] = value
+        # NumPy scalars, e.g. from sliders, would promote float32 arrays to float64
+        globals()[key] = value.item() if isinstance(value, np.generic) else value
+
+    verletPositions = None
+
+    if engine == NUMBA and not nb.available:
+        warnings.warn("Numba is not installed, falling back to the vectorized engine")
+        engine = VECTORIZED
+
+    # On by default, so only asking for it explicitly warns
+    if values.get("useSymmetricPairs") and engine not in SYMMETRIC_PAIR_ENGINES:
+        warnings.warn("Only the vectorized and numba engines evaluate every pair once, the others evaluate pairs from both sides and ignore useSymmetricPairs")
 
 
 def UpdateSettings(**values):
@@ -98,7 +215,35 @@ def UpdateSettings(**values):
     Args:
         **values: Keyword arguments representing the settings to update.
     """
-    global particleSize, gravity, collisionDamping, smoothingRadius, targetDensity, pressureMultiplier, viscosityStrength, mouseInteractionStrength, mouseInteractionRadius, mouseInput
+    global particleSize, gravity, collisionDamping, smoothingRadius, targetDensity, pressureMultiplier, viscosityStrength, mouseInteractionStrength, mouseInteractionRadius, mouseInput, deltaTime, useAdaptiveTimeStep, reorderInterval
+
+    for key, value in values.items():
+        globals()[key] = value.item() if isinstance(value, np.generic) else value
+
+def GetSettings():
+    """
+    Returns: A dictionary of every setting of InitializeValues and UpdateSettings by name, as they are now.
+             Settings the selected engine ignores are reported off.
+    """
+    settings = {name: globals()[name] for name in SETTING_NAMES}
+    settings["useVerletList"] = UsesVerletList()
+    settings["useSymmetricPairs"] = useSymmetricPairs and engine in SYMMETRIC_PAIR_ENGINES
+
+    return settings
+
+
+def GetStepState():
+    """
+    Returns: A dictionary of the values carried from one step to the next besides the particle arrays and settings.
+    """
+    return {"simulatedTime": simulatedTime, "maxAcceleration": maxAcceleration, "stepsSinceReorder": stepsSinceReorder}
+
+
+def SetStepState(**values):
+    """
+    Restores values of GetStepState, after InitializeArrays reset them.
+    """
+    global simulatedTime, maxAcceleration, stepsSinceReorder
 
     for key, value in values.items():
         globals()[key] = value
@@ -111,7 +256,7 @@ def HandleCollisions(particleIndex):
 
     Returns: A list containing the new position and velocity of the particle.
     """
-    new_position = positions[particleIndex] + velocities[particleIndex]
+    new_position = positions[particleIndex] + velocities[particleIndex] * deltaTime
     velocity = velocities[particleIndex]
 
     simAreaWidth = SCREEN_SIZE[0] - GUI_SIZE[0]
@@ -154,49 +299,291 @@ def UpdateExternalForces(particleIndex, mousePos):
             gravityAcceleration -= velocity
     
     # Adding gravity 
-    velocities[particleIndex] += gravityAcceleration
+    velocities[particleIndex] += gravityAcceleration * deltaTime
 
     # Prediction
-    predictionFactor = 1
+    predictionFactor = deltaTime
     predictedPositions[particleIndex] = positions[particleIndex] + (velocities[particleIndex] * predictionFactor)
 
 
+def UsesVerletList():
+    """
+    Returns: Whether neighbour candidates are reused across steps.
+    """
+    return useVerletList
+
+
+def GetSearchRadius():
+    """
+    Returns the radius neighbour candidates are gathered within, smoothingRadius widened by the skin in Verlet mode.
+    """
+    return smoothingRadius + verletSkin if UsesVerletList() else smoothingRadius
+
+
+def GetDenseGridShape(cellSize):
+    """
+    Returns: The (cellsX, cellsY) shape of a dense cell grid over the bounded simulation area,
+             or None when the area is unbounded or the grid would be too sparse for the number of particles.
+    """
+    if not SCREEN_SIZE: return None
+
+    gridShape = sh.GetGridShape(SCREEN_SIZE[0] - GUI_SIZE[0], SCREEN_SIZE[1], cellSize)
+
+    if gridShape[0] * gridShape[1] > denseGridMaxCellsPerParticle * numOfParticles: return None
+
+    return gridShape
+
+
+## Adaptive time step
+def UpdateDeltaTime():
+    """
+    Chooses the time step of the coming step from the fastest particle and the largest acceleration of the last step:
+        CFL condition: pressure waves and the fastest particle travel at most courantFactor * smoothingRadius.
+                       Pressure grows linearly with density, so waves travel at sqrt(pressureMultiplier).
+        Force limit: the step stays below forceFactor * sqrt(smoothingRadius / largest acceleration).
+    The step grows by at most maxDeltaTimeGrowth per step, so it only gets large after calm steps measured it safe,
+    and stays within [minDeltaTime, maxDeltaTime]. The mouse interaction pulls velocities towards the input at a unit rate,
+    which caps the step at 1 while it is active.
+    """
+    global deltaTime, stepStartVelocities, maxAcceleration
+
+    maxSpeed = np.sqrt(np.einsum("ij,ij->i", velocities, velocities).max(initial=0))
+    soundSpeed = np.sqrt(max(pressureMultiplier, 0))
+
+    newDeltaTime = min(maxDeltaTime, deltaTime * maxDeltaTimeGrowth)
+    if maxSpeed + soundSpeed > 0:
+        newDeltaTime = min(newDeltaTime, courantFactor * smoothingRadius / (soundSpeed + maxSpeed))
+    if maxAcceleration > 0:
+        newDeltaTime = min(newDeltaTime, forceFactor * np.sqrt(smoothingRadius / maxAcceleration))
+    if mouseInput != 0:
+        newDeltaTime = min(newDeltaTime, 1)
+
+    deltaTime = float(max(minDeltaTime, newDeltaTime))
+
+    stepStartVelocities = velocities.copy()
+    maxAcceleration = 0
+
+
+def MeasureAcceleration(selection=slice(None)):
+    """
+    Keeps the largest acceleration of the step among the selected particles, from the change of velocity since the step started.
+    Particles colliding with the bounds are left out by the callers: pressure pushing them into a wall is held by the wall,
+    and would keep the step small long after the fluid came to rest.
+
+    Args:
+        selection: Index array, boolean mask or slice of the particles measured.
+    """
+    global maxAcceleration
+
+    changes = velocities[selection] - stepStartVelocities[selection]
+    # A Python float, so the step is chosen in double precision with float32 arrays too
+    maxAcceleration = max(maxAcceleration, float(np.sqrt(np.einsum("ij,ij->i", changes, changes).max(initial=0))) / deltaTime)
+
+
 def UpdateSpatialHash():
     """
     Updates the spatial hash table for particle positions in a spatial grid.
 
-    This function calculates the cell hash and key for each particle, stores this
-    information in the spatial indecies table, sorts the table by cell key, and computes 
-    the offsets for each unique cell key.
+    This function calculates the cell hash and key for all particles at once, sorts the
+    particles by cell key with a stable counting sort, and stores the start and end
+    offsets of each cell key, so a cell is read as one contiguous range of spatial indecies.
+    Keys without particles get an empty range. Cells are as large as the search radius.
+    Every reorderInterval steps the particles are reordered by the cells found, see ReorderParticles.
+
+    The bounded simulation area is covered by a dense grid, keyed directly by cell coordinates, so no two cells share a key.
+    Its table has one extra empty key, used for neighbouring rows outside the grid.
+    """
+    global spatialCellSize, spatialGridShape, spatialIndecies, spatialOffsets, spatialEnds
+
+    spatialCellSize = GetSearchRadius()
+    spatialGridShape = GetDenseGridShape(spatialCellSize)
+
+    if spatialGridShape is None:
+        cellHashes = sh.HashCells(sh.GetCells(predictedPositions, spatialCellSize))
+        cellKeys = sh.GetKeysFromHashes(cellHashes, numOfParticles)
+        tableSize = numOfParticles
+    else:
+        cellKeys = sh.GetGridKeys(sh.GetGridCells(predictedPositions, spatialCellSize, spatialGridShape), spatialGridShape)
+        cellHashes = cellKeys
+        tableSize = spatialGridShape[0] * spatialGridShape[1] + 1
+
+    # Sorting by cellKey
+    order, spatialOffsets, spatialEnds = sh.CountingSort(cellKeys, tableSize)
+
+    spatialIndecies = np.stack((order, cellHashes[order], cellKeys[order]), axis=1)
+
+    # Particles that were never reordered are still in spawn order
+    if reorderInterval > 0 and (particles.ids is None or stepsSinceReorder >= reorderInterval):
+        ReorderParticles()
+
+
+def ReorderParticles():
+    """
+    Moves the particles in memory into the Morton order of their cells, so particles close in space are close in the arrays
+    and the neighbour loops read mostly nearby memory. The spatial hash just grouped the particles by cell, so only its cells
+    are sorted, by the Morton code of the cell of their first particle, and particles keep their order within a cell.
+
+    The spatial hash is remapped to the new particle indecies and stays valid for the rest of the step.
+    The identity of every particle follows it in particles.ids.
+    """
+    global stepStartVelocities, stepsSinceReorder
+
+    sortedKeys = spatialIndecies[:, 2]
+    cellStarts = np.flatnonzero(np.diff(sortedKeys, prepend=-1))
+    cellCounts = np.diff(cellStarts, append=numOfParticles)
+    cells = sh.GetCells(predictedPositions[spatialIndecies[cellStarts, 0]], spatialCellSize)
+    cellOrder = np.argsort(sh.GetMortonCodes(cells), kind="stable")
+
+    _, entries = sh.ExpandRanges(cellStarts[cellOrder], cellCounts[cellOrder])
+    order = spatialIndecies[entries, 0]
+    particles.Reorder(order)
+
+    # Entries of the spatial hash point to the slots their particles moved to
+    newIndecies = np.empty_like(order)
+    newIndecies[order] = np.arange(numOfParticles)
+    spatialIndecies[:, 0] = newIndecies[spatialIndecies[:, 0]]
+
+    if useAdaptiveTimeStep:
+        stepStartVelocities = stepStartVelocities[order]
+    stepsSinceReorder = 0
+    recorder.Count("reorders")
+
+
+def UpdateNeighbourCandidates(symmetric=False):
+    """
+    Gathers candidate pairs of all particles from the neighbouring cells of the spatial hash in one pass over whole arrays.
+    Hash collisions are filtered the same way as in the cell walk, and only pairs within the cell size are kept.
+    Candidates come out ordered by particle.
+
+    Args:
+        symmetric: Gathers from the half stencil instead, so every pair comes out once and particles are not paired with themselves.
+    """
+    global candidateParticleIndecies, candidateIndecies, candidatesSymmetric
+
+    FindCandidates = sh.FindHalfCandidates if symmetric else sh.FindCandidates
+    counters = recorder.counters if recorder.enabled else None
+    particleIndecies, neighbourIndex = FindCandidates(predictedPositions, spatialIndecies, spatialOffsets, spatialEnds, spatialCellSize, gridShape=spatialGridShape, counters=counters)
+    candidatesSymmetric = symmetric
+
+    # Skip if not within search radius
+    offsetsToNeighbour = predictedPositions[neighbourIndex] - predictedPositions[particleIndecies]
+    inRadius = np.einsum("ij,ij->i", offsetsToNeighbour, offsetsToNeighbour) < spatialCellSize ** 2
+
+    candidateParticleIndecies = particleIndecies[inRadius]
+    candidateIndecies = neighbourIndex[inRadius]
+
+
+def UpdateVerletList(symmetric=False, gatherCandidates=True):
+    """
+    Rebuilds the spatial hash and the neighbour candidates only when needed: when some particle moved more than
+    half of the skin since the last rebuild, or when the search radius, particle count or kind of candidates changed.
+    Otherwise no pair can have come within smoothingRadius without being a candidate, so the old candidates are reused.
+
+    Args:
+        gatherCandidates: Gathers the candidates from the rebuilt spatial hash, the PARALLEL engine leaves that to its workers.
+
+    Returns: Whether the spatial hash was rebuilt.
+    """
+    global verletPositions, verletSearchRadius, verletSteps, verletRebuilds, candidatesSymmetric
+
+    verletSteps += 1
+
+    if verletPositions is not None and verletSearchRadius == GetSearchRadius() and candidatesSymmetric == symmetric:
+        displacements = predictedPositions - verletPositions
+        maxDisplacement = np.sqrt(np.einsum("ij,ij->i", displacements, displacements).max(initial=0))
+
+        if maxDisplacement <= verletSkin * 0.5: return False
+
+    with recorder.Phase("spatialHash"):
+        UpdateSpatialHash()
+    if gatherCandidates:
+        with recorder.Phase("neighbours"):
+            UpdateNeighbourCandidates(symmetric)
+    candidatesSymmetric = symmetric
+    recorder.Count("verletRebuilds")
+
+    verletPositions = predictedPositions.copy()
+    verletSearchRadius = GetSearchRadius()
+    verletRebuilds += 1
+    return True
+
+
+def GetVerletStats():
     """
-    global spatialIndecies, spatialOffsets
+    Returns: A dictionary with the number of steps and rebuilds of the Verlet list since InitializeArrays, and the rebuild rate.
+    """
+    return {
+        "steps": verletSteps,
+        "rebuilds": verletRebuilds,
+        "rebuildRate": verletRebuilds / verletSteps if verletSteps > 0 else 0,
+    }
 
-    for particleIndex in range(numOfParticles):
-        # Reset offsets so that each simulation iteration has a fresh offset array
-        spatialOffsets[particleIndex] = -1
 
-        # Update spatialIndecies array
-        cell = sh.GetCell(predictedPositions[particleIndex], smoothingRadius)
-        cellHash = sh.HashCell(cell)
-        cellKey = sh.GetKeyFromHash(cellHash, numOfParticles)
+def GetCandidatesInRadius():
+    """
+    Keeps the neighbour candidates within smoothingRadius and computes their distances and directions, once per pair per step.
+
+    Returns: A tuple (particleIndecies, neighbourIndecies, distances, directions), directions are random where the distance is zero.
+    """
+    # Skip if not within radius
+    offsetsToNeighbour = predictedPositions[candidateIndecies] - predictedPositions[candidateParticleIndecies]
+    distances = np.sqrt(np.einsum("ij,ij->i", offsetsToNeighbour, offsetsToNeighbour))
+    inRadius = distances < smoothingRadius
+    distances = distances[inRadius]
+
+    directions = fm.GetRandomDirections(len(distances)).astype(distances.dtype, copy=False)
+    nonZero = distances > 0
+    directions[nonZero] = offsetsToNeighbour[inRadius][nonZero] / distances[nonZero, None]
+
+    return candidateParticleIndecies[inRadius], candidateIndecies[inRadius], distances, directions
 
-        spatialIndecies[particleIndex] = [particleIndex, cellHash, cellKey]
 
-    # Sorting spatialIndecies by cellKey
-    spatialIndecies = sorted(spatialIndecies, key=lambda x : x[2])
+def UpdateNeighbourList():
+    """
+    Updates the neighbour list from the neighbour candidates, so density, pressure and viscosity passes
+    read their neighbours, distances and directions instead of each walking the 9 neighbouring cells.
+    """
+    global neighbourOffsets, neighbourParticleIndecies, neighbourIndecies, neighbourDistances, neighbourDirections
 
-    # Calculate Offsets
-    for particleIndex in range(numOfParticles):
-        # Calculate start indices of each unique cell key in spatial lookup
-        indexData = spatialIndecies[particleIndex]
-        previousIndexData = spatialIndecies[particleIndex - 1]
+    neighbourParticleIndecies, neighbourIndecies, neighbourDistances, neighbourDirections = GetCandidatesInRadius()
+
+    # Candidates are ordered by particle, so entries are already grouped in rows
+    neighbourOffsets = np.concatenate(([0], np.cumsum(np.bincount(neighbourParticleIndecies, minlength=numOfParticles))))
+
+
+def UpdatePairList():
+    """
+    Updates the pair list from the half stencil candidates, holding every pair within smoothingRadius once.
+    """
+    global pairParticleIndecies, pairNeighbourIndecies, pairDistances, pairDirections
+
+    pairParticleIndecies, pairNeighbourIndecies, pairDistances, pairDirections = GetCandidatesInRadius()
+
+
+def UpdateNeighbours(symmetric=False):
+    """
+    Updates the neighbour list, through the Verlet list when enabled, otherwise from a freshly built spatial hash.
+
+    Args:
+        symmetric: Updates the pair list instead of the neighbour list.
+    """
+    if UsesVerletList():
+        UpdateVerletList(symmetric)
+    else:
+        with recorder.Phase("spatialHash"):
+            UpdateSpatialHash()
+        with recorder.Phase("neighbours"):
+            UpdateNeighbourCandidates(symmetric)
+
+    with recorder.Phase("neighbours"):
+        if symmetric:
+            UpdatePairList()
+            recorder.Count("pairsInRadius", len(pairDistances))
+        else:
+            UpdateNeighbourList()
+            # Each pair is listed from both sides, and every particle with itself
+            recorder.Count("pairsInRadius", (len(neighbourDistances) - numOfParticles) // 2)
 
-        cellKey = indexData[2]
-        previousCellKey = -1 if particleIndex == 0 else previousIndexData[2]
-        
-        # If first occurance of key in spaitalIndecies
-        if cellKey != previousCellKey:
-            spatialOffsets[cellKey] = particleIndex
 
 # Densities
 def CalculateDensityNaive(samplePoint):
@@ -217,38 +604,13 @@ def CalculateDensityNaive(samplePoint):
 
 def CalculateDensity(particleIndex):
     """
-    Calculates the density of a particle at the given index using a spatial hash for efficiency.
+    Calculates the density of a particle at the given index from its neighbour list.
     """
-    position = predictedPositions[particleIndex]
-    originCell = sh.GetCell(position, smoothingRadius)
     density = 0
 
-    # Neighbour search
-    for i in range(9):
-        neighbourHash = sh.HashCell(originCell + sh.offsets[i])
-        neighbourKey = sh.GetKeyFromHash(neighbourHash, numOfParticles)
-        currIndex = spatialOffsets[neighbourKey]
-
-        while currIndex < numOfParticles:
-            indexData = spatialIndecies[currIndex]
-            currIndex += 1
-
-            # Break if no longer looking points in neighbouring cell
-            if indexData[2] != neighbourKey: break
-            # Skip if hash does not match, additonal checking if looking at real neighbour, since grid can be infinite
-            if indexData[1] != neighbourHash: continue
-
-            neighbourIndex = indexData[0]
-
-            neighbourPosition = predictedPositions[neighbourIndex]
-            offsetToNeighbour = neighbourPosition - position
-            distanceToNeighbour = np.linalg.norm(offsetToNeighbour)
-
-            # Skip if not within radius
-            if distanceToNeighbour >= smoothingRadius: continue
-
-            # Calculate densities
-            density += particleMass * fm.SpikyFunctionPow2(smoothingRadius, distanceToNeighbour)
+    for entry in range(neighbourOffsets[particleIndex], neighbourOffsets[particleIndex + 1]):
+        # Calculate densities
+        density += particleMass * fm.SpikyFunctionPow2(smoothingRadius, neighbourDistances[entry])
 
     return density
 
@@ -263,49 +625,27 @@ def UpdateDensity(particleIndex):
 # Pressure forces
 def CalculatePressureForce(particleIndex):
     """
-    Calculates the pressure force acting on a particle at the given index using a spatial hash for efficiency.
+    Calculates the pressure force acting on a particle at the given index from its neighbour list.
    Pressure force is calculated by using the DensityDerivative for the slope value
     """
-    position = predictedPositions[particleIndex]
     density = densities[particleIndex]
     pressure = fm.PressureFromDensity(density, targetDensity, pressureMultiplier)
 
-    originCell = sh.GetCell(position, smoothingRadius)
     pressureForce = np.zeros(2, dtype=float)
 
-    # Neighbour search
-    for i in range(9):
-        neighbourHash = sh.HashCell(originCell + sh.offsets[i])
-        neighbourKey = sh.GetKeyFromHash(neighbourHash, numOfParticles)
-        currIndex = spatialOffsets[neighbourKey]
+    for entry in range(neighbourOffsets[particleIndex], neighbourOffsets[particleIndex + 1]):
+        neighbourIndex = neighbourIndecies[entry]
+        # Skip if looking at self
+        if neighbourIndex == particleIndex: continue
 
-        while currIndex < numOfParticles:
-            indexData = spatialIndecies[currIndex]
-            currIndex += 1
-            # Break if no longer looking at correct bin
-            if indexData[2] != neighbourKey: break
-            # Skip if hash does not match
-            if indexData[1] != neighbourHash: continue
+        #Calculate pressure force
+        directionToNeighbour = neighbourDirections[entry]
 
-            neighbourIndex = indexData[0]
-            # Skip if looking at self
-            if neighbourIndex == particleIndex: continue
+        neighbourDensity = densities[neighbourIndex]
+        neighbourPressure = fm.PressureFromDensity(neighbourDensity, targetDensity, pressureMultiplier)
+        sharedPressure = (pressure + neighbourPressure) * 0.5 # Newton's third law of motion
 
-            neighbourPosition = predictedPositions[neighbourIndex]
-            offsetToNeighbour = neighbourPosition - position
-            distanceToNeighbour = np.linalg.norm(offsetToNeighbour)
-
-            # Skip if not within radius
-            if distanceToNeighbour >= smoothingRadius: continue
-
-            #Calculate pressure force
-            directionToNeighbour = offsetToNeighbour / distanceToNeighbour if distanceToNeighbour > 0 else fm.GetRandomDirection()
-
-            neighbourDensity = densities[neighbourIndex]
-            neighbourPressure = fm.PressureFromDensity(neighbourDensity, targetDensity, pressureMultiplier)
-            sharedPressure = (pressure + neighbourPressure) * 0.5 # Newton's third law of motion
-
-            pressureForce += directionToNeighbour * DensityDerivatice(smoothingRadius, distanceToNeighbour) * sharedPressure / neighbourDensity
+        pressureForce += directionToNeighbour * DensityDerivatice(smoothingRadius, neighbourDistances[entry]) * sharedPressure / neighbourDensity
      
     return pressureForce
  
@@ -322,48 +662,25 @@ def UpdatePressureForce(particleIndex):
 
     if density > densityThreshhold:
         acceleration = pressureForce / density
-        velocities[particleIndex] += acceleration  
+        velocities[particleIndex] += acceleration * deltaTime
 
 # Viscosities
 def CalculateViscosityForce(particleIndex):
     """
-    Calculates the viscosity force acting on a particle at the given index using a spatial hash for efficiency
+    Calculates the viscosity force acting on a particle at the given index from its neighbour list.
     Viscostiy is calculated by bluring together the velosities of nearby regions of fluid
     """
-    position = predictedPositions[particleIndex]
-    originCell = sh.GetCell(position, smoothingRadius)
-
     viscosityForce = 0
     velocity = velocities[particleIndex]
 
-    for i in range(9):
-        neighbourHash = sh.HashCell(originCell + sh.offsets[i])
-        neighbourKey = sh.GetKeyFromHash(neighbourHash, numOfParticles)
-        currIndex = spatialOffsets[neighbourKey]
-
-        while currIndex < numOfParticles:
-            indexData = spatialIndecies[currIndex]
-            currIndex += 1
-
-            # Break if no longer looking at correct bin
-            if indexData[2] != neighbourKey: break
-            # Skip if hash does not match
-            if indexData[1] != neighbourHash: continue
-
-            neighbourIndex = indexData[0]
-            # Skip if looking at self
-            if neighbourIndex == particleIndex: continue
-
-            neighbourPosition = predictedPositions[neighbourIndex]
-            offsetToNeighbour = neighbourPosition - position
-            distanceToNeighbour = np.linalg.norm(offsetToNeighbour)
+    for entry in range(neighbourOffsets[particleIndex], neighbourOffsets[particleIndex + 1]):
+        neighbourIndex = neighbourIndecies[entry]
+        # Skip if looking at self
+        if neighbourIndex == particleIndex: continue
 
-            # Skip if not in radius
-            if distanceToNeighbour >= smoothingRadius: continue
-
-            # Calculate viscosity
-            neighbourVelocity = velocities[neighbourIndex]
-            viscosityForce += (neighbourVelocity - velocity) * ViscosityFunction(smoothingRadius, distanceToNeighbour)
+        # Calculate viscosity
+        neighbourVelocity = velocities[neighbourIndex]
+        viscosityForce += (neighbourVelocity - velocity) * ViscosityFunction(smoothingRadius, neighbourDistances[entry])
 
     return viscosityForce
 
@@ -373,46 +690,447 @@ def UpdateViscosity(particleIndex):
     Updates the viscosity force acting on a particle at the given index.
     """
     viscosityForce = CalculateViscosityForce(particleIndex)
-    velocities[particleIndex] += viscosityForce * viscosityStrength
+    velocities[particleIndex] += viscosityForce * viscosityStrength * deltaTime
 
 
 def UpdatePosition(particleIndex):
     """
     Updates the position and velocity of a particle at the given index based on collision handling.
     """
+    if useAdaptiveTimeStep:
+        velocityBefore = velocities[particleIndex].copy()
+
     newValues = HandleCollisions(particleIndex)
 
+    # Only particles that did not collide, their velocity is still the one before
+    if useAdaptiveTimeStep and np.array_equal(newValues[1], velocityBefore):
+        MeasureAcceleration([particleIndex])
+
     positions[particleIndex] = newValues[0]
     velocities[particleIndex] = newValues[1]
 
 
-def SimulationStep(mousePos):
+## Vectorized engine
+def SumPerParticle(particleIndecies, values):
+    """
+    Sums per pair values into per particle totals. Values are either (P,) or (P, 2).
+
+    Returns: An array of shape (N,) or (N, 2).
+    """
+    if values.ndim == 1:
+        return np.bincount(particleIndecies, weights=values, minlength=numOfParticles)
+
+    return np.stack([np.bincount(particleIndecies, weights=values[:, i], minlength=numOfParticles) for i in range(values.shape[1])], axis=1)
+
+
+def UpdateAllExternalForces(mousePos):
+    """ 
+    Adding external forces, such as gravity, and interaction force, to all particles at once, then predicts their positions
+    """
+    acceleration = np.zeros_like(velocities)
+    acceleration[:, 1] = gravity
+
+    # Alter acceleration by user interaction
+    if mouseInput != 0:
+        offsetToInput = np.asarray(mousePos, dtype=positions.dtype) - positions
+        distanceToInput = np.sqrt(np.einsum("ij,ij->i", offsetToInput, offsetToInput))
+        inRadius = np.flatnonzero(distanceToInput < mouseInteractionRadius)
+
+        offsetToInput = offsetToInput[inRadius]
+        distanceToInput = distanceToInput[inRadius]
+        forceStrength = distanceToInput / mouseInteractionRadius
+
+        directionToInput = fm.GetRandomDirections(len(inRadius))
+        nonZero = distanceToInput > 0
+        directionToInput[nonZero] = offsetToInput[nonZero] / distanceToInput[nonZero, None]
+
+        acceleration[inRadius] += directionToInput * (mouseInteractionStrength * mouseInput * forceStrength)[:, None]
+        acceleration[inRadius] -= velocities[inRadius]
+
+    velocities[:] += acceleration * deltaTime
+
+    # Prediction
+    predictionFactor = deltaTime
+    predictedPositions[:] = positions + velocities * predictionFactor
+
+
+def UpdateAllDensities():
+    """
+    Updates the densities of all particles from the neighbour list.
+    """
+    influences = fm.spikyPow2.Value(smoothingRadius, neighbourDistances)
+    densities[:] = SumPerParticle(neighbourParticleIndecies, particleMass * influences)
+
+
+def UpdateAllPressureForces():
+    """
+    Updates velocities of all particles by the pressure force, symmetrised with shared pressure between pairs.
+    """
+    # Skip if looking at self
+    notSelf = neighbourParticleIndecies != neighbourIndecies
+    particleIndecies = neighbourParticleIndecies[notSelf]
+    neighbourIndex = neighbourIndecies[notSelf]
+
+    pressures = fm.PressureFromDensity(densities, targetDensity, pressureMultiplier)
+    sharedPressures = (pressures[particleIndecies] + pressures[neighbourIndex]) * 0.5 # Newton's third law of motion
+
+    magnitudes = fm.spikyPow2.Derivative(smoothingRadius, neighbourDistances[notSelf]) * sharedPressures / densities[neighbourIndex]
+    pressureForces = SumPerParticle(particleIndecies, neighbourDirections[notSelf] * magnitudes[:, None])
+
+    aboveThreshhold = densities > densityThreshhold
+    velocities[aboveThreshhold] += pressureForces[aboveThreshhold] / densities[aboveThreshhold, None] * deltaTime
+
+
+def UpdateAllViscosities():
+    """
+    Updates velocities of all particles by the viscosity force, bluring together velocities of nearby particles.
+    The self entries add nothing, since the velocity difference is zero.
+    """
+    influences = fm.smoothPow3.Value(smoothingRadius, neighbourDistances)
+    velocityDifferences = velocities[neighbourIndecies] - velocities[neighbourParticleIndecies]
+    viscosityForces = SumPerParticle(neighbourParticleIndecies, velocityDifferences * influences[:, None])
+
+    velocities[:] += viscosityForces * viscosityStrength * deltaTime
+
+
+def SumPerPair(values, sign):
+    """
+    Adds per pair values to the first particle of each pair, and sign times the values to the second one.
+    With sign -1 both get equal and opposite contributions. Values are either (H,) or (H, 2).
+
+    Returns: An array of shape (N,) or (N, 2).
+    """
+    return SumPerParticle(np.concatenate((pairParticleIndecies, pairNeighbourIndecies)), np.concatenate((values, sign * values)))
+
+
+def UpdateAllDensitiesFromPairs():
+    """
+    Updates the densities of all particles from the pair list, every pair adding the same influence to both particles.
+    The pair list holds no self entries, so the own influence is added at distance zero.
+    """
+    influences = fm.spikyPow2.Value(smoothingRadius, pairDistances)
+    densities[:] = SumPerPair(particleMass * influences, 1) + particleMass * fm.spikyPow2.Value(smoothingRadius, 0)
+
+
+def UpdateAllPressureForcesFromPairs():
+    """
+    Updates velocities of all particles by the pressure force from the pair list.
+    Each pair is evaluated once, and both particles get equal and opposite accelerations.
+    """
+    pressures = fm.PressureFromDensity(densities, targetDensity, pressureMultiplier)
+    sharedPressures = (pressures[pairParticleIndecies] + pressures[pairNeighbourIndecies]) * 0.5 # Newton's third law of motion
+
+    # Force on each particle is divided by the density of the other one, acceleration again by its own
+    magnitudes = fm.spikyPow2.Derivative(smoothingRadius, pairDistances) * sharedPressures / (densities[pairParticleIndecies] * densities[pairNeighbourIndecies])
+    accelerations = SumPerPair(pairDirections * magnitudes[:, None], -1)
+
+    aboveThreshhold = densities > densityThreshhold
+    velocities[aboveThreshhold] += accelerations[aboveThreshhold] * deltaTime
+
+
+def UpdateAllViscositiesFromPairs():
+    """
+    Updates velocities of all particles by the viscosity force from the pair list.
+    Each pair is evaluated once, and both particles get equal and opposite changes of velocity.
+    """
+    influences = fm.smoothPow3.Value(smoothingRadius, pairDistances)
+    velocityDifferences = velocities[pairNeighbourIndecies] - velocities[pairParticleIndecies]
+    viscosityForces = SumPerPair(velocityDifferences * influences[:, None], -1)
+
+    velocities[:] += viscosityForces * viscosityStrength * deltaTime
+
+
+def UpdateAllPositions():
+    """ 
+    Moves all particles by their velocities, placing particles that left the bounds on the boundary and reversing their velocity.
+    """
+    newPositions = positions + velocities * deltaTime
+
+    simAreaWidth = SCREEN_SIZE[0] - GUI_SIZE[0]
+
+    HALF_BOUND_X = (simAreaWidth - particleSize) * 0.5
+    HALF_BOUND_Y = (SCREEN_SIZE[1] - particleSize) * 0.5
+
+    bounds = ((0, HALF_BOUND_X), (1, HALF_BOUND_Y))
+    collisions = [np.abs(newPositions[:, axis] - halfBound) >= halfBound for axis, halfBound in bounds]
+
+    if useAdaptiveTimeStep:
+        MeasureAcceleration(~(collisions[0] | collisions[1]))
+
+    for (axis, halfBound), collided in zip(bounds, collisions):
+        newPositions[collided, axis] = halfBound * np.sign(newPositions[collided, axis]) + halfBound
+        velocities[collided, axis] *= -1 * collisionDamping
+
+    positions[:] = newPositions
+
+
+def VectorizedSimulationStep(mousePos):
+    """
+    Performs a single simulation step with whole array operations. 
+    Phases run one after another over all particles, so the pressure and viscosity passes
+    read the velocities from the end of the previous phase instead of partially updated ones.
+    With useSymmetricPairs the density, pressure and viscosity passes evaluate every pair once instead of from both sides.
+    """
+    with recorder.Phase("externalForces"):
+        UpdateAllExternalForces(mousePos)
+
+    UpdateNeighbours(symmetric=useSymmetricPairs)
+
+    if useSymmetricPairs:
+        UpdateDensities, UpdatePressureForces, UpdateViscosities = UpdateAllDensitiesFromPairs, UpdateAllPressureForcesFromPairs, UpdateAllViscositiesFromPairs
+    else:
+        UpdateDensities, UpdatePressureForces, UpdateViscosities = UpdateAllDensities, UpdateAllPressureForces, UpdateAllViscosities
+
+    with recorder.Phase("density"):
+        UpdateDensities()
+    with recorder.Phase("pressure"):
+        UpdatePressureForces()
+    with recorder.Phase("viscosity"):
+        UpdateViscosities()
+    with recorder.Phase("positions"):
+        UpdateAllPositions()
+
+
+def NumbaSimulationStep(mousePos):
+    """
+    Performs a single simulation step with the density, pressure and viscosity loops compiled by Numba.
+    The compiled loops walk the neighbouring cell ranges of the spatial hash directly, so no neighbour list is built.
+    With useVerletList they walk the Verlet candidates of every particle instead, as a single range each.
+    With useSymmetricPairs they walk the half stencil, evaluating every pair once, and each thread sums the contributions
+    to both particles of its pairs into its own accumulator. Otherwise every particle gathers from all its neighbours on its own.
+    """
+    with recorder.Phase("externalForces"):
+        UpdateAllExternalForces(mousePos)
+
+    if UsesVerletList():
+        UpdateVerletList(symmetric=useSymmetricPairs)
+
+        with recorder.Phase("neighbours"):
+            # Candidates are ordered by particle, and the loops only read the first column of the table
+            candidateTable = candidateIndecies[:, None]
+            rangeEnds = np.cumsum(np.bincount(candidateParticleIndecies, minlength=numOfParticles))[:, None]
+            rangeStarts = np.concatenate(([0], rangeEnds[:-1, 0]))[:, None]
+            rangeHashes = None
+    else:
+        with recorder.Phase("spatialHash"):
+            UpdateSpatialHash()
+
+        with recorder.Phase("neighbours"):
+            candidateTable = spatialIndecies
+            if useSymmetricPairs:
+                rangeStarts, rangeEnds, rangeHashes = sh.GetHalfNeighbourRanges(predictedPositions, spatialCellSize, spatialIndecies, spatialOffsets, spatialEnds, spatialGridShape)
+            else:
+                rangeStarts, rangeEnds, rangeHashes = sh.GetNeighbourRanges(predictedPositions, spatialCellSize, spatialOffsets, spatialEnds, spatialGridShape)
+
+    checkHashes = rangeHashes is not None
+    if not checkHashes:
+        rangeHashes = np.empty((0, 0), dtype=np.int64)
+
+    # Every pass walks all candidates of the ranges once
+    if recorder.enabled:
+        recorder.Count("candidatesVisited", int((rangeEnds - rangeStarts).sum()))
+
+    hashTables = (predictedPositions, candidateTable, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius)
+    fm.spikyPow2.SetRadius(smoothingRadius)
+    fm.smoothPow3.SetRadius(smoothingRadius)
+
+    if useSymmetricPairs:
+        numOfChunks = nb.GetNumOfChunks()
+        with recorder.Phase("density"):
+            nb.UpdateDensitiesFromPairs(*hashTables, fm.spikyPow2.valueScale, particleMass, densities, numOfChunks)
+        with recorder.Phase("pressure"):
+            nb.UpdatePressureForcesFromPairs(*hashTables, fm.spikyPow2.derivativeScale, densities, velocities, targetDensity, pressureMultiplier, densityThreshhold, deltaTime, numOfChunks)
+        with recorder.Phase("viscosity"):
+            nb.UpdateViscositiesFromPairs(*hashTables, fm.smoothPow3.valueScale, velocities, viscosityStrength, deltaTime, numOfChunks)
+    else:
+        with recorder.Phase("density"):
+            nb.UpdateDensities(*hashTables, fm.spikyPow2.valueScale, particleMass, densities)
+        with recorder.Phase("pressure"):
+            nb.UpdatePressureForces(*hashTables, fm.spikyPow2.derivativeScale, densities, velocities, targetDensity, pressureMultiplier, densityThreshhold, deltaTime)
+        with recorder.Phase("viscosity"):
+            nb.UpdateViscosities(*hashTables, fm.smoothPow3.valueScale, velocities, viscosityStrength, deltaTime)
+    with recorder.Phase("positions"):
+        UpdateAllPositions()
+
+
+def EnsureWorkerPool():
+    """
+    Starts the worker pool when needed and moves the particle arrays into its shared memory.
+    Restarts the pool when the number of workers changed, and reshares when the particle store changed.
+    New workers hold no Verlet candidates, so the next step rebuilds them.
+    """
+    global workerPool, verletPositions
+
+    wantedWorkers = numOfWorkers if numOfWorkers > 0 else os.cpu_count()
+
+    if workerPool is not None and workerPool.numOfWorkers != wantedWorkers:
+        Shutdown()
+
+    if workerPool is None:
+        workerPool = pc.WorkerPool(wantedWorkers)
+
+    if workerPool.particles is not particles:
+        workerPool.ShareParticles(particles)
+        BindParticleArrays()
+        verletPositions = None
+
+
+def ParallelSimulationStep(mousePos):
+    """
+    Performs a single simulation step with density, pressure and viscosity split over the worker pool.
+    Each of the three phases is a parallel sweep over particle ranges, and the next one starts only after all workers finished.
+    Workers only write to the particles of their own range, so pairs are evaluated from both sides whatever useSymmetricPairs says.
+    With useVerletList the spatial hash is only rebuilt and published when the Verlet list expired, and workers keep
+    the candidates of their range until then.
+    """
+    EnsureWorkerPool()
+
+    with recorder.Phase("externalForces"):
+        UpdateAllExternalForces(mousePos)
+
+    if UsesVerletList():
+        rebuilt = UpdateVerletList(gatherCandidates=False)
+    else:
+        with recorder.Phase("spatialHash"):
+            UpdateSpatialHash()
+        rebuilt = True
+
+    if rebuilt:
+        with recorder.Phase("spatialHash"):
+            workerPool.PublishSpatialHash(spatialIndecies, spatialOffsets, spatialEnds)
+
+    settings = {
+        "gatherCandidates": rebuilt,
+        "keepCandidates": UsesVerletList(),
+        "cellSize": spatialCellSize,
+        "gridShape": spatialGridShape,
+        "smoothingRadius": smoothingRadius,
+        "particleMass": particleMass,
+        "targetDensity": targetDensity,
+        "pressureMultiplier": pressureMultiplier,
+        "densityThreshhold": densityThreshhold,
+        "viscosityStrength": viscosityStrength,
+        "deltaTime": deltaTime,
+    }
+
+    # Workers find their pairs in the density phase
+    with recorder.Phase("density"):
+        workerPool.RunPhase(pc.DENSITY, settings)
+    with recorder.Phase("pressure"):
+        workerPool.RunPhase(pc.PRESSURE, settings)
+    with recorder.Phase("viscosity"):
+        workerPool.RunPhase(pc.VISCOSITY, settings)
+    with recorder.Phase("positions"):
+        UpdateAllPositions()
+
+
+def Shutdown():
+    """
+    Stops the worker pool of the PARALLEL engine, if running. Particle arrays are copied out of shared memory first.
+    Closes the trajectory being recorded.
+    """
+    global workerPool
+
+    SetTrajectoryWriter(None)
+
+    if workerPool is None: return
+
+    workerPool.Close()
+    workerPool = None
+
+    if particles is not None:
+        BindParticleArrays()
+
+
+def ScalarSimulationStep(mousePos):
     """"
     Performs a single simulation step, updating forces, densities, and positions for all particles.
     For every particle: 
         Update External Forces
-        Update Spatial Hash
+        Update Spatial Hash and Neighbour List
         Update Density
         Update Pressure Force
         Update Viscosity
         Update Position
     """
-    for particleIndex in range(numOfParticles):
-        UpdateExternalForces(particleIndex, mousePos)
+    with recorder.Phase("externalForces"):
+        for particleIndex in range(numOfParticles):
+            UpdateExternalForces(particleIndex, mousePos)
 
-    UpdateSpatialHash()
+    UpdateNeighbours()
     
-    for particleIndex in range(numOfParticles):
-        UpdateDensity(particleIndex)
+    with recorder.Phase("density"):
+        for particleIndex in range(numOfParticles):
+            UpdateDensity(particleIndex)
+
+    # One phase for the whole sweep, the three updates take turns per particle
+    with recorder.Phase("pressureViscosityPositions"):
+        for particleIndex in range(numOfParticles):    
+            UpdatePressureForce(particleIndex)
+            UpdateViscosity(particleIndex)
+            UpdatePosition(particleIndex)
+
+
+def SimulationStep(mousePos):
+    """
+    Performs a single simulation step of deltaTime with the selected engine, chosen first with useAdaptiveTimeStep.
+    While the recorder is enabled, the phase times and counters of the step are handed to its sinks.
+
+    Returns: The simulated time the step advanced.
+    """
+    global simulatedTime, stepsSinceReorder
+
+    if recorder.enabled:
+        recorder.StartStep()
 
-    for particleIndex in range(numOfParticles):    
-        UpdatePressureForce(particleIndex)
-        UpdateViscosity(particleIndex)
-        UpdatePosition(particleIndex)
+    if useAdaptiveTimeStep:
+        UpdateDeltaTime()
+
+    if engine == VECTORIZED:
+        VectorizedSimulationStep(mousePos)
+    elif engine == NUMBA:
+        NumbaSimulationStep(mousePos)
+    elif engine == PARALLEL:
+        ParallelSimulationStep(mousePos)
+    else:
+        ScalarSimulationStep(mousePos)
+
+    simulatedTime += deltaTime
+    stepsSinceReorder += 1
+
+    if trajectoryWriter is not None:
+        trajectoryWriter.AddStep(particles, simulatedTime)
+
+    if recorder.enabled:
+        recorder.Count("deltaTime", deltaTime)
+        recorder.EndStep()
+
+    return deltaTime
+
+
+def SetTrajectoryWriter(writer):
+    """
+    Feeds every following step to the writer, closing the one fed before. None stops recording.
+
+    Args:
+        writer: A Trajectory.TrajectoryWriter, or any object with AddStep(particles, simulatedTime) and Close().
+    """
+    global trajectoryWriter
+
+    if trajectoryWriter is not None:
+        trajectoryWriter.Close()
+    trajectoryWriter = writer
 
 
 def GetPositions():
     """
     Returns the current positions of all particles.
     """
-    return positions
\ No newline at end of file
+    return positions
+
+
+def GetParticles():
+    """
+    Returns the particle store holding all particle arrays.
+    """
+    return particles
\ No newline at end of file
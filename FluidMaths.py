@@ -3,70 +3,184 @@ import numpy as np
 import random
 
 
+class Kernel:
+
+    def __init__(self):
+        """
+        Smoothing kernel with normalisation constants cached for the last used radius.
+        Values and derivatives accept a single distance or a whole array of distances.
+        """
+        self.radius = None
+
+
+    def SetRadius(self, radius):
+        """
+        Recomputes the normalisation constants, only when the radius changed.
+        """
+        if radius != self.radius:
+            self.radius = radius
+            self.ComputeConstants(radius)
+
+
+    @staticmethod
+    def Clamp(value):
+        """
+        Returns max(0, value) for a number or every element of an array.
+        """
+        if isinstance(value, np.ndarray):
+            return np.maximum(value, 0)
+        return max(0, value)
+
+
+    def ValueAndDerivative(self, radius, dst):
+        """
+        Computes the value and the derivative in one pass.
+
+        Returns: A pair (value, derivative).
+        """
+        return self.Value(radius, dst), self.Derivative(radius, dst)
+
+
+class SpikyPow2Kernel(Kernel):
+
+    def ComputeConstants(self, radius):
+        volume = 2 * math.pi * (radius ** 3) / 3
+        self.valueScale = volume ** -1
+        self.derivativeScale = 3 / (math.pi * radius ** 3)
+
+
+    def Value(self, radius, dst):
+        """
+        Computes the Spiky function with a power of 2.
+        """
+        self.SetRadius(radius)
+        value = self.Clamp(radius - dst)
+        return value * value * self.valueScale
+
+
+    def Derivative(self, radius, dst):
+        """
+        Computes the derivative of the Spiky function with a power of 2.
+        """
+        self.SetRadius(radius)
+        # Negative so it returns the slope value
+        return -self.Clamp(radius - dst) * self.derivativeScale
+
+
+    def ValueAndDerivative(self, radius, dst):
+        self.SetRadius(radius)
+        value = self.Clamp(radius - dst)
+        return value * value * self.valueScale, -value * self.derivativeScale
+
+
+class SpikyPow3Kernel(Kernel):
+
+    def ComputeConstants(self, radius):
+        volume = math.pi * (radius ** 4) / 2
+        self.valueScale = volume ** -1
+        self.derivativeScale = 6 / (math.pi * radius ** 4)
+
+
+    def Value(self, radius, dst):
+        """
+        Computes the Spiky function with a power of 3.
+        """
+        self.SetRadius(radius)
+        value = self.Clamp(radius - dst)
+        return value * value * value * self.valueScale
+
+
+    def Derivative(self, radius, dst):
+        """
+        Computes the derivative of the Spiky function with a power of 3.
+        """
+        self.SetRadius(radius)
+        value = self.Clamp(radius - dst)
+        # Negative so it returns the slope value
+        return -value * value * self.derivativeScale
+
+
+    def ValueAndDerivative(self, radius, dst):
+        self.SetRadius(radius)
+        value = self.Clamp(radius - dst)
+        valueSquared = value * value
+        return valueSquared * value * self.valueScale, -valueSquared * self.derivativeScale
+
+
+class SmoothPow3Kernel(Kernel):
+
+    def ComputeConstants(self, radius):
+        self.radiusSquared = radius ** 2
+        volume = 16/35.0 * radius ** 7
+        self.valueScale = volume ** -1
+        self.derivativeScale = 6 * self.valueScale
+
+
+    def Value(self, radius, dst):
+        """
+        Computes the Smooth function with a power of 3.
+        """
+        self.SetRadius(radius)
+        value = self.Clamp(self.radiusSquared - dst * dst)
+        return value * value * value * self.valueScale
+
+
+    def Derivative(self, radius, dst):
+        """
+        Computes the derivative of the Smooth function with a power of 3.
+        """
+        self.SetRadius(radius)
+        value = self.Clamp(self.radiusSquared - dst * dst)
+        # Negative so it returns the slope value
+        return -dst * value * value * self.derivativeScale
+
+
+    def ValueAndDerivative(self, radius, dst):
+        self.SetRadius(radius)
+        value = self.Clamp(self.radiusSquared - dst * dst)
+        valueSquared = value * value
+        return valueSquared * value * self.valueScale, -dst * valueSquared * self.derivativeScale
+
+
+# One shared instance per kernel type
+spikyPow2 = SpikyPow2Kernel()
+spikyPow3 = SpikyPow3Kernel()
+smoothPow3 = SmoothPow3Kernel()
+
+
 def SpikyFunctionPow2(radius, dst):
     """
     Computes the Spiky function with a power of 2.
-
     """
-    if (dst >= radius):
-        return 0
-
-    volume = 2 * math.pi * (radius ** 3) / 3
-    value = max(0, radius - dst) ** 2
-    return value * (volume ** -1)
+    return spikyPow2.Value(radius, dst)
 
 
 def SpikyFunctionPow3(radius, dst):
     """
     Computes the Spiky function with a power of 3.
     """
-    if dst >= radius:
-        return 0
-
-    volume = math.pi * (radius ** 4) / 2
-    value = max(0, radius - dst) ** 3
-    return value * (volume ** -1)
+    return spikyPow3.Value(radius, dst)
 
 
 def SmoothFunctionPow3(radius, dst):
     """
     Computes the Smooth function with a power of 3.
     """
-    if dst >= radius:
-        return 0
-    
-    value = max(0, radius ** 2 - dst ** 2) ** 3
-    volume = 16/35.0 * radius ** 7
-
-    return value * (volume ** -1)
+    return smoothPow3.Value(radius, dst)
 
 
 def SpikyFunctionPow2Derivative(radius, dst):
     """
     Computes the derivative of the Spiky function with a power of 2.
     """
-    if dst >= radius:
-        return 0
-    
-    value = radius - dst
-    scale = 3 / (math.pi * radius ** 3)
-
-    # Negative so it returns the slope value
-    return -value * scale
+    return spikyPow2.Derivative(radius, dst)
     
 
 def SpikyFunctionPow3Derivative(radius, dst):
     """
     Computes the derivative of the Spiky function with a power of 3.
     """
-    if dst >= radius:
-        return 0
-
-    value = (radius - dst) ** 2
-    scale = 6 / (math.pi * radius ** 4)
-    # Negative so it returns the slope value
-    return - value * scale
-
+    return spikyPow3.Derivative(radius, dst)
 
 
 def PressureFromDensity(density, targetDensity, pressureMultiplier):
@@ -99,3 +213,10 @@ def GetRandomDirection():
     direction[1] = random.random() * 2 - 1
 
     return direction
+
+
+def GetRandomDirections(count):
+    """ 
+    Returns (count, 2) array of random vectors with x and y in range -1 & 1
+    """
+    return np.random.random((count, 2)) * 2 - 1
@@ -75,6 +75,15 @@ class Gui:
         self.randomResetButton = self.CreateButton("RESET RANDOM", size)
 
 
+    def AddButton(self, text):
+        """
+        Adds a button below the sliders and the buttons added before.
+
+        Returns: The created button.
+        """
+        return self.CreateButton(text, (self.sliderLength, self.sliderHeight))
+
+
     def CreateButton(self, text, size):
         """
         Creates a button with the given text and size.
@@ -170,3 +179,32 @@ class Gui:
         Returns: A list of current values of all sliders.
         """
         return [slider.get_current_value() for slider in self.sliderArray]
+
+
+    def SetSliderValues(self, values):
+        """
+        Moves all sliders to the given values, clamped to their ranges.
+
+        Args:
+            values: The values in the order of the sliders.
+        """
+        for slider, value in zip(self.sliderArray, values):
+            slider.set_current_value(value, warn=False)
+
+
+    def SetSliderRange(self, index, minValue, maxValue):
+        """
+        Changes the range of a slider, keeping its value within the new range.
+
+        Args:
+            index: The position of the slider in the order the sliders were added.
+            minValue: New minimum value of the slider.
+            maxValue: New maximum value of the slider.
+        """
+        slider = self.sliderArray[index]
+        if tuple(slider.value_range) == (minValue, maxValue):
+            return
+
+        value = slider.get_current_value()
+        slider.value_range = (minValue, maxValue)
+        slider.set_current_value(min(max(value, minValue), maxValue), warn=False)
@@ -0,0 +1,244 @@
+import os
+import argparse
+import time
+import numpy as np
+
+import Computing
+import SimSetup
+import Instrumentation
+import Checkpoint
+import Trajectory
+
+# Engines and start options by their command line names
+ENGINES = {
+    "scalar": Computing.SCALAR,
+    "vectorized": Computing.VECTORIZED,
+    "numba": Computing.NUMBA,
+    "parallel": Computing.PARALLEL,
+}
+SPAWN_OPTIONS = {
+    "grid": SimSetup.GRID,
+    "random": SimSetup.RANDOM,
+}
+PRECISIONS = {
+    "float64": np.float64,
+    "float32": np.float32,
+}
+
+
+def ParseArguments(argv=None):
+    """
+    Parses the command line of the headless runner. Defaults match the settings of Simulation.
+
+    Returns: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Runs the fluid simulation without a window and reports its throughput.")
+
+    scenario = parser.add_argument_group("scenario")
+    scenario.add_argument("--particles", type=int, default=200, help="number of particles")
+    scenario.add_argument("--spawn", choices=SPAWN_OPTIONS, default="grid", help="start option")
+    scenario.add_argument("--particle-size", type=float, default=8)
+    scenario.add_argument("--particle-spacing", type=float, default=25, help="spacing between particles of the grid")
+    scenario.add_argument("--width", type=int, default=930, help="width of the simulation area")
+    scenario.add_argument("--height", type=int, default=720, help="height of the simulation area")
+    scenario.add_argument("--seed", type=int, default=None, help="seed of the random number generators")
+    scenario.add_argument("--restore", default=None, metavar="PATH", help="continues from a checkpoint file instead, with the settings it was written with")
+
+    physics = parser.add_argument_group("physics")
+    physics.add_argument("--gravity", type=float, default=0)
+    physics.add_argument("--collision-damping", type=float, default=0.5)
+    physics.add_argument("--particle-mass", type=float, default=1)
+    physics.add_argument("--smoothing-radius", type=float, default=50)
+    physics.add_argument("--target-density", type=float, default=5 / 10000.0)
+    physics.add_argument("--pressure-multiplier", type=float, default=500)
+    physics.add_argument("--viscosity-strength", type=float, default=0.5)
+    physics.add_argument("--density-threshhold", type=float, default=0.0000001)
+    physics.add_argument("--dt", type=float, default=1, help="simulated time of one step, the first one with --adaptive-dt")
+    physics.add_argument("--adaptive-dt", action="store_true", help="chooses the time step every step from the CFL condition and the force limit")
+    physics.add_argument("--max-dt", type=float, default=4, help="largest adaptive time step")
+
+    solver = parser.add_argument_group("solver")
+    solver.add_argument("--engine", choices=ENGINES, default="vectorized")
+    solver.add_argument("--precision", choices=PRECISIONS, default="float64", help="float type of the particle arrays, float32 halves their memory traffic")
+    solver.add_argument("--workers", type=int, default=0, help="worker processes of the parallel engine, 0 uses one per core")
+    solver.add_argument("--verlet", action="store_true", help="reuse neighbour candidates across steps")
+    solver.add_argument("--reorder-every", type=int, default=0, metavar="STEPS", help="reorders the particles in memory by the Morton order of their cells every so many steps, 0 never")
+    solver.add_argument("--verlet-skin", type=float, default=25)
+    solver.add_argument("--steps", type=int, default=1000, help="number of timed steps")
+    solver.add_argument("--warmup", type=int, default=0, help="untimed steps before the timed ones, e.g. to compile the Numba loops")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", default=None, help="writes the final particle arrays to this .npz file")
+    output.add_argument("--checkpoint", default=None, metavar="PATH", help="writes the final state to this checkpoint file, see --restore")
+    output.add_argument("--record", default=None, metavar="PATH", help="records the positions and velocities of every step, warmup included, to this trajectory file")
+    output.add_argument("--record-every", type=int, default=1, help="steps per recorded frame")
+    output.add_argument("--record-int16", action="store_true", help="quantizes recorded frames to int16 relative to the simulation area")
+    output.add_argument("--record-zlib", action="store_true", help="compresses every chunk of recorded frames")
+    output.add_argument("--quiet", action="store_true", help="only prints the final line")
+    output.add_argument("--phase-stats", action="store_true", help="records the timed steps and prints mean phase times and counters")
+    output.add_argument("--phase-csv", default=None, help="records the timed steps and writes one CSV line per step to this file")
+    output.add_argument("--trace", default=None, help="writes the timed steps to this Chrome trace JSON file")
+    output.add_argument("--profile", default=None, help="samples the stacks of the traced steps and writes them collapsed for flamegraphs to this file")
+
+    return parser.parse_args(argv)
+
+
+def Setup(args):
+    """
+    Spawns the particles and initializes the computing module from the parsed arguments,
+    or restores both from a checkpoint. The whole area is simulated, so the GUI takes no width.
+
+    Returns: The particle store.
+    """
+    if args.restore:
+        return Checkpoint.LoadCheckpoint(args.restore)
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    particles = SimSetup.SpawnParticles(SPAWN_OPTIONS[args.spawn], args.particles, args.particle_size, args.particle_spacing, args.width, args.height)
+
+    Computing.InitializeValues(
+        SCREEN_SIZE=(args.width, args.height),
+        GUI_SIZE=(0, args.height),
+        gravity=args.gravity,
+        collisionDamping=args.collision_damping,
+        particleSize=args.particle_size,
+        particleMass=args.particle_mass,
+        smoothingRadius=args.smoothing_radius,
+        targetDensity=args.target_density,
+        pressureMultiplier=args.pressure_multiplier,
+        viscosityStrength=args.viscosity_strength,
+        densityThreshhold=args.density_threshhold,
+        mouseInteractionStrength=0,
+        mouseInteractionRadius=0,
+        engine=ENGINES[args.engine],
+        useVerletList=args.verlet,
+        verletSkin=args.verlet_skin,
+        numOfWorkers=args.workers,
+        floatType=PRECISIONS[args.precision],
+        reorderInterval=args.reorder_every,
+        deltaTime=args.dt,
+        useAdaptiveTimeStep=args.adaptive_dt,
+        maxDeltaTime=args.max_dt
+        )
+
+    Computing.InitializeArrays(particles)
+
+    return particles
+
+
+def Run(steps):
+    """
+    Runs the given number of simulation steps without mouse input.
+
+    Returns: The elapsed wall clock time in seconds.
+    """
+    # Mouse input is off, the position is never read
+    mousePos = (0, 0)
+    recorder = Computing.recorder
+
+    start = time.perf_counter()
+    for step in range(steps):
+        with recorder.Span("SimulationStep"):
+            Computing.SimulationStep(mousePos)
+        recorder.EndFrame()
+
+    return time.perf_counter() - start
+
+
+def SaveState(path, particles):
+    """
+    Writes all particle arrays of the store to a .npz file, in the order of the particle ids.
+    """
+    np.savez(path, **{arrayName: particles.InIdOrder(array) for arrayName, array in particles.GetArrays().items()})
+
+
+def PrintPhaseStats(stepStats):
+    """
+    Prints the mean, min and max of every recorded phase time in milliseconds, and the mean of every counter.
+    """
+    for name, values in stepStats.items():
+        if name == "stepTime" or name in Computing.recorder.phaseNames:
+            print(f"{name:>16}: {values['mean'] * 1000:8.3f} ms (min {values['min'] * 1000:.3f}, max {values['max'] * 1000:.3f})")
+        else:
+            print(f"{name:>16}: {values['mean']:10.1f} per step")
+
+
+def Main(argv=None):
+    """
+    Runs a scenario from the command line and prints its throughput.
+
+    Returns: A dictionary with the number of steps, the elapsed time, and steps per second.
+    """
+    args = ParseArguments(argv)
+
+    try:
+        numOfParticles = len(Setup(args))
+        # A restored run starts at the simulated time of its checkpoint
+        startTime = Computing.simulatedTime
+        if args.record:
+            Trajectory.Record(args.record, every=args.record_every, quantize=args.record_int16, compress=args.record_zlib)
+
+        if not args.quiet:
+            engineName = {engine: name for name, engine in ENGINES.items()}[Computing.engine]
+            print(f"{numOfParticles} particles, {engineName} engine in {np.dtype(Computing.floatType).name}, {args.warmup} warmup and {args.steps} timed steps")
+
+        Run(args.warmup)
+
+        rollingStats = Instrumentation.RollingStats(window=max(1, args.steps)) if args.phase_stats else None
+        csvSink = Instrumentation.CsvSink(args.phase_csv) if args.phase_csv else None
+        sinks = [sink for sink in (rollingStats, csvSink) if sink is not None]
+        if sinks:
+            Computing.recorder.Enable(*sinks)
+        if args.trace:
+            Instrumentation.Tracer(args.trace, args.steps, args.profile).Start(Computing.recorder)
+
+        elapsed = Run(args.steps)
+
+        Computing.recorder.Disable()
+        if Computing.recorder.tracer is not None:
+            Computing.recorder.tracer.Stop()
+        if csvSink is not None:
+            csvSink.Close()
+
+        # The engine may have moved the arrays, e.g. into shared memory
+        particles = Computing.GetParticles()
+
+        if args.checkpoint:
+            Checkpoint.SaveCheckpoint(args.checkpoint)
+            if not args.quiet:
+                print(f"Checkpoint written to {args.checkpoint}")
+    finally:
+        Computing.Shutdown()
+
+    stats = {
+        "steps": args.steps,
+        "simulatedTime": Computing.simulatedTime,
+        "elapsed": elapsed,
+        "stepsPerSecond": args.steps / elapsed if elapsed > 0 else float("inf"),
+    }
+
+    if args.record and not args.quiet:
+        print(f"Trajectory written to {args.record}, {os.path.getsize(args.record) / 2 ** 20:.1f} MiB")
+
+    if args.output:
+        SaveState(args.output, particles)
+        if not args.quiet:
+            print(f"Final state written to {args.output}")
+
+    if rollingStats is not None:
+        PrintPhaseStats(rollingStats.GetStats())
+
+    if Computing.useAdaptiveTimeStep and not args.quiet:
+        runTime = stats["simulatedTime"] - startTime
+        print(f"Simulated time {runTime:.2f} in {args.warmup + args.steps} steps, mean step {runTime / max(1, args.warmup + args.steps):.3f}")
+
+    print(f"{stats['steps']} steps in {stats['elapsed']:.3f} s, {stats['stepsPerSecond']:.2f} steps/sec, {stats['stepsPerSecond'] * numOfParticles:.0f} particle steps/sec")
+
+    return stats
+
+
+# Guarded, so worker processes of the PARALLEL engine started with spawn do not run the scenario
+if __name__ == "__main__":
+    Main()
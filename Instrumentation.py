@@ -0,0 +1,388 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+from collections import deque, Counter
+
+
+class NullPhase:
+    """
+    Phase that measures nothing, handed out while the recorder is disabled so timed blocks cost almost nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nullPhase = NullPhase()
+
+
+class Phase:
+
+    def __init__(self, recorder, name):
+        """
+        Times one block of a simulation step and adds the time to the named phase of the recorder.
+        While a trace is running, the block is also added to it as a span.
+        """
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+
+        if self.recorder.enabled:
+            phases = self.recorder.phases
+            phases[self.name] = phases.get(self.name, 0.0) + end - self.start
+
+        tracer = self.recorder.tracer
+        if tracer is not None:
+            tracer.AddSpan(self.name, self.start, end)
+        return False
+
+
+class Span:
+
+    def __init__(self, tracer, name):
+        """
+        Adds one block to a trace as a span, without counting it as a phase.
+        """
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.AddSpan(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Recorder:
+
+    def __init__(self):
+        """
+        Collects phase times and counters of every simulation step and hands one record per step to its sinks.
+        Disabled by default, then timed blocks and counters cost a single check.
+        """
+        self.enabled = False
+        self.sinks = []
+        self.step = 0
+        self.phases = {}
+        self.counters = {}
+        self.phaseNames = set() # Names of all phases recorded so far, telling phase times apart from counters in records
+        self.stepStart = 0
+        self.tracer = None # Running Tracer, None when not tracing
+
+
+    def Enable(self, *sinks):
+        """
+        Enables recording, adding the given sinks.
+        """
+        for sink in sinks:
+            self.AddSink(sink)
+        self.enabled = True
+
+
+    def Disable(self):
+        self.enabled = False
+
+
+    def AddSink(self, sink):
+        """
+        Adds a sink, any callable taking a record dictionary, or an object with such a Write method.
+        """
+        self.sinks.append(sink)
+
+
+    def RemoveSink(self, sink):
+        self.sinks.remove(sink)
+
+
+    def Phase(self, name):
+        """
+        Returns: A context manager timing its block as part of the named phase, a shared no-op one while neither recording nor tracing.
+        """
+        if not self.enabled and self.tracer is None:
+            return nullPhase
+        return Phase(self, name)
+
+
+    def Span(self, name):
+        """
+        Returns: A context manager adding its block to the running trace, a shared no-op one while not tracing.
+        """
+        if self.tracer is None:
+            return nullPhase
+        return Span(self.tracer, name)
+
+
+    def EndFrame(self):
+        """
+        Marks the end of a frame, so a running trace can stop after its window of frames.
+        """
+        if self.tracer is not None:
+            self.tracer.EndFrame()
+
+
+    def Count(self, name, value=1):
+        """
+        Adds the value to the named counter of the current step.
+        """
+        if not self.enabled: return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def StartStep(self):
+        self.phases = {}
+        self.counters = {}
+        self.stepStart = time.perf_counter()
+
+
+    def EndStep(self):
+        """
+        Finishes the step and hands its record to every sink. Phase times are in seconds.
+
+        Returns: The record, a flat dictionary with the step number, total step time, phase times and counters.
+        """
+        record = {"step": self.step, "stepTime": time.perf_counter() - self.stepStart}
+        record.update(self.phases)
+        record.update(self.counters)
+        self.phaseNames.update(self.phases)
+        self.step += 1
+
+        for sink in self.sinks:
+            if hasattr(sink, "Write"):
+                sink.Write(record)
+            else:
+                sink(record)
+
+        return record
+
+
+class RollingStats:
+
+    def __init__(self, window=120):
+        """
+        Keeps the records of the last steps in memory and summarizes them.
+
+        Args:
+            window: The number of most recent steps kept.
+        """
+        self.records = deque(maxlen=window)
+
+
+    def Write(self, record):
+        self.records.append(record)
+
+
+    def GetStats(self):
+        """
+        Returns: A dictionary by value name of dictionaries with the mean, min, max, last and total over the kept steps.
+                 Steps missing a value count it as zero in the mean and total.
+        """
+        names = []
+        for record in self.records:
+            names += [name for name in record if name != "step" and name not in names]
+
+        stats = {}
+        for name in names:
+            values = [record.get(name, 0) for record in self.records]
+            stats[name] = {
+                "mean": sum(values) / len(values),
+                "min": min(values),
+                "max": max(values),
+                "last": values[-1],
+                "total": sum(values),
+            }
+
+        return stats
+
+
+class CsvSink:
+
+    def __init__(self, path, columns=None):
+        """
+        Writes one line per step to a CSV file.
+
+        Args:
+            path: The path of the CSV file, overwritten.
+            columns: The column names, by default the values of the first record. Missing values are left empty.
+        """
+        self.file = open(path, "w", newline="")
+        self.columns = columns
+        self.writer = None
+
+
+    def Write(self, record):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=self.columns or list(record), restval="", extrasaction="ignore")
+            self.writer.writeheader()
+
+        self.writer.writerow(record)
+
+
+    def Close(self):
+        self.file.close()
+
+
+class CallbackSink:
+
+    def __init__(self, callback, every=1):
+        """
+        Calls a function with the record of every n-th step.
+        """
+        self.callback = callback
+        self.every = every
+
+
+    def Write(self, record):
+        if record["step"] % self.every == 0:
+            self.callback(record)
+
+
+class Tracer:
+
+    def __init__(self, path, frames=120, profilePath=None, profileInterval=0.001):
+        """
+        Records spans of a window of frames and writes them as Chrome trace event JSON,
+        viewable in chrome://tracing or Perfetto. Spans nest by time, so phases show inside the step and frame around them.
+
+        Args:
+            path: The path of the trace JSON file.
+            frames: The number of frames traced, 0 traces until stopped.
+            profilePath: When given, the main thread is also sampled and its stacks written to this file
+                         in the collapsed format of flamegraph tools.
+            profileInterval: Seconds between samples of the sampling profiler.
+        """
+        self.path = path
+        self.frames = frames
+        self.framesLeft = frames
+        self.events = []
+        self.recorder = None
+        self.startTime = 0
+        self.profiler = SamplingProfiler(profilePath, profileInterval) if profilePath else None
+
+
+    def Start(self, recorder):
+        """
+        Starts tracing the spans and phases of the recorder.
+        """
+        self.recorder = recorder
+        self.events = []
+        self.framesLeft = self.frames
+        self.startTime = time.perf_counter()
+        recorder.tracer = self
+
+        if self.profiler is not None:
+            self.profiler.Start()
+
+
+    def AddSpan(self, name, start, end):
+        """
+        Adds a complete event, times in seconds of time.perf_counter.
+        """
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.startTime) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": 0,
+            "tid": 0,
+        })
+
+
+    def EndFrame(self):
+        """
+        Counts a traced frame, stopping the trace once the window is full.
+        """
+        self.framesLeft -= 1
+        if self.framesLeft == 0:
+            self.Stop()
+
+
+    def Stop(self):
+        """
+        Stops tracing and writes the trace, and the collapsed stacks of the profiler.
+        """
+        if self.recorder is not None and self.recorder.tracer is self:
+            self.recorder.tracer = None
+
+        if self.profiler is not None:
+            self.profiler.Stop()
+            self.profiler.Write()
+
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "Python fluid simulation"}},
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "main"}},
+        ]
+        with open(self.path, "w") as file:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, file)
+
+
+    @property
+    def running(self):
+        return self.recorder is not None and self.recorder.tracer is self
+
+
+class SamplingProfiler:
+
+    def __init__(self, path, interval=0.001):
+        """
+        Samples the stack of the thread that starts it from a background thread, counting how often each stack was seen.
+
+        Args:
+            path: The path of the collapsed stack file, one "outer;inner count" line per stack.
+            interval: Seconds between samples.
+        """
+        self.path = path
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread = None
+        self.running = False
+
+
+    def Start(self):
+        self.stacks = Counter()
+        self.running = True
+        self.threadId = threading.get_ident()
+        self.thread = threading.Thread(target=self.SampleLoop, daemon=True)
+        self.thread.start()
+
+
+    def SampleLoop(self):
+        while self.running:
+            frame = sys._current_frames().get(self.threadId)
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+
+    def Stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def Write(self):
+        with open(self.path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
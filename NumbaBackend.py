@@ -0,0 +1,392 @@
+import os
+import math
+import numpy as np
+
+import FluidMaths as fm
+
+try:
+    import numba
+    available = True
+except ImportError:
+    numba = None
+    available = False
+
+# A process that forked after TBB started its threads hangs on exit, as it does once the PARALLEL engine started its workers.
+# Other threading layers are preferred, unless one was chosen in the environment.
+if available and "NUMBA_THREADING_LAYER" not in os.environ:
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+
+def Jit(function=None, parallel=False):
+    """
+    Compiles a function to native code in nopython mode, when Numba is installed.
+    Compilation results are cached on disk next to the module, so only the first start pays for compiling.
+    Without Numba the function is returned unchanged and runs as plain Python.
+    """
+    if function is None:
+        return lambda function: Jit(function, parallel)
+
+    if not available:
+        return function
+
+    return numba.njit(cache=True, parallel=parallel)(function)
+
+
+# Loops over particles are spread over all cores when compiled
+ParallelRange = numba.prange if available else range
+
+# Compiled kernels, normalisation scales come precomputed from the FluidMaths kernel objects
+@Jit
+def SpikyFunctionPow2(radius, dst, valueScale):
+    """
+    Computes the Spiky function with a power of 2, see FluidMaths.SpikyPow2Kernel
+    """
+    value = max(0.0, radius - dst)
+    return value * value * valueScale
+
+
+@Jit
+def SpikyFunctionPow3(radius, dst, valueScale):
+    """
+    Computes the Spiky function with a power of 3, see FluidMaths.SpikyPow3Kernel
+    """
+    value = max(0.0, radius - dst)
+    return value * value * value * valueScale
+
+
+@Jit
+def SmoothFunctionPow3(radius, dst, valueScale):
+    """
+    Computes the Smooth function with a power of 3, see FluidMaths.SmoothPow3Kernel
+    """
+    value = max(0.0, radius * radius - dst * dst)
+    return value * value * value * valueScale
+
+
+@Jit
+def SpikyFunctionPow2Derivative(radius, dst, derivativeScale):
+    """
+    Computes the derivative of the Spiky function with a power of 2, see FluidMaths.SpikyPow2Kernel
+    """
+    # Negative so it returns the slope value
+    return -max(0.0, radius - dst) * derivativeScale
+
+
+@Jit
+def SpikyFunctionPow3Derivative(radius, dst, derivativeScale):
+    """
+    Computes the derivative of the Spiky function with a power of 3, see FluidMaths.SpikyPow3Kernel
+    """
+    value = max(0.0, radius - dst)
+    # Negative so it returns the slope value
+    return -value * value * derivativeScale
+
+
+PressureFromDensity = Jit(fm.PressureFromDensity)
+
+
+@Jit(parallel=True)
+def UpdateDensities(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, particleMass, densities):
+    """
+    Updates the densities of all particles by walking the neighbouring cell ranges of the spatial hash.
+    """
+    numOfParticles = len(predictedPositions)
+
+    for particleIndex in ParallelRange(numOfParticles):
+        positionX = predictedPositions[particleIndex, 0]
+        positionY = predictedPositions[particleIndex, 1]
+        density = 0.0
+
+        # Neighbour search
+        for i in range(rangeStarts.shape[1]):
+            for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                # Skip if hash does not match
+                if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                neighbourIndex = spatialIndecies[currIndex, 0]
+                offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                # Skip if not within radius
+                if distanceToNeighbour >= smoothingRadius: continue
+
+                density += particleMass * SpikyFunctionPow2(smoothingRadius, distanceToNeighbour, kernelScale)
+
+        densities[particleIndex] = density
+
+
+@Jit(parallel=True)
+def UpdatePressureForces(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, densities, velocities, targetDensity, pressureMultiplier, densityThreshhold, deltaTime):
+    """
+    Updates velocities of all particles by the pressure force, walking the neighbouring cell ranges of the spatial hash.
+    Each particle only writes its own velocity, so particles are processed in parallel.
+    """
+    numOfParticles = len(predictedPositions)
+
+    for particleIndex in ParallelRange(numOfParticles):
+        positionX = predictedPositions[particleIndex, 0]
+        positionY = predictedPositions[particleIndex, 1]
+
+        density = densities[particleIndex]
+        pressure = PressureFromDensity(density, targetDensity, pressureMultiplier)
+        pressureForceX = 0.0
+        pressureForceY = 0.0
+
+        # Neighbour search
+        for i in range(rangeStarts.shape[1]):
+            for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                # Skip if hash does not match
+                if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                neighbourIndex = spatialIndecies[currIndex, 0]
+                # Skip if looking at self
+                if neighbourIndex == particleIndex: continue
+
+                offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                # Skip if not within radius
+                if distanceToNeighbour >= smoothingRadius: continue
+
+                if distanceToNeighbour > 0:
+                    directionX = offsetX / distanceToNeighbour
+                    directionY = offsetY / distanceToNeighbour
+                else:
+                    directionX = np.random.random() * 2 - 1
+                    directionY = np.random.random() * 2 - 1
+
+                neighbourDensity = densities[neighbourIndex]
+                neighbourPressure = PressureFromDensity(neighbourDensity, targetDensity, pressureMultiplier)
+                sharedPressure = (pressure + neighbourPressure) * 0.5 # Newton's third law of motion
+
+                magnitude = SpikyFunctionPow2Derivative(smoothingRadius, distanceToNeighbour, kernelScale) * sharedPressure / neighbourDensity
+                pressureForceX += directionX * magnitude
+                pressureForceY += directionY * magnitude
+
+        if density > densityThreshhold:
+            velocities[particleIndex, 0] += pressureForceX / density * deltaTime
+            velocities[particleIndex, 1] += pressureForceY / density * deltaTime
+
+
+@Jit(parallel=True)
+def UpdateViscosities(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, velocities, viscosityStrength, deltaTime):
+    """
+    Updates velocities of all particles by the viscosity force, walking the neighbouring cell ranges of the spatial hash.
+    Forces are computed from a copy of the velocities first, so parallel particles never read a half updated velocity.
+    """
+    numOfParticles = len(predictedPositions)
+    previousVelocities = velocities.copy()
+
+    for particleIndex in ParallelRange(numOfParticles):
+        positionX = predictedPositions[particleIndex, 0]
+        positionY = predictedPositions[particleIndex, 1]
+
+        velocityX = previousVelocities[particleIndex, 0]
+        velocityY = previousVelocities[particleIndex, 1]
+        viscosityForceX = 0.0
+        viscosityForceY = 0.0
+
+        # Neighbour search
+        for i in range(rangeStarts.shape[1]):
+            for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                # Skip if hash does not match
+                if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                neighbourIndex = spatialIndecies[currIndex, 0]
+                # Skip if looking at self
+                if neighbourIndex == particleIndex: continue
+
+                offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                # Skip if not within radius
+                if distanceToNeighbour >= smoothingRadius: continue
+
+                influence = SmoothFunctionPow3(smoothingRadius, distanceToNeighbour, kernelScale)
+                viscosityForceX += (previousVelocities[neighbourIndex, 0] - velocityX) * influence
+                viscosityForceY += (previousVelocities[neighbourIndex, 1] - velocityY) * influence
+
+        velocities[particleIndex, 0] += viscosityForceX * viscosityStrength * deltaTime
+        velocities[particleIndex, 1] += viscosityForceY * viscosityStrength * deltaTime
+
+
+## Half stencil kernels, every pair is evaluated once and both particles get its contributions
+def GetNumOfChunks():
+    """
+    Returns: The number of chunks the particles are split in by the half stencil kernels, one per thread.
+    """
+    return numba.get_num_threads() if available else 1
+
+
+@Jit
+def GetChunkBounds(chunk, numOfChunks, numOfParticles):
+    return chunk * numOfParticles // numOfChunks, (chunk + 1) * numOfParticles // numOfChunks
+
+
+@Jit(parallel=True)
+def SumChunks(partials):
+    """
+    Sums the per chunk accumulators of shape (chunks, N, components) into one (N, components) array.
+    """
+    numOfParticles = partials.shape[1]
+    totals = np.zeros((numOfParticles, partials.shape[2]))
+
+    for particleIndex in ParallelRange(numOfParticles):
+        for chunk in range(partials.shape[0]):
+            for component in range(partials.shape[2]):
+                totals[particleIndex, component] += partials[chunk, particleIndex, component]
+
+    return totals
+
+
+@Jit(parallel=True)
+def UpdateDensitiesFromPairs(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, particleMass, densities, numOfChunks):
+    """
+    Updates the densities of all particles by walking the half stencil ranges of the spatial hash, adding every pair's influence to both particles.
+    A pair's neighbour may belong to any chunk, so each chunk of particles sums into its own accumulator and the accumulators are added up after.
+    The half stencil holds no self entries, so the own influence is added at distance zero.
+    """
+    numOfParticles = len(predictedPositions)
+    partials = np.zeros((numOfChunks, numOfParticles, 1))
+
+    for chunk in ParallelRange(numOfChunks):
+        start, end = GetChunkBounds(chunk, numOfChunks, numOfParticles)
+
+        for particleIndex in range(start, end):
+            positionX = predictedPositions[particleIndex, 0]
+            positionY = predictedPositions[particleIndex, 1]
+
+            # Neighbour search
+            for i in range(rangeStarts.shape[1]):
+                for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                    # Skip if hash does not match
+                    if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                    neighbourIndex = spatialIndecies[currIndex, 0]
+                    offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                    offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                    distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                    # Skip if not within radius
+                    if distanceToNeighbour >= smoothingRadius: continue
+
+                    influence = particleMass * SpikyFunctionPow2(smoothingRadius, distanceToNeighbour, kernelScale)
+                    partials[chunk, particleIndex, 0] += influence
+                    partials[chunk, neighbourIndex, 0] += influence
+
+    totals = SumChunks(partials)
+    ownInfluence = particleMass * SpikyFunctionPow2(smoothingRadius, 0.0, kernelScale)
+
+    for particleIndex in ParallelRange(numOfParticles):
+        densities[particleIndex] = totals[particleIndex, 0] + ownInfluence
+
+
+@Jit(parallel=True)
+def UpdatePressureForcesFromPairs(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, densities, velocities, targetDensity, pressureMultiplier, densityThreshhold, deltaTime, numOfChunks):
+    """
+    Updates velocities of all particles by the pressure force, walking the half stencil ranges of the spatial hash.
+    Each pair is evaluated once, and both particles get equal and opposite accelerations.
+    """
+    numOfParticles = len(predictedPositions)
+    partials = np.zeros((numOfChunks, numOfParticles, 2))
+
+    for chunk in ParallelRange(numOfChunks):
+        start, end = GetChunkBounds(chunk, numOfChunks, numOfParticles)
+
+        for particleIndex in range(start, end):
+            positionX = predictedPositions[particleIndex, 0]
+            positionY = predictedPositions[particleIndex, 1]
+
+            density = densities[particleIndex]
+            pressure = PressureFromDensity(density, targetDensity, pressureMultiplier)
+
+            # Neighbour search
+            for i in range(rangeStarts.shape[1]):
+                for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                    # Skip if hash does not match
+                    if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                    neighbourIndex = spatialIndecies[currIndex, 0]
+                    offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                    offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                    distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                    # Skip if not within radius
+                    if distanceToNeighbour >= smoothingRadius: continue
+
+                    if distanceToNeighbour > 0:
+                        directionX = offsetX / distanceToNeighbour
+                        directionY = offsetY / distanceToNeighbour
+                    else:
+                        directionX = np.random.random() * 2 - 1
+                        directionY = np.random.random() * 2 - 1
+
+                    neighbourDensity = densities[neighbourIndex]
+                    neighbourPressure = PressureFromDensity(neighbourDensity, targetDensity, pressureMultiplier)
+                    sharedPressure = (pressure + neighbourPressure) * 0.5 # Newton's third law of motion
+
+                    # Force on each particle is divided by the density of the other one, acceleration again by its own
+                    magnitude = SpikyFunctionPow2Derivative(smoothingRadius, distanceToNeighbour, kernelScale) * sharedPressure / (density * neighbourDensity)
+                    partials[chunk, particleIndex, 0] += directionX * magnitude
+                    partials[chunk, particleIndex, 1] += directionY * magnitude
+                    partials[chunk, neighbourIndex, 0] -= directionX * magnitude
+                    partials[chunk, neighbourIndex, 1] -= directionY * magnitude
+
+    accelerations = SumChunks(partials)
+
+    for particleIndex in ParallelRange(numOfParticles):
+        if densities[particleIndex] > densityThreshhold:
+            velocities[particleIndex, 0] += accelerations[particleIndex, 0] * deltaTime
+            velocities[particleIndex, 1] += accelerations[particleIndex, 1] * deltaTime
+
+
+@Jit(parallel=True)
+def UpdateViscositiesFromPairs(predictedPositions, spatialIndecies, rangeStarts, rangeEnds, rangeHashes, checkHashes, smoothingRadius, kernelScale, velocities, viscosityStrength, deltaTime, numOfChunks):
+    """
+    Updates velocities of all particles by the viscosity force, walking the half stencil ranges of the spatial hash.
+    Each pair is evaluated once, and both particles get equal and opposite changes of velocity.
+    Velocities are only written after all pairs were evaluated, so no pair reads a half updated velocity.
+    """
+    numOfParticles = len(predictedPositions)
+    partials = np.zeros((numOfChunks, numOfParticles, 2))
+
+    for chunk in ParallelRange(numOfChunks):
+        start, end = GetChunkBounds(chunk, numOfChunks, numOfParticles)
+
+        for particleIndex in range(start, end):
+            positionX = predictedPositions[particleIndex, 0]
+            positionY = predictedPositions[particleIndex, 1]
+
+            velocityX = velocities[particleIndex, 0]
+            velocityY = velocities[particleIndex, 1]
+
+            # Neighbour search
+            for i in range(rangeStarts.shape[1]):
+                for currIndex in range(rangeStarts[particleIndex, i], rangeEnds[particleIndex, i]):
+                    # Skip if hash does not match
+                    if checkHashes and spatialIndecies[currIndex, 1] != rangeHashes[particleIndex, i]: continue
+
+                    neighbourIndex = spatialIndecies[currIndex, 0]
+                    offsetX = predictedPositions[neighbourIndex, 0] - positionX
+                    offsetY = predictedPositions[neighbourIndex, 1] - positionY
+                    distanceToNeighbour = math.sqrt(offsetX * offsetX + offsetY * offsetY)
+
+                    # Skip if not within radius
+                    if distanceToNeighbour >= smoothingRadius: continue
+
+                    influence = SmoothFunctionPow3(smoothingRadius, distanceToNeighbour, kernelScale)
+                    forceX = (velocities[neighbourIndex, 0] - velocityX) * influence
+                    forceY = (velocities[neighbourIndex, 1] - velocityY) * influence
+                    partials[chunk, particleIndex, 0] += forceX
+                    partials[chunk, particleIndex, 1] += forceY
+                    partials[chunk, neighbourIndex, 0] -= forceX
+                    partials[chunk, neighbourIndex, 1] -= forceY
+
+    viscosityForces = SumChunks(partials)
+
+    for particleIndex in ParallelRange(numOfParticles):
+        velocities[particleIndex, 0] += viscosityForces[particleIndex, 0] * viscosityStrength * deltaTime
+        velocities[particleIndex, 1] += viscosityForces[particleIndex, 1] * viscosityStrength * deltaTime
@@ -0,0 +1,432 @@
+import os
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import FluidMaths as fm
+import SpatialHash as sh
+
+# Commands sent to the workers
+ATTACH = 0
+DENSITY = 1
+PRESSURE = 2
+VISCOSITY = 3
+STOP = 4
+
+
+def GetSharedLayout(numOfParticles, tableSize, floatType=np.float64):
+    """
+    Args:
+        tableSize: The number of cell keys of the spatial hash, the dense grid has its own number of keys.
+        floatType: The float type of the particle arrays.
+
+    Returns: A dictionary of every shared array by name, as (shape, dtype) pairs.
+    """
+    return {
+        "positions": ((numOfParticles, 2), floatType),
+        "predictedPositions": ((numOfParticles, 2), floatType),
+        "velocities": ((numOfParticles, 2), floatType),
+        "densities": ((numOfParticles,), floatType),
+        "previousVelocities": ((numOfParticles, 2), floatType),
+        "spatialIndecies": ((numOfParticles, 3), np.int64),
+        "spatialOffsets": ((tableSize,), np.int64),
+        "spatialEnds": ((tableSize,), np.int64),
+    }
+
+
+def AttachArrays(names, numOfParticles, tableSize, floatType):
+    """
+    Attaches to shared memory blocks by name and wraps each block in a numpy array, without copying.
+
+    Returns: A pair (blocks, arrays), both dictionaries by array name.
+    """
+    blocks = {}
+    arrays = {}
+    for arrayName, (shape, dtype) in GetSharedLayout(numOfParticles, tableSize, floatType).items():
+        blocks[arrayName] = shared_memory.SharedMemory(name=names[arrayName])
+        arrays[arrayName] = np.ndarray(shape, dtype=dtype, buffer=blocks[arrayName].buf)
+
+    return blocks, arrays
+
+
+def FindCandidates(arrays, start, end, settings):
+    """
+    Gathers neighbour candidates of particles in [start, end) from the shared spatial hash.
+    Candidates kept for later steps are narrowed down to the ones within the cell size, the search radius of the Verlet list.
+
+    Returns: A pair of arrays (particleIndecies, neighbourIndecies).
+    """
+    predictedPositions = arrays["predictedPositions"]
+    particleIndecies, neighbourIndecies = sh.FindCandidates(predictedPositions, arrays["spatialIndecies"], arrays["spatialOffsets"], arrays["spatialEnds"], settings["cellSize"], start, end, settings["gridShape"])
+
+    if not settings["keepCandidates"]:
+        return particleIndecies, neighbourIndecies
+
+    # Skip if not within search radius
+    offsetsToNeighbour = predictedPositions[neighbourIndecies] - predictedPositions[particleIndecies]
+    inRadius = np.einsum("ij,ij->i", offsetsToNeighbour, offsetsToNeighbour) < settings["cellSize"] ** 2
+
+    return particleIndecies[inRadius], neighbourIndecies[inRadius]
+
+
+def FindPairs(arrays, start, candidates, settings):
+    """
+    Finds all pairs within smoothingRadius among the neighbour candidates of the particles from start on.
+
+    Returns: A tuple (rows, neighbourIndecies, offsetsToNeighbour, distances), rows counted from start.
+    """
+    predictedPositions = arrays["predictedPositions"]
+    particleIndecies, neighbourIndecies = candidates
+
+    offsetsToNeighbour = predictedPositions[neighbourIndecies] - predictedPositions[particleIndecies]
+    distances = np.sqrt(np.einsum("ij,ij->i", offsetsToNeighbour, offsetsToNeighbour))
+    inRadius = distances < settings["smoothingRadius"]
+
+    return particleIndecies[inRadius] - start, neighbourIndecies[inRadius], offsetsToNeighbour[inRadius], distances[inRadius]
+
+
+def SumPerRow(rows, values, numOfRows):
+    """
+    Sums per pair values of shape (P, 2) into per row totals of shape (numOfRows, 2).
+    """
+    return np.stack([np.bincount(rows, weights=values[:, i], minlength=numOfRows) for i in range(2)], axis=1)
+
+
+def RunDensity(arrays, start, end, settings, pairs):
+    """
+    Updates densities of particles in [start, end).
+    """
+    rows, neighbourIndecies, offsetsToNeighbour, distances = pairs
+    influences = fm.spikyPow2.Value(settings["smoothingRadius"], distances)
+
+    arrays["densities"][start:end] = np.bincount(rows, weights=settings["particleMass"] * influences, minlength=end - start)
+
+
+def RunPressure(arrays, start, end, settings, pairs):
+    """
+    Updates velocities of particles in [start, end) by the pressure force. Reads densities of all particles.
+    """
+    rows, neighbourIndecies, offsetsToNeighbour, distances = pairs
+    densities = arrays["densities"]
+
+    # Skip if looking at self
+    notSelf = rows + start != neighbourIndecies
+    rows = rows[notSelf]
+    neighbourIndecies = neighbourIndecies[notSelf]
+    offsetsToNeighbour = offsetsToNeighbour[notSelf]
+    distances = distances[notSelf]
+
+    directionsToNeighbour = fm.GetRandomDirections(len(distances)).astype(distances.dtype, copy=False)
+    nonZero = distances > 0
+    directionsToNeighbour[nonZero] = offsetsToNeighbour[nonZero] / distances[nonZero, None]
+
+    pressures = fm.PressureFromDensity(densities, settings["targetDensity"], settings["pressureMultiplier"])
+    sharedPressures = (pressures[rows + start] + pressures[neighbourIndecies]) * 0.5 # Newton's third law of motion
+
+    magnitudes = fm.spikyPow2.Derivative(settings["smoothingRadius"], distances) * sharedPressures / densities[neighbourIndecies]
+    pressureForces = SumPerRow(rows, directionsToNeighbour * magnitudes[:, None], end - start)
+
+    ownDensities = densities[start:end]
+    aboveThreshhold = ownDensities > settings["densityThreshhold"]
+    arrays["velocities"][start:end][aboveThreshhold] += pressureForces[aboveThreshhold] / ownDensities[aboveThreshhold, None] * settings["deltaTime"]
+
+
+def RunViscosity(arrays, start, end, settings, pairs):
+    """
+    Updates velocities of particles in [start, end) by the viscosity force. Reads the velocity snapshot of all particles.
+    """
+    rows, neighbourIndecies, offsetsToNeighbour, distances = pairs
+    previousVelocities = arrays["previousVelocities"]
+
+    influences = fm.smoothPow3.Value(settings["smoothingRadius"], distances)
+    velocityDifferences = previousVelocities[neighbourIndecies] - previousVelocities[rows + start]
+    viscosityForces = SumPerRow(rows, velocityDifferences * influences[:, None], end - start)
+
+    arrays["velocities"][start:end] += viscosityForces * settings["viscosityStrength"] * settings["deltaTime"]
+
+
+def WorkerLoop(connection, workerIndex):
+    """
+    Main function of a worker process. Waits for commands, runs them on its particle range, and answers
+    once done, so the pool can wait for all workers like at a barrier.
+    Pairs found in the density phase are kept for the pressure and viscosity phases of the same step,
+    and with the Verlet list the candidates they come from are kept until the spatial hash is published again.
+    """
+    np.random.seed(workerIndex)
+    blocks = {}
+    arrays = {}
+    candidates = None
+    pairs = None
+
+    while True:
+        command, args = connection.recv()
+
+        try:
+            if command == STOP:
+                break
+
+            if command == ATTACH:
+                arrays = {}
+                for block in blocks.values():
+                    block.close()
+                blocks, arrays = AttachArrays(*args)
+
+            elif command == DENSITY:
+                start, end, settings = args
+                if settings["gatherCandidates"]:
+                    candidates = FindCandidates(arrays, start, end, settings)
+                pairs = FindPairs(arrays, start, candidates, settings)
+                if not settings["keepCandidates"]:
+                    candidates = None
+                RunDensity(arrays, start, end, settings, pairs)
+
+            elif command == PRESSURE:
+                RunPressure(arrays, *args, pairs)
+
+            elif command == VISCOSITY:
+                RunViscosity(arrays, *args, pairs)
+
+            connection.send(None)
+        except Exception:
+            connection.send(traceback.format_exc())
+
+    arrays = {}
+    for block in blocks.values():
+        block.close()
+
+
+class WorkerPool:
+
+    def __init__(self, numOfWorkers=0):
+        """
+        Starts a persistent pool of worker processes.
+
+        Args:
+            numOfWorkers: The number of worker processes, 0 uses one per core.
+        """
+        self.numOfWorkers = numOfWorkers if numOfWorkers > 0 else os.cpu_count()
+        self.connections = []
+        self.processes = []
+        self.blocks = {}
+        self.retiredBlocks = []
+        self.arrays = {}
+        self.particles = None
+        self.numOfParticles = 0
+        self.tableSize = 0
+        self.floatType = np.float64
+
+        # Workers have to share the tracker of this process, or their own trackers would unlink the blocks when they exit
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+
+        for workerIndex in range(self.numOfWorkers):
+            connection, workerConnection = mp.Pipe()
+            process = mp.Process(target=WorkerLoop, args=(workerConnection, workerIndex), daemon=True)
+            process.start()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+
+    def ShareParticles(self, particles):
+        """
+        Moves the particle arrays of the store into shared memory, so workers read and write them without pickling.
+        The store's arrays are replaced by the shared ones, holders of the store see the change.
+        """
+        self.ReleaseBlocks()
+
+        self.numOfParticles = len(particles)
+        self.tableSize = len(particles)
+        self.floatType = particles.dtype.type
+        self.CreateBlocks(GetSharedLayout(self.numOfParticles, self.tableSize, self.floatType))
+
+        for arrayName, array in particles.GetArrays().items():
+            self.arrays[arrayName][:] = array
+            setattr(particles, arrayName, self.arrays[arrayName])
+
+        self.particles = particles
+
+        self.AttachWorkers()
+
+
+    def CreateBlocks(self, layout):
+        """
+        Creates a shared memory block for every array of the layout, replacing blocks of the same name.
+        """
+        for arrayName, (shape, dtype) in layout.items():
+            if arrayName in self.blocks:
+                self.retiredBlocks.append(self.blocks[arrayName])
+
+            block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            self.blocks[arrayName] = block
+            self.arrays[arrayName] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+    def MemoryFootprint(self):
+        """
+        Returns: The number of bytes of shared memory in use, the shared particle arrays included.
+        """
+        return sum(block.size for block in self.blocks.values())
+
+
+    def AttachWorkers(self):
+        """
+        Makes every worker attach to the current shared memory blocks.
+        """
+        names = {arrayName: block.name for arrayName, block in self.blocks.items()}
+        self.Broadcast(ATTACH, lambda start, end: (names, self.numOfParticles, self.tableSize, self.floatType))
+        self.ReleaseBlocks(retiredOnly=True)
+
+
+    def PublishSpatialHash(self, spatialIndecies, spatialOffsets, spatialEnds):
+        """
+        Copies the spatial hash tables into shared memory for the workers.
+        Switching between the hashed and the dense grid changes the table size, then the key tables get new blocks.
+        """
+        if len(spatialOffsets) != self.tableSize:
+            self.tableSize = len(spatialOffsets)
+            layout = GetSharedLayout(self.numOfParticles, self.tableSize, self.floatType)
+            self.CreateBlocks({arrayName: layout[arrayName] for arrayName in ("spatialOffsets", "spatialEnds")})
+            self.AttachWorkers()
+
+        self.arrays["spatialIndecies"][:] = spatialIndecies
+        self.arrays["spatialOffsets"][:] = spatialOffsets
+        self.arrays["spatialEnds"][:] = spatialEnds
+
+
+    def RunPhase(self, command, settings):
+        """
+        Runs one phase (DENSITY, PRESSURE or VISCOSITY) on all workers, each on its own particle range,
+        and returns once every worker finished it.
+        """
+        if command == VISCOSITY:
+            self.arrays["previousVelocities"][:] = self.arrays["velocities"]
+
+        self.Broadcast(command, lambda start, end: (start, end, settings))
+
+
+    def Broadcast(self, command, GetArgs):
+        """
+        Sends a command to every worker with arguments built from its particle range, then waits for all answers.
+        """
+        bounds = np.linspace(0, self.numOfParticles, self.numOfWorkers + 1).astype(int)
+
+        for workerIndex, connection in enumerate(self.connections):
+            connection.send((command, GetArgs(bounds[workerIndex], bounds[workerIndex + 1])))
+
+        errors = [connection.recv() for connection in self.connections]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise RuntimeError("Worker failed:\n" + errors[0])
+
+
+    def ReleaseBlocks(self, retiredOnly=False):
+        """
+        Frees the shared memory blocks. Blocks still viewed by some array are closed later.
+
+        Args:
+            retiredOnly: Only frees blocks that were replaced, keeping the ones in use.
+        """
+        if not retiredOnly:
+            self.arrays = {}
+            self.retiredBlocks += self.blocks.values()
+            self.blocks = {}
+
+        stillUsed = []
+        for block in self.retiredBlocks:
+            try:
+                block.close()
+                block.unlink()
+            except BufferError:
+                stillUsed.append(block)
+            except FileNotFoundError:
+                pass
+        self.retiredBlocks = stillUsed
+
+
+    def Close(self):
+        """
+        Stops all worker processes and frees the shared memory. The particle store gets private copies of its arrays.
+        """
+        for connection in self.connections:
+            connection.send((STOP, None))
+        for process in self.processes:
+            process.join()
+
+        if self.particles is not None:
+            for arrayName, array in self.particles.GetArrays().items():
+                setattr(self.particles, arrayName, array.copy())
+            self.particles = None
+
+        self.connections = []
+        self.processes = []
+        self.ReleaseBlocks()
+
+
+def MeasureScaling(coreCounts, numOfParticles=20000, steps=20, **values):
+    """
+    Measures the parallel engine for every core count on the same scene and reports its scaling.
+    Efficiency is the speedup over one worker divided by the number of cores. One worker is always timed as the baseline,
+    also when it is not among the core counts.
+
+    Args:
+        coreCounts: The numbers of worker processes to measure.
+        numOfParticles: The number of particles, spawned in a grid.
+        steps: The number of timed steps per core count.
+        **values: Settings passed to Computing.InitializeValues, engine and numOfWorkers are set for every core count.
+
+    Returns: A list of dictionaries with cores, secondsPerStep, speedup and efficiency.
+    """
+    import Computing
+    import SimSetup
+
+    def TimeSteps(cores):
+        particles = SimSetup.SpawnParticlesInGrid(numOfParticles, values["particleSize"], 1, values["SCREEN_SIZE"][0] - values["GUI_SIZE"][0], values["SCREEN_SIZE"][1])
+        Computing.InitializeValues(**{**values, "engine": Computing.PARALLEL, "numOfWorkers": cores})
+        Computing.InitializeArrays(particles)
+
+        # First step attaches the workers
+        Computing.SimulationStep((0, 0))
+
+        startTime = time.perf_counter()
+        for step in range(steps):
+            Computing.SimulationStep((0, 0))
+        return (time.perf_counter() - startTime) / steps
+
+    try:
+        secondsPerStep = {cores: TimeSteps(cores) for cores in sorted(set(coreCounts) | {1})}
+    finally:
+        Computing.Shutdown()
+
+    results = []
+    for cores in coreCounts:
+        speedup = secondsPerStep[1] / secondsPerStep[cores]
+        results.append({"cores": cores, "secondsPerStep": secondsPerStep[cores], "speedup": speedup, "efficiency": speedup / cores})
+
+    return results
+
+
+if __name__ == "__main__":
+    settings = dict(
+        SCREEN_SIZE=(1280, 720),
+        GUI_SIZE=(350, 720),
+        gravity=0.3,
+        collisionDamping=0.5,
+        particleSize=2,
+        particleMass=1,
+        smoothingRadius=10,
+        targetDensity=5 / 100.0,
+        pressureMultiplier=500,
+        viscosityStrength=0.5,
+        densityThreshhold=0.0000001,
+        mouseInteractionStrength=20,
+        mouseInteractionRadius=50,
+    )
+    coreCounts = sorted({1, 2, 4, os.cpu_count()})
+
+    print(f"{'cores':>5} {'ms/step':>10} {'speedup':>8} {'efficiency':>10}")
+    for result in MeasureScaling(coreCounts, **settings):
+        print(f"{result['cores']:>5} {result['secondsPerStep'] * 1000:>10.2f} {result['speedup']:>8.2f} {result['efficiency']:>10.0%}")
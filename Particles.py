@@ -0,0 +1,147 @@
+import numpy as np
+
+
+class Particles:
+
+    def __init__(self, numOfParticles, dtype=np.float64):
+        """
+        Allocates the particle store: contiguous (N, 2) float arrays for positions, predicted positions
+        and velocities, and a flat (N,) float array for densities.
+
+        Args:
+            numOfParticles: The number of particles the store holds.
+            dtype: The float type of all arrays.
+        """
+        self.numOfParticles = numOfParticles
+
+        self.positions = np.zeros((numOfParticles, 2), dtype=dtype)
+        self.predictedPositions = np.zeros((numOfParticles, 2), dtype=dtype)
+        self.velocities = np.zeros((numOfParticles, 2), dtype=dtype)
+        self.densities = np.zeros(numOfParticles, dtype=dtype)
+        self.ids = None # Persistent identity of the particle in every slot, None while every particle is still in the slot it was created in
+
+
+    @classmethod
+    def FromPositions(cls, positions, dtype=np.float64):
+        """
+        Creates a particle store from a sequence of [x, y] positions. Velocities and densities start at zero.
+
+        Returns: The created particle store.
+        """
+        positions = np.asarray(positions, dtype=dtype).reshape(-1, 2)
+
+        particles = cls(len(positions), dtype)
+        particles.positions[:] = positions
+        particles.predictedPositions[:] = positions
+
+        return particles
+
+
+    @classmethod
+    def FromArrays(cls, arrays):
+        """
+        Wraps existing arrays, e.g. memory-mapped ones, in a particle store without copying them.
+
+        Args:
+            arrays: A dictionary of all particle arrays by name, as GetArrays returns it, and optionally the ids by "ids".
+
+        Returns: The created particle store.
+        """
+        particles = cls(0, arrays["positions"].dtype)
+        for arrayName in particles.GetArrays():
+            setattr(particles, arrayName, arrays[arrayName])
+        particles.ids = arrays.get("ids")
+        particles.numOfParticles = len(particles.positions)
+
+        return particles
+
+
+    def __len__(self):
+        return self.numOfParticles
+
+
+    def GetArrays(self):
+        """
+        Returns: A dictionary of all particle arrays by name.
+        """
+        return {
+            "positions": self.positions,
+            "predictedPositions": self.predictedPositions,
+            "velocities": self.velocities,
+            "densities": self.densities,
+        }
+
+
+    def SetFloatType(self, dtype):
+        """
+        Converts the arrays of the store to the given float type, replacing them, so holders of the store see the change.
+        Arrays already of that type are kept.
+        """
+        for arrayName, array in self.GetArrays().items():
+            if array.dtype != dtype:
+                setattr(self, arrayName, array.astype(dtype))
+
+
+    def Reorder(self, order):
+        """
+        Moves the particles to new slots, overwriting the arrays in place, so holders of the arrays see the change.
+        Every particle keeps its identity in ids.
+
+        Args:
+            order: The slot every particle comes from, new slot i holds the particle of slot order[i].
+        """
+        for array in self.GetArrays().values():
+            array[:] = array[order]
+        self.ids = order if self.ids is None else self.ids[order]
+
+
+    def InIdOrder(self, array, out=None):
+        """
+        Puts the rows of a per particle array in the order of the particle ids, the order particles were created in.
+
+        Args:
+            out: The array written to, by default a new one unless the particles were never reordered.
+
+        Returns: The rows in id order, the array itself when the particles were never reordered and out is not given.
+        """
+        if self.ids is None:
+            if out is None:
+                return array
+            out[:] = array
+            return out
+
+        if out is None:
+            out = np.empty_like(array)
+        out[self.ids] = array
+        return out
+
+
+    def FollowReorder(self, array, previousIds):
+        """
+        Moves the rows of a per particle array along with the particles, when the store was reordered since it was taken.
+
+        Args:
+            previousIds: The ids of the store when the array was taken.
+
+        Returns: The rows in the current slots of their particles, the array itself when the store was not reordered.
+        """
+        if self.ids is previousIds:
+            return array
+        if previousIds is None:
+            return array[self.ids]
+
+        previousSlots = np.empty_like(previousIds)
+        previousSlots[previousIds] = np.arange(len(previousIds))
+        return array[previousSlots[self.ids]]
+
+
+    @property
+    def dtype(self):
+        return self.positions.dtype
+
+
+    def MemoryFootprint(self):
+        """
+        Returns: The number of bytes held by the particle arrays.
+        """
+        return sum(array.nbytes for array in self.GetArrays().values())
@@ -0,0 +1,389 @@
+import os
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from Scheduler import FixedStepScheduler, InterpolateParticles
+
+# Commands sent to the physics process
+RESET = 0
+SETTINGS = 1
+MOUSE = 2
+PAUSE = 3
+STOP = 4
+CHECKPOINT = 5
+RESTORE = 6
+RECORD = 7
+
+# Slots of the frame header
+SEQUENCE = 0 # Number of frames published, the front frame is the newest
+FRONT = 1 # Index of the front frame, the other one is written next
+FRAME_SEQUENCES = 2 # Two slots, one per frame, odd while the frame is being written
+HEADER_SIZE = 4
+
+
+def GetFrameArrays(buffer, numOfParticles):
+    """
+    Wraps a shared memory buffer in the header and the two frames of positions and velocities, without copying.
+
+    Returns: A pair (header, frames), header an int64 array of HEADER_SIZE slots,
+             frames a (2, 2, N, 2) float64 array indexed [frame, positions or velocities].
+    """
+    header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=buffer)
+    frames = np.ndarray((2, 2, numOfParticles, 2), dtype=np.float64, buffer=buffer, offset=header.nbytes)
+    return header, frames
+
+
+def GetFrameBytes(numOfParticles):
+    return HEADER_SIZE * 8 + 2 * 2 * numOfParticles * 2 * 8
+
+
+def PublishFrame(header, frames, particles):
+    """
+    Writes the positions and velocities of the particle store into the back frame, then makes it the front frame.
+    Rows are in the order of the particle ids, so the window sees every particle in the same row while they are reordered in memory.
+    The frame sequence is odd while writing, so readers can tell a torn frame.
+    """
+    back = 1 - header[FRONT]
+
+    header[FRAME_SEQUENCES + back] += 1
+    particles.InIdOrder(particles.positions, frames[back, 0])
+    particles.InIdOrder(particles.velocities, frames[back, 1])
+    header[FRAME_SEQUENCES + back] += 1
+
+    header[FRONT] = back
+    header[SEQUENCE] += 1
+
+
+def PhysicsLoop(connection, timeScale):
+    """
+    Main function of the physics process. Steps the simulation of Computing in real time and publishes every finished step
+    as a frame, handling the commands that arrived in between.
+    While paused or before the first RESET it only waits for commands.
+    CHECKPOINT is answered once the file is written, with the traceback of a failed write or None.
+    An error it stops with is sent back as (STOP, traceback).
+    Steps advance timeScale simulated time per second, one step between checks for commands, falling behind instead of
+    catching up with a burst of steps when physics is slower.
+    """
+    import Computing
+    import Checkpoint
+    import Trajectory
+
+    block = None
+    header = frames = None
+    mousePos = (0, 0)
+    paused = True
+    scheduler = FixedStepScheduler(timeScale=timeScale, timeBudget=0, deltaTime=Computing.deltaTime)
+    lastTime = time.perf_counter()
+
+    def Step():
+        stepTime = Computing.SimulationStep(mousePos)
+        PublishFrame(header, frames, Computing.GetParticles())
+        return stepTime
+
+    try:
+        while True:
+            waiting = paused or block is None
+            # Until the simulated time not stepped yet makes up a step
+            timeout = None if waiting else max(0.0, (scheduler.deltaTime - scheduler.accumulator) / timeScale)
+
+            # Commands are handled as they come while waiting for the next step
+            if connection.poll(timeout):
+                command, args = connection.recv()
+
+                if command == STOP:
+                    break
+
+                if command in (RESET, RESTORE):
+                    blockName, numOfParticles, source = args
+                    header = frames = None
+                    if block is not None:
+                        block.close()
+                    block = shared_memory.SharedMemory(name=blockName)
+                    header, frames = GetFrameArrays(block.buf, numOfParticles)
+
+                    if command == RESET:
+                        values, particles = source
+                        Computing.InitializeValues(**values)
+                        Computing.InitializeArrays(particles)
+                    else:
+                        Checkpoint.LoadCheckpoint(source)
+                    scheduler.Reset()
+
+                elif command == CHECKPOINT:
+                    # A failed write leaves the simulation running, the window reports it
+                    try:
+                        Checkpoint.SaveCheckpoint(args)
+                        connection.send((CHECKPOINT, None))
+                    except Exception:
+                        connection.send((CHECKPOINT, traceback.format_exc()))
+
+                elif command == RECORD:
+                    if args is None:
+                        Computing.SetTrajectoryWriter(None)
+                    else:
+                        path, options = args
+                        Trajectory.Record(path, **options)
+
+                elif command == SETTINGS:
+                    Computing.UpdateSettings(**args)
+
+                elif command == MOUSE:
+                    mousePos = args
+
+                elif command == PAUSE:
+                    paused = args
+
+                # Time spent paused or waiting for the first reset is not stepped
+                if paused or block is None:
+                    lastTime = time.perf_counter()
+                continue
+
+            now = time.perf_counter()
+            scheduler.Advance(Step, now - lastTime)
+            lastTime = now
+
+    except (EOFError, BrokenPipeError):
+        # The window process is gone
+        pass
+    except Exception:
+        connection.send((STOP, traceback.format_exc()))
+    finally:
+        header = frames = None
+        if block is not None:
+            block.close()
+        Computing.Shutdown()
+
+
+class PhysicsProcess:
+
+    def __init__(self, timeScale=120):
+        """
+        Starts the physics process. Finished steps are published into a double-buffered shared memory block
+        and settings changes are sent as commands through a pipe, so neither side ever waits for the other.
+
+        Args:
+            timeScale: Simulated time per real second. 120 is one unit step per frame at 120 frames per second.
+        """
+        self.block = None
+        self.header = None
+        self.frames = None
+        self.numOfParticles = 0
+        self.sequence = -1 # Sequence of the last frame read
+        self.previousPositions = None # Positions of the frame read before the last one
+        self.frameTime = 0 # Real time the last frame was read
+        self.frameInterval = 0 # Real time between the last two frames read
+        self.interpolated = None
+        self.paused = True
+        self.mousePos = None
+
+        # The process has to share the tracker of this one, or its own tracker would unlink the block when it exits
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+
+        # Not a daemon, the PARALLEL engine starts worker processes of its own
+        self.connection, processConnection = mp.Pipe()
+        self.process = mp.Process(target=PhysicsLoop, args=(processConnection, timeScale))
+        self.process.start()
+
+
+    def Reset(self, particles, values):
+        """
+        Restarts the simulation with the particles of the store and the values of Computing.InitializeValues.
+        Every reset gets a new block sized for its particles, the store's arrays are the first frame.
+        """
+        self.CreateBlock(particles)
+        self.Send(RESET, (self.block.name, self.numOfParticles, (values, particles)))
+
+
+    def Restore(self, particles, path):
+        """
+        Restarts the simulation from a checkpoint file, which the physics process restores itself, random number generators included.
+
+        Args:
+            particles: The particle store of the checkpoint, e.g. of Checkpoint.ReadCheckpoint, in id order. Its arrays are the first frame.
+        """
+        self.CreateBlock(particles)
+        self.Send(RESTORE, (self.block.name, self.numOfParticles, path))
+
+
+    def SaveCheckpoint(self, path):
+        """
+        Has the physics process write its state to a checkpoint file, after the step it is at.
+        Waits until the file is written, so a restore sent after it reads the new file, and raises the error of a failed write.
+        """
+        self.Send(CHECKPOINT, path)
+        error = self.WaitForReply(CHECKPOINT)
+        if error is not None:
+            raise RuntimeError("Checkpoint failed in the physics process:\n" + error)
+
+
+    def Record(self, path, **options):
+        """
+        Has the physics process record its steps into a trajectory file, see Trajectory.Record. None as path stops recording.
+        A reset or restore stops recording too.
+        """
+        self.Send(RECORD, None if path is None else (path, options))
+
+
+    def CreateBlock(self, particles):
+        """
+        Replaces the frame block with a new one sized for the particles of the store, holding them as the first frame.
+        """
+        self.ReleaseBlock()
+
+        self.numOfParticles = len(particles)
+        self.block = shared_memory.SharedMemory(create=True, size=GetFrameBytes(self.numOfParticles))
+        self.header, self.frames = GetFrameArrays(self.block.buf, self.numOfParticles)
+        self.header[:] = 0
+        self.frames[0, 0] = particles.positions
+        self.frames[0, 1] = particles.velocities
+        self.sequence = 0
+        self.previousPositions = None
+
+
+    def UpdateSettings(self, **values):
+        """
+        Sends changed values of Computing.UpdateSettings, applied before the next step.
+        """
+        self.Send(SETTINGS, values)
+
+
+    def SetMousePosition(self, mousePos):
+        """
+        Sends the mouse position used by the next steps, only when it moved.
+        """
+        if mousePos != self.mousePos:
+            self.mousePos = tuple(mousePos)
+            self.Send(MOUSE, self.mousePos)
+
+
+    def SetPaused(self, paused):
+        """
+        Pauses or resumes stepping, only sent when it changes, so it can be called every frame.
+        """
+        if paused != self.paused:
+            self.paused = paused
+            self.Send(PAUSE, paused)
+
+
+    def Send(self, command, args):
+        self.CheckErrors()
+        self.connection.send((command, args))
+
+
+    def CheckErrors(self):
+        """
+        Raises the error the physics process stopped with, if any.
+        """
+        if self.connection.poll():
+            self.Receive()
+
+
+    def WaitForReply(self, command):
+        """
+        Waits for the physics process to answer a command.
+
+        Returns: The answer sent with it.
+        """
+        while True:
+            replyCommand, reply = self.Receive()
+            if replyCommand == command:
+                return reply
+
+
+    def Receive(self):
+        """
+        Returns: The next message of the physics process as a pair (command, reply), raising the error it stopped with instead.
+        """
+        try:
+            command, reply = self.connection.recv()
+        except EOFError:
+            raise RuntimeError("Physics process stopped")
+
+        if command == STOP:
+            raise RuntimeError("Physics process failed:\n" + reply)
+        return command, reply
+
+
+    def ReadFrame(self, particles, retries=8):
+        """
+        Copies the newest complete frame into the positions and velocities of the particle store.
+        Never waits for the physics process, a frame written over while copying is read again.
+        The positions it replaces are kept for Interpolate.
+
+        Returns: True when a new frame was copied, False when the store already holds the newest one.
+        """
+        self.CheckErrors()
+        if self.header is None:
+            return False
+
+        for attempt in range(retries):
+            sequence = int(self.header[SEQUENCE])
+            if sequence == self.sequence:
+                return False
+
+            front = int(self.header[FRONT])
+            frameSequence = int(self.header[FRAME_SEQUENCES + front])
+            if frameSequence % 2 == 1: continue
+
+            if self.previousPositions is None or self.previousPositions.shape != particles.positions.shape:
+                self.previousPositions = np.empty_like(particles.positions)
+            self.previousPositions[:] = particles.positions
+
+            np.copyto(particles.positions, self.frames[front, 0])
+            np.copyto(particles.velocities, self.frames[front, 1])
+
+            if self.header[FRAME_SEQUENCES + front] == frameSequence:
+                now = time.perf_counter()
+                self.frameInterval = now - self.frameTime
+                self.frameTime = now
+                self.sequence = sequence
+                return True
+
+            np.copyto(particles.positions, self.previousPositions)
+
+        return False
+
+
+    def Interpolate(self, particles):
+        """
+        Returns: A particle store to draw, with positions moving from the frame read before the last one to the last one
+                 over the time between them, one frame behind and smooth while physics publishes slower than the display.
+        """
+        alpha = (time.perf_counter() - self.frameTime) / self.frameInterval if self.frameInterval > 0 else 1.0
+
+        result = InterpolateParticles(self.previousPositions, particles, alpha, self.interpolated)
+        if result is not particles:
+            self.interpolated = result
+        return result
+
+
+    def ReleaseBlock(self):
+        self.header = None
+        self.frames = None
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+    def Close(self):
+        """
+        Stops the physics process and frees the shared memory.
+        """
+        try:
+            self.connection.send((STOP, None))
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.connection.close()
+        self.ReleaseBlock()
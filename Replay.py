@@ -0,0 +1,105 @@
+import math
+import numpy as np
+
+from Particles import Particles
+from Trajectory import TrajectoryReader
+
+
+class Playback:
+
+    def __init__(self, path, framesPerSecond=60):
+        """
+        Plays a recorded trajectory forwards or backwards at any speed, with random access to every frame.
+        Only the chunk of the frame shown is read, the file is never loaded as a whole.
+
+        Args:
+            framesPerSecond: Recorded frames shown per real second at speed 1.
+        """
+        self.reader = TrajectoryReader(path)
+        self.framesPerSecond = framesPerSecond
+        self.position = 0.0 # Frame shown, fractional while between frames
+        self.speed = 1.0 # Multiple of framesPerSecond, negative plays backwards
+        self.playing = False
+        self.particles = Particles(self.reader.numOfParticles, np.float32)
+        self.shownFrame = -1 # Frame held by the particle store
+
+
+    @property
+    def numOfFrames(self):
+        # Grows while the trajectory is still being recorded
+        return len(self.reader)
+
+
+    @property
+    def frameIndex(self):
+        return min(int(math.floor(self.position)), max(0, self.numOfFrames - 1))
+
+
+    def Advance(self, elapsed):
+        """
+        Moves the playback by the real seconds since the last frame, stopping at either end.
+        """
+        if not self.playing: return
+
+        lastFrame = max(0, self.numOfFrames - 1)
+        self.position += self.speed * self.framesPerSecond * elapsed
+
+        if self.position <= 0 or self.position >= lastFrame:
+            self.position = min(max(self.position, 0.0), float(lastFrame))
+            self.playing = False
+
+
+    def Seek(self, frameIndex):
+        """
+        Jumps to a frame, clamped to the recorded ones.
+        """
+        self.position = float(min(max(frameIndex, 0), max(0, self.numOfFrames - 1)))
+
+
+    def Step(self, frames):
+        """
+        Pauses and moves the given number of frames, negative ones backwards.
+        """
+        self.playing = False
+        self.Seek(self.frameIndex + frames)
+
+
+    def TogglePlaying(self):
+        """
+        Starts or pauses playing, from the other end when playing on would stop right away.
+        """
+        if not self.playing:
+            lastFrame = max(0, self.numOfFrames - 1)
+            if self.speed > 0 and self.frameIndex >= lastFrame:
+                self.Seek(0)
+            elif self.speed < 0 and self.frameIndex <= 0:
+                self.Seek(lastFrame)
+        self.playing = not self.playing
+
+
+    def GetParticles(self):
+        """
+        Returns: The particle store holding the positions and velocities of the frame shown, None before the first frame is recorded.
+        """
+        if self.numOfFrames == 0:
+            return None
+
+        frameIndex = self.frameIndex
+        if frameIndex != self.shownFrame:
+            positions, velocities = self.reader.ReadFrame(frameIndex)
+            np.copyto(self.particles.positions, positions)
+            np.copyto(self.particles.velocities, velocities)
+            self.shownFrame = frameIndex
+
+        return self.particles
+
+
+    def GetFrameInfo(self):
+        """
+        Returns: A pair (step, simulatedTime) of the frame shown.
+        """
+        return self.reader.GetFrameInfo(self.frameIndex)
+
+
+    def Close(self):
+        self.reader.Close()
@@ -0,0 +1,132 @@
+import time
+import numpy as np
+
+from Particles import Particles
+
+# Longest frame the real time scheduler catches up on, a longer hitch (e.g. a dragged window) is dropped
+MAX_FRAME_TIME = 0.25
+
+
+def InterpolateParticles(previousPositions, particles, alpha, interpolated=None):
+    """
+    Blends the positions of the particle store with the positions of the step before.
+
+    Args:
+        alpha: 0 gives the previous positions, 1 the current ones.
+        interpolated: A particle store reused for the result, replaced when its size does not match.
+
+    Returns: A particle store with the blended positions and the current velocities,
+             the particle store itself when there is nothing to blend.
+    """
+    if previousPositions is None or alpha >= 1 or len(previousPositions) != len(particles):
+        return particles
+
+    if interpolated is None or len(interpolated) != len(particles):
+        interpolated = Particles(len(particles))
+
+    np.subtract(particles.positions, previousPositions, out=interpolated.positions)
+    interpolated.positions *= alpha
+    interpolated.positions += previousPositions
+    interpolated.velocities = particles.velocities
+
+    return interpolated
+
+
+class FixedStepScheduler:
+
+    def __init__(self, substeps=0, timeScale=120, timeBudget=None, deltaTime=1):
+        """
+        Decides how many physics steps run per displayed frame, so the physics rate no longer follows the frame rate.
+        Either a fixed number of steps per frame, or as many steps as the real time since the last frame asks for,
+        with drawn positions interpolated between the last two steps.
+
+        Args:
+            substeps: Steps per displayed frame. substeps * deltaTime = 1 keeps the speed of one unit step per frame.
+                      0 steps in real time instead.
+            timeScale: Simulated time per real second when stepping in real time. 120 is one unit step per frame at 120 frames per second.
+            timeBudget: Most seconds spent stepping per frame. The simulated time that did not fit is dropped,
+                        so physics slower than the display slows the fluid down instead of spiralling. None has no budget.
+            deltaTime: Simulated time of a step until the first step tells otherwise.
+        """
+        self.substeps = substeps
+        self.timeScale = timeScale
+        self.timeBudget = timeBudget
+        self.deltaTime = deltaTime
+        self.accumulator = 0.0 # Simulated time not stepped yet
+        self.previousPositions = None
+        self.interpolated = None
+
+
+    def Advance(self, Step, elapsed, particles=None):
+        """
+        Runs the steps of one displayed frame.
+
+        Args:
+            Step: Runs one physics step and returns the simulated time it advanced.
+            elapsed: Real seconds since the last frame.
+            particles: The particle store the steps move, its positions before the last step are kept for interpolation,
+                       and follow the particles when the step reorders them in memory.
+
+        Returns: The number of steps run.
+        """
+        start = time.perf_counter()
+        if self.substeps == 0:
+            self.accumulator += min(elapsed, MAX_FRAME_TIME) * self.timeScale
+
+        steps = 0
+        while self.HasStepLeft(steps):
+            if particles is not None:
+                if self.previousPositions is None or self.previousPositions.shape != particles.positions.shape:
+                    self.previousPositions = np.empty_like(particles.positions)
+                self.previousPositions[:] = particles.positions
+                ids = particles.ids
+
+            self.deltaTime = Step()
+            if particles is not None:
+                self.previousPositions = particles.FollowReorder(self.previousPositions, ids)
+            steps += 1
+            if self.substeps == 0:
+                self.accumulator -= self.deltaTime
+
+            if self.timeBudget is not None and time.perf_counter() - start > self.timeBudget:
+                self.accumulator = min(self.accumulator, self.deltaTime)
+                break
+
+        return steps
+
+
+    def HasStepLeft(self, steps):
+        """
+        Returns: Whether another step belongs to the current frame, after the given number of steps.
+        """
+        if self.substeps > 0:
+            return steps < self.substeps
+        return self.accumulator >= self.deltaTime
+
+
+    @property
+    def alpha(self):
+        """
+        How far the display is between the last two steps, 1 when stepping a fixed number of steps per frame.
+        """
+        if self.substeps > 0 or self.deltaTime <= 0:
+            return 1.0
+        return min(1.0, self.accumulator / self.deltaTime)
+
+
+    def Interpolate(self, particles):
+        """
+        Returns: A particle store to draw, with positions interpolated between the last two steps.
+        """
+        result = InterpolateParticles(self.previousPositions, particles, self.alpha, self.interpolated)
+        if result is not particles:
+            self.interpolated = result
+        return result
+
+
+    def Reset(self):
+        """
+        Forgets the previous positions and the simulated time not stepped yet, e.g. after new particles spawned.
+        """
+        self.accumulator = 0.0
+        self.previousPositions = None
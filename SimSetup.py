@@ -1,6 +1,11 @@
 import math
 import numpy as np
-import random
+
+from Particles import Particles
+
+# Start options
+GRID = 0
+RANDOM = 1
 
 
 def SpawnParticlesInGrid(particleNumber, particleSize, particleSpacing, SCREEN_WIDTH, SCREEN_HEIGHT):
@@ -14,22 +19,20 @@ def SpawnParticlesInGrid(particleNumber, particleSize, particleSpacing, SCREEN_W
         SCREEN_WIDTH: The width of the screen.
         SCREEN_HEIGHT: The height of the screen.
 
-    Returns: An array of particle positions.
+    Returns: A particle store with the spawned positions.
     """
-
-    positions = np.zeros(particleNumber, dtype=object)
+    particles = Particles(particleNumber)
 
     particles_per_row = int(math.sqrt(particleNumber))  
     particles_per_col = (particleNumber - 1) // particles_per_row + 1
     spacing = particleSpacing + particleSize
 
-    for i in range(particleNumber):
-        x = SCREEN_WIDTH // 2 + (i % particles_per_row - particles_per_row // 2) * spacing
-        y = SCREEN_HEIGHT // 2 + (int(i / particles_per_row) - particles_per_col // 2) * spacing
-
-        positions[i] = np.array([x, y], dtype=float)
+    i = np.arange(particleNumber)
+    particles.positions[:, 0] = SCREEN_WIDTH // 2 + (i % particles_per_row - particles_per_row // 2) * spacing
+    particles.positions[:, 1] = SCREEN_HEIGHT // 2 + (i // particles_per_row - particles_per_col // 2) * spacing
+    particles.predictedPositions[:] = particles.positions
 
-    return positions
+    return particles
 
 
 def SpawnParticlesRandomly(particleNumber, particleSize, SCREEN_WIDTH, SCREEN_HEIGHT):
@@ -42,14 +45,35 @@ def SpawnParticlesRandomly(particleNumber, particleSize, SCREEN_WIDTH, SCREEN_HE
         SCREEN_WIDTH: The width of the screen.
         SCREEN_HEIGHT: The height of the screen.
 
-    Returns: An array of particle positions.
+    Returns: A particle store with the spawned positions.
     """
-    positions = np.zeros(particleNumber, dtype=object)
+    particles = Particles(particleNumber)
 
-    for i in range(particleNumber):
-        x = random.randint(0 + particleSize, SCREEN_WIDTH - particleSize)
-        y = random.randint(0 + particleSize, SCREEN_HEIGHT - particleSize)
+    # Whole pixel coordinates, both bounds inclusive
+    particles.positions[:, 0] = np.random.randint(0 + particleSize, SCREEN_WIDTH - particleSize + 1, particleNumber)
+    particles.positions[:, 1] = np.random.randint(0 + particleSize, SCREEN_HEIGHT - particleSize + 1, particleNumber)
+    particles.predictedPositions[:] = particles.positions
+
+    return particles
+
+
+def SpawnParticles(option, particleNumber, particleSize, particleSpacing, SCREEN_WIDTH, SCREEN_HEIGHT):
+    """
+    Spawns particles with the given start option.
 
-        positions[i] = np.array([x, y], dtype=int)
+    Args:
+        option: The start option, GRID or RANDOM.
+        particleNumber: The number of particles to spawn.
+        particleSize: The size of each particle.
+        particleSpacing: The spacing between particles, only used by GRID.
+        SCREEN_WIDTH: The width of the screen.
+        SCREEN_HEIGHT: The height of the screen.
+
+    Returns: A particle store with the spawned positions.
+    """
+    if option == GRID:
+        return SpawnParticlesInGrid(particleNumber, particleSize, particleSpacing, SCREEN_WIDTH, SCREEN_HEIGHT)
+    elif option == RANDOM:
+        return SpawnParticlesRandomly(particleNumber, particleSize, SCREEN_WIDTH, SCREEN_HEIGHT)
 
-    return positions
\ No newline at end of file
+    raise ValueError(f"Unknown start option {option}")
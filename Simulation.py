@@ -1,31 +1,35 @@
+import os
+import argparse
 import pygame
 import numpy as np
 
+import Rendering as rd
 from Rendering import Rendering
 from Gui import Gui
 import Computing
 import SimSetup
-
-# Pygame init
-pygame.init()
+import Instrumentation
+import Checkpoint
+import Trajectory
+from Particles import Particles
+from PhysicsProcess import PhysicsProcess
+from Replay import Playback
+from Scheduler import FixedStepScheduler
+
+# Window
 SCREEN_WIDTH, SCREEN_HEIGHT = 1280, 720 
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-pygame.display.set_caption("Python fluid simulation")
-clock = pygame.time.Clock()
-pygame.mouse.set_visible(True)
 framerate = 120
 
 screenSize = (SCREEN_WIDTH, SCREEN_HEIGHT)
 guiSize = (350, SCREEN_HEIGHT)
-gui = Gui(screenSize, guiSize)
 
 SIM_AREA_WIDTH = SCREEN_WIDTH - guiSize[0]
 
-render = Rendering(screen, SIM_AREA_WIDTH, SCREEN_HEIGHT)
-
-# Start options
-GRID = 0
-RANDOM = 1
+# Created by InitializeWindow, importing the module opens no window
+screen = None
+clock = None
+gui = None
+render = None
 
 # Colors
 wallColor = (0,0,0)
@@ -34,6 +38,11 @@ backgroundColorLight = (210, 210, 210)
 backgroundColorDark = (10, 10, 14)
 brushOutlineColor = (0,0,0)
 menuBackgroundColor = backgroundColorLight
+useVelocityColors = True # Colors particles by speed, V toggles
+velocityColormap = "water" # One of Rendering.COLORMAPS, C cycles through them
+velocitySpeedRange = (0, 12.75) # Speeds mapped to the first and last color, None scales to the fastest particle
+splatMode = None # One of Rendering.SPLAT_MODES writes particles straight into the screen pixels, for large particle counts. S cycles,
+                 # None blits sprites below Rendering.SPLAT_CROSSOVER particles and splats in the solid or speed mode from there on
 
 # Editor settings
 particleSize = 8
@@ -51,12 +60,52 @@ viscosityStrength = 0.5
 mouseInput = 0 # 1 - pushing appart, -1 pulling in
 mouseInteractionStrength = 20 
 mouseInteractionRadius = 50
+engine = Computing.NUMBA # Falls back to Computing.VECTORIZED without Numba, Computing.SCALAR for the per particle reference loops
+useVerletList = False # Reuse neighbour candidates until a particle moved more than half the skin
+verletSkin = 25
+floatType = np.float64 # Float type of the physics arrays, np.float32 halves their memory traffic, --float32
+reorderInterval = 0 # Physics steps between moves of the particles in memory into the Morton order of their cells, 0 never moves them, --reorder-every
+deltaTime = 1 # Simulated time of one physics step, the other settings were tuned for 1
+useAdaptiveTimeStep = False # Chooses the step every step, the largest the CFL condition and force limit allow, deltaTime is the first one. A toggles
+substeps = 0 # Physics steps per displayed frame in the window loop, 0 steps in real time. The physics process always steps in real time
+timeScale = framerate # Simulated time per real second in real time, one unit step per frame at the frame rate the settings were tuned at
+physicsTimeBudget = None # Most seconds of a frame spent on physics steps in the window loop, the rest of the simulated time is dropped. None has no limit
+interpolatePositions = True # Draws positions between the last two steps when physics runs slower than the display
+usePhysicsProcess = True # Steps physics in its own process, so a slow step never stalls the window. False steps it in the window loop, --sync-physics
 
 #Debug
 densityThreshhold = 0.0000001
+tracePath = "trace.json" # Chrome trace written when tracing with the T key
+traceFrames = 120 # Frames per trace, 0 traces until T is pressed again
+profilePath = None # Collapsed stacks of the sampling profiler, written next to the trace when set
+checkpointPath = "checkpoint.fluid" # Checkpoint written with F5 and restored with F9
+trajectoryPath = "trajectory.fluidtraj" # Trajectory recorded while R is toggled on, overwritten by every recording
+recordEvery = 1 # Physics steps per recorded frame
+recordQuantized = False # Records int16 positions and velocities instead of float32
+recordCompressed = False # Compresses every chunk of recorded frames
+recording = False # Whether physics steps are being recorded, a reset or restore ends the recording
+
+# Init particle store
+particles = None
+physics = None # PhysicsProcess while usePhysicsProcess
+scheduler = None # FixedStepScheduler of the window loop without the physics process
+
+
+def InitializeWindow():
+    """
+    Initializes pygame and opens the window with its GUI. Not done on import, the physics process and the worker processes
+    of the PARALLEL engine import this module too when started with spawn, and would open windows of their own.
+    """
+    global screen, clock, gui, render
+
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+    pygame.display.set_caption("Python fluid simulation")
+    clock = pygame.time.Clock()
+    pygame.mouse.set_visible(True)
 
-# Init particle arrays1
-positions = []
+    gui = Gui(screenSize, guiSize)
+    render = Rendering(screen, SIM_AREA_WIDTH, SCREEN_HEIGHT)
 
 
 def Start(option):
@@ -64,12 +113,12 @@ def Start(option):
     Runs once at the start to initialize the simulation.
 
     Args:
-        option: The start option, e.g., GRID or RANDOM.
+        option: The start option, e.g., SimSetup.GRID or SimSetup.RANDOM.
     """
     SpawnParticles(option)
     SetupGui()
 
-    Computing.InitializeValues(
+    InitializePhysics(
         SCREEN_SIZE=(screenSize),
         GUI_SIZE=guiSize,
         gravity=gravity,
@@ -82,10 +131,39 @@ def Start(option):
         viscosityStrength=viscosityStrength,
         densityThreshhold=densityThreshhold,
         mouseInteractionStrength=mouseInteractionStrength,
-        mouseInteractionRadius=mouseInteractionRadius
+        mouseInteractionRadius=mouseInteractionRadius,
+        engine=engine,
+        useVerletList=useVerletList,
+        verletSkin=verletSkin,
+        floatType=floatType,
+        reorderInterval=reorderInterval,
+        deltaTime=deltaTime,
+        useAdaptiveTimeStep=useAdaptiveTimeStep
         )
-    
-    Computing.InitializeArrays(positions)
+
+
+def InitializePhysics(**values):
+    """
+    Initializes the computing module with the given values and the particle store, in the physics process when there is one.
+    """
+    StopRecording()
+
+    if physics is not None:
+        physics.Reset(particles, values)
+    else:
+        Computing.InitializeValues(**values)
+        Computing.InitializeArrays(particles)
+        scheduler.Reset()
+
+
+def SendSettings(**values):
+    """
+    Updates settings of the computing module, in the physics process when there is one.
+    """
+    if physics is not None:
+        physics.UpdateSettings(**values)
+    else:
+        Computing.UpdateSettings(**values)
 
 
 def SpawnParticles(option):
@@ -93,13 +171,10 @@ def SpawnParticles(option):
     Spawns particles in the simulation based on the given option.
 
     Args: 
-        option: The spawning option, e.g., GRID or RANDOM.
+        option: The spawning option, e.g., SimSetup.GRID or SimSetup.RANDOM.
     """
-    global positions
-    if option == GRID:
-        positions = SimSetup.SpawnParticlesInGrid(numOfParticles, particleSize, particleSpacing, SIM_AREA_WIDTH, SCREEN_HEIGHT)
-    elif option == RANDOM:
-        positions = SimSetup.SpawnParticlesRandomly(numOfParticles, particleSize, SIM_AREA_WIDTH, SCREEN_HEIGHT)
+    global particles
+    particles = SimSetup.SpawnParticles(option, numOfParticles, particleSize, particleSpacing, SIM_AREA_WIDTH, SCREEN_HEIGHT)
 
 
 def SetupGui():
@@ -126,31 +201,114 @@ def SetupGui():
 def Update(paused):
     """
     Runs every iteration to update the simulation state.
+    With the physics process, the newest finished step is drawn and the window never waits for physics.
+    Otherwise the scheduler runs the physics steps of the frame in the window loop.
+    While tracing, every part of the frame is added to the trace as a span.
     """
-    screen.fill(backgroundColorDark)
-    #render.DrawAllParticlesWithVelColors(positions, velocities, waterColor, particleSize)
-    render.DrawAllParticles(positions, waterColor, particleSize)
+    recorder = Computing.recorder
+
+    with recorder.Span("Frame"):
+        if physics is not None:
+            with recorder.Span("ReadFrame"):
+                physics.ReadFrame(particles)
+            physics.SetPaused(paused)
+
+        if not paused:
+            mousePos = pygame.mouse.get_pos()
+            if physics is not None:
+                physics.SetMousePosition(mousePos)
+            else:
+                with recorder.Span("SimulationStep"):
+                    scheduler.Advance(lambda: Computing.SimulationStep(mousePos), clock.get_time() / 1000, particles)
+            #Debug()
+
+        with recorder.Span("DrawAllParticles"):
+            screen.fill(backgroundColorDark)
+            drawnParticles = particles
+            if interpolatePositions:
+                drawnParticles = (physics or scheduler).Interpolate(particles)
+
+            DrawParticles(drawnParticles)
+
+        if not paused and mouseInput != 0:
+            render.BrushRendering(backgroundColorLight, mousePos, mouseInteractionRadius)
+        
+        with recorder.Span("gui.Render"):
+            gui.Render(screen, framerate)
 
-    if not paused:
-        mousePos = pygame.mouse.get_pos()
-        Computing.SimulationStep(mousePos)
-        #Debug()
+        with recorder.Span("display.flip"):
+            pygame.display.flip()
+        with recorder.Span("clock.tick"):
+            clock.tick(framerate)
 
-        if mouseInput != 0:
-            render.BrushRendering(backgroundColorLight, mousePos, mouseInteractionRadius)
-    
-    gui.Render(screen, framerate)
+    recorder.EndFrame()
+
+
+def DrawParticles(drawnParticles):
+    """
+    Draws the particles of the store with the current coloring, splatted, colored by speed or in the water color.
+    """
+    mode = splatMode
+    if mode is None and len(drawnParticles) >= rd.SPLAT_CROSSOVER:
+        mode = "speed" if useVelocityColors else "solid"
 
-    pygame.display.flip()
-    clock.tick(framerate)
+    if mode is not None:
+        render.DrawAllParticlesSplatted(drawnParticles, waterColor, particleSize, mode, velocityColormap, velocitySpeedRange)
+    elif useVelocityColors:
+        render.DrawAllParticlesWithVelColors(drawnParticles, waterColor, particleSize, velocityColormap, velocitySpeedRange)
+    else:
+        render.DrawAllParticles(drawnParticles, waterColor, particleSize)
+
+
+def HandleViewKeys(event):
+    """
+    Handles the keys changing how particles are drawn: V toggles velocity colors, C cycles the colormaps, S the splat modes.
+    Splatting costs about the same at any particle count, so S tells from how many particles it pays off.
+
+    Returns: True when the key was one of them.
+    """
+    global useVelocityColors, velocityColormap, splatMode
+
+    if event.key == pygame.K_v:
+        useVelocityColors = not useVelocityColors
+    elif event.key == pygame.K_c:
+        # Next colormap
+        colormaps = list(rd.COLORMAPS)
+        velocityColormap = colormaps[(colormaps.index(velocityColormap) + 1) % len(colormaps)]
+    elif event.key == pygame.K_s:
+        # Next splat mode, then back to sprites
+        splatModes = [None] + rd.SPLAT_MODES
+        splatMode = splatModes[(splatModes.index(splatMode) + 1) % len(splatModes)]
+        if splatMode is None:
+            print(f"Drawing sprites, splatting from {rd.SPLAT_CROSSOVER} particles on")
+        else:
+            print(f"Splatting in the {splatMode} mode, faster than sprites only from about {rd.SPLAT_CROSSOVER} particles")
+    else:
+        return False
+    return True
+
+
+def ToggleTrace():
+    """
+    Starts a trace of the next traceFrames frames, or stops and writes the running one.
+    """
+    tracer = Computing.recorder.tracer
+
+    if tracer is not None:
+        tracer.Stop()
+        print(f"Trace written to {tracer.path}")
+        return
+
+    Instrumentation.Tracer(tracePath, traceFrames, profilePath).Start(Computing.recorder)
+    print(f"Tracing {traceFrames or 'all'} frames to {tracePath}")
 
 
 def UpdatePositions():
     """
-    Updates the positions of particles from the computing module.
+    Updates the particle store from the computing module.
     """
-    global positions
-    positions = Computing.GetPositions()
+    global particles
+    particles = Computing.GetParticles()
 
 
 def UpdateSettings():
@@ -164,7 +322,7 @@ def UpdateSettings():
     if numOfParticles != values[0] or particleSpacing != values[2]:
         numOfParticles = values[0]
         particleSpacing = values[2]
-        Reset(GRID)
+        Reset(SimSetup.GRID)
 
     particleSize=values[1]
     gravity=values[3]
@@ -176,7 +334,7 @@ def UpdateSettings():
     mouseInteractionStrength=values[9]
     mouseInteractionRadius=values[10]
 
-    Computing.UpdateSettings(
+    SendSettings(
         particleSize=particleSize, 
         gravity=gravity, 
         collisionDamping=collisionDamping, 
@@ -194,19 +352,14 @@ def Reset(option):
     Resets the simulation with the given spawning option.
 
     Args:
-        option: The reset option, e.g., GRID or RANDOM.
+        option: The reset option, e.g., SimSetup.GRID or SimSetup.RANDOM.
     """
-    global positions, predictedPositions, velocities, densities, spatialIndecies, spatialOffests
-    positions = []
-    predictedPositions = []
-    velocities = []
-    densities = []
-    spatialIndecies = []
-    spatialOffests = []
+    global particles
+    particles = None
 
     SpawnParticles(option)
     
-    Computing.InitializeValues(
+    InitializePhysics(
         SCREEN_SIZE=(screenSize),
         GUI_SIZE=guiSize,
         gravity=gravity,
@@ -217,10 +370,102 @@ def Reset(option):
         targetDensity=targetDensity,
         pressureMultiplier=pressureMultiplier,
         viscosityStrength=viscosityStrength,
-        densityThreshhold=densityThreshhold
+        densityThreshhold=densityThreshhold,
+        engine=engine,
+        useVerletList=useVerletList,
+        verletSkin=verletSkin,
+        floatType=floatType,
+        reorderInterval=reorderInterval,
+        deltaTime=deltaTime,
+        useAdaptiveTimeStep=useAdaptiveTimeStep
         )
-    
-    Computing.InitializeArrays(positions)
+
+
+def ToggleRecording():
+    """
+    Starts recording physics steps into the trajectory file, or stops the running recording.
+    """
+    global recording
+
+    if recording:
+        StopRecording()
+        return
+
+    options = {"every": recordEvery, "quantize": recordQuantized, "compress": recordCompressed}
+    if physics is not None:
+        physics.Record(trajectoryPath, **options)
+    else:
+        Trajectory.Record(trajectoryPath, **options)
+    recording = True
+    print(f"Recording one frame every {recordEvery} steps to {trajectoryPath}")
+
+
+def StopRecording():
+    """
+    Stops the running recording, if any, the computing module already stopped it when it was reset.
+    """
+    global recording
+
+    if not recording: return
+
+    if physics is not None:
+        physics.Record(None)
+    else:
+        Computing.SetTrajectoryWriter(None)
+    recording = False
+    print(f"Trajectory written to {trajectoryPath}")
+
+
+def SaveCheckpoint():
+    """
+    Writes the state of the simulation to the checkpoint file, from the physics process when there is one, waiting until it is written.
+    """
+    try:
+        if physics is not None:
+            physics.SaveCheckpoint(checkpointPath)
+        else:
+            Checkpoint.SaveCheckpoint(checkpointPath)
+    except (OSError, RuntimeError) as error:
+        print(f"Checkpoint not written to {checkpointPath}: {error}")
+        return
+    print(f"Checkpoint written to {checkpointPath}")
+
+
+def RestoreCheckpoint():
+    """
+    Restarts the simulation from the checkpoint file, taking over its settings and moving the sliders to them.
+    The mouse keeps its current state instead of the one the checkpoint was written with.
+    """
+    global particles, numOfParticles, particleSpacing
+
+    if not os.path.exists(checkpointPath):
+        print(f"No checkpoint at {checkpointPath}, F5 writes one")
+        return
+
+    settings, state, restored = Checkpoint.ReadCheckpoint(checkpointPath)
+    StopRecording()
+
+    # Settings both modules have, the screen keeps its own size
+    for name, value in settings.items():
+        if name in globals() and name not in ("SCREEN_SIZE", "GUI_SIZE", "mouseInput"):
+            globals()[name] = value
+
+    gui.SetSliderValues([len(restored), particleSize, particleSpacing, gravity, collisionDamping, smoothingRadius, targetDensity,
+                         pressureMultiplier, viscosityStrength, mouseInteractionStrength, mouseInteractionRadius])
+    # As the sliders show them, so moving another slider does not respawn the particles
+    values = gui.GetSliderValues()
+    numOfParticles, particleSpacing = values[0], values[2]
+
+    if physics is not None:
+        # The window keeps copies in id order, as frames come, the physics process maps the file itself
+        particles = Particles.FromArrays({name: restored.InIdOrder(array, np.empty_like(array)) for name, array in restored.GetArrays().items()})
+        physics.Restore(particles, checkpointPath)
+    else:
+        particles = Checkpoint.LoadCheckpoint(checkpointPath)
+        scheduler.Reset()
+
+    SendSettings(mouseInput=mouseInput)
+    print(f"Restored {len(particles)} particles from {checkpointPath}")
 
 
 def Debug():
@@ -251,16 +496,87 @@ def HandleMouseInput(event):
         changed = True
 
     if changed:
-        Computing.UpdateSettings(mouseInput=mouseInput)
+        SendSettings(mouseInput=mouseInput)
     
     
-def MainLoop():
+def ParseArguments(argv=None):
+    """
+    Parses the command line of the simulation window.
+
+    Returns: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Python fluid simulation")
+    parser.add_argument("--trace", nargs="?", const=tracePath, default=None, metavar="PATH",
+                        help=f"traces the first frames to a Chrome trace JSON file, {tracePath} by default. The T key starts and stops traces too")
+    parser.add_argument("--trace-frames", type=int, default=traceFrames, help="frames per trace, 0 traces until stopped")
+    parser.add_argument("--profile", default=None, metavar="PATH", help="samples the stacks while tracing and writes them collapsed for flamegraphs")
+    parser.add_argument("--checkpoint", default=checkpointPath, metavar="PATH", help="checkpoint file written with F5 and restored with F9")
+    parser.add_argument("--restore", action="store_true", help="starts from the checkpoint file")
+    parser.add_argument("--record", nargs="?", const=trajectoryPath, default=None, metavar="PATH",
+                        help=f"records physics steps from the start to a trajectory file, {trajectoryPath} by default. The R key starts and stops recordings too")
+    parser.add_argument("--record-every", type=int, default=recordEvery, help="physics steps per recorded frame")
+    parser.add_argument("--record-int16", action="store_true", help="quantizes recorded frames to int16 relative to the simulation area")
+    parser.add_argument("--record-zlib", action="store_true", help="compresses every chunk of recorded frames")
+    parser.add_argument("--replay", default=None, metavar="PATH", help="plays a recorded trajectory file instead of simulating")
+    parser.add_argument("--float32", action="store_true", help="runs physics in single precision")
+    parser.add_argument("--reorder-every", type=int, default=reorderInterval, metavar="STEPS",
+                        help="reorders the particles in memory by the Morton order of their cells every so many physics steps, 0 never")
+    parser.add_argument("--dt", type=float, default=deltaTime, help="simulated time of one physics step")
+    parser.add_argument("--adaptive-dt", action="store_true", help="chooses the time step every step from the CFL condition and the force limit")
+    parser.add_argument("--substeps", type=int, default=substeps, help="physics steps per displayed frame, 0 steps in real time. Implies --sync-physics")
+    parser.add_argument("--time-scale", type=float, default=timeScale, help="simulated time per real second in real time")
+    parser.add_argument("--time-budget", type=float, default=physicsTimeBudget, help="most seconds of a frame spent on physics steps in the window loop")
+    parser.add_argument("--no-interpolation", action="store_true", help="draws the last physics step instead of interpolating between the last two")
+    parser.add_argument("--sync-physics", action="store_true", help="steps physics in the window loop instead of its own process, e.g. to trace its phases")
+
+    return parser.parse_args(argv)
+
+
+def MainLoop(args=None):
     """
     Main loop of the simulation, handling events and updates.
     """
+    global tracePath, traceFrames, profilePath, checkpointPath, trajectoryPath, recordEvery, recordQuantized, recordCompressed, usePhysicsProcess, physics, scheduler
+    global floatType, reorderInterval, deltaTime, useAdaptiveTimeStep, substeps, timeScale, physicsTimeBudget, interpolatePositions
+
+    if args is not None:
+        tracePath = args.trace or tracePath
+        traceFrames = args.trace_frames
+        profilePath = args.profile
+        checkpointPath = args.checkpoint
+        trajectoryPath = args.record or trajectoryPath
+        recordEvery = args.record_every
+        recordQuantized = args.record_int16
+        recordCompressed = args.record_zlib
+        floatType = np.float32 if args.float32 else np.float64
+        reorderInterval = args.reorder_every
+        deltaTime = args.dt
+        useAdaptiveTimeStep = args.adaptive_dt
+        substeps = args.substeps
+        timeScale = args.time_scale
+        physicsTimeBudget = args.time_budget
+        interpolatePositions = not args.no_interpolation
+        # Substeps follow displayed frames, which only the window loop has
+        usePhysicsProcess = not args.sync_physics and substeps == 0
+
+    if usePhysicsProcess:
+        physics = PhysicsProcess(timeScale)
+    else:
+        scheduler = FixedStepScheduler(substeps, timeScale, physicsTimeBudget, deltaTime)
+
     paused = True 
 
-    Start(GRID) 
+    Start(SimSetup.GRID) 
+
+    if args is not None and args.restore:
+        RestoreCheckpoint()
+
+    if args is not None and args.trace:
+        ToggleTrace()
+
+    if args is not None and args.record:
+        ToggleRecording()
+
     Update(paused)
 
     running = True
@@ -278,6 +594,21 @@ def MainLoop():
                     else:
                         # Pause
                         paused = True
+                elif event.key == pygame.K_t:
+                    ToggleTrace()
+                elif event.key == pygame.K_r:
+                    ToggleRecording()
+                elif HandleViewKeys(event):
+                    pass
+                elif event.key == pygame.K_a:
+                    # Back to the fixed step when turned off
+                    useAdaptiveTimeStep = not useAdaptiveTimeStep
+                    SendSettings(useAdaptiveTimeStep=useAdaptiveTimeStep, deltaTime=deltaTime)
+                elif event.key == pygame.K_F5:
+                    SaveCheckpoint()
+                elif event.key == pygame.K_F9:
+                    RestoreCheckpoint()
+                    paused = True
 
             HandleMouseInput(event)
 
@@ -288,15 +619,117 @@ def MainLoop():
             if sliderMoved == 2:
                 button = gui.GetPressedButton(event)
                 if button == "RESET GRID":
-                    Reset(GRID)
+                    Reset(SimSetup.GRID)
                     paused = True
                 elif button == "RESET RANDOM":
-                    Reset(RANDOM)
+                    Reset(SimSetup.RANDOM)
                     paused = True
         
         Update(paused)
         
+    if Computing.recorder.tracer is not None:
+        ToggleTrace()
+
     pygame.quit()
+    if physics is not None:
+        physics.Close()
+    Computing.Shutdown()
+
+def SetupReplayGui(playback):
+    """
+    Sets up the GUI of the replay, playback sliders and buttons in place of the physics sliders.
+    """
+    gui.AddSlider(0, "Frame", 0, max(1, playback.numOfFrames - 1))
+    gui.AddSlider(playback.speed, "Speed", -8.0, 8.0)
+
+    gui.AddButton("PLAY / PAUSE")
+    gui.AddButton("REVERSE")
+
+
+def ReplayLoop(path):
+    """
+    Plays a recorded trajectory in the window without computing physics, one recorded frame per displayed frame at speed 1.
+    The frame slider seeks and scrubs, negative speeds play backwards. SPACE plays and pauses, LEFT and RIGHT step a frame,
+    HOME and END jump to the ends, UP and DOWN double and halve the speed, R reverses. V, C and S change the colors as while simulating.
+    """
+    global particleSize
+
+    playback = Playback(path, framerate)
+    particleSize = playback.reader.settings.get("particleSize", particleSize)
+    SetupReplayGui(playback)
+    caption = None
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    playback.TogglePlaying()
+                elif event.key == pygame.K_LEFT:
+                    playback.Step(-1)
+                elif event.key == pygame.K_RIGHT:
+                    playback.Step(1)
+                elif event.key == pygame.K_HOME:
+                    playback.Seek(0)
+                elif event.key == pygame.K_END:
+                    playback.Seek(playback.numOfFrames - 1)
+                elif event.key == pygame.K_UP:
+                    playback.speed = max(-8.0, min(8.0, playback.speed * 2))
+                elif event.key == pygame.K_DOWN:
+                    playback.speed /= 2
+                elif event.key == pygame.K_r:
+                    playback.speed = -playback.speed
+                else:
+                    HandleViewKeys(event)
+
+            sliderMoved = gui.ProcessEvents(event)
+
+            if sliderMoved == 1:
+                frameIndex, playback.speed = gui.GetSliderValues()
+                if frameIndex != playback.frameIndex:
+                    # Scrubbing
+                    playback.playing = False
+                    playback.Seek(frameIndex)
+            if sliderMoved == 2:
+                button = gui.GetPressedButton(event)
+                if button == "PLAY / PAUSE":
+                    playback.TogglePlaying()
+                elif button == "REVERSE":
+                    playback.speed = -playback.speed
+
+        playback.Advance(clock.get_time() / 1000)
+        # Frames keep coming while the recording is still being written
+        gui.SetSliderRange(0, 0, max(1, playback.numOfFrames - 1))
+        gui.SetSliderValues([playback.frameIndex, playback.speed])
+
+        screen.fill(backgroundColorDark)
+        drawnParticles = playback.GetParticles()
+        if drawnParticles is not None:
+            DrawParticles(drawnParticles)
+
+            step, simulatedTime = playback.GetFrameInfo()
+            newCaption = f"Replay of {path}: frame {playback.frameIndex + 1}/{playback.numOfFrames}, step {step}, time {simulatedTime:.2f}"
+            if newCaption != caption:
+                caption = newCaption
+                pygame.display.set_caption(caption)
+
+        gui.Render(screen, framerate)
+        pygame.display.flip()
+        clock.tick(framerate)
+
+    playback.Close()
+    pygame.quit()
+
 
-MainLoop()
+# Guarded, so the physics process and worker processes of the PARALLEL engine started with spawn do not run the main loop
+if __name__ == "__main__":
+    arguments = ParseArguments()
+    InitializeWindow()
+    if arguments.replay:
+        ReplayLoop(arguments.replay)
+    else:
+        MainLoop(arguments)
 
@@ -1,3 +1,5 @@
+import math
+import functools
 import numpy as np
 
 # Offsets for finding neighbours of cells
@@ -40,4 +42,211 @@ def GetKeyFromHash(cellHash, tableSize):
     Computes cell key for the hash table from a cell hash
     Returns: Cell key as an integer
     """
-    return int(cellHash % tableSize)
\ No newline at end of file
+    return int(cellHash % tableSize)
+
+## Whole array versions, used by the vectorized engine
+offsetsArray = np.array(offsets) # (9, 2)
+halfOffsetsArray = np.array([offsets[4], offsets[5], offsets[0], offsets[1], offsets[2]]) # (5, 2) Given cell, Right and the row below, visiting every pair of cells once
+
+def GetCells(points, radius):
+    """ 
+    Computes cell coordinates for all given points, truncating like GetCell
+    Returns: (N, 2) integer array of cell coordinates
+    """
+    return (points / radius).astype(np.int64)
+
+def HashCells(cells):
+    """ 
+    Computes the hash of every cell in an (..., 2) integer array
+    Return: Hashes as integer array
+    """
+    return cells[..., 0] * hashK1 + cells[..., 1] * hashH2
+
+def GetKeysFromHashes(cellHashes, tableSize):
+    """ 
+    Computes cell keys for an array of cell hashes
+    Returns: Cell keys as integer array
+    """
+    return np.mod(cellHashes, tableSize)
+
+def ExpandRanges(starts, counts):
+    """ 
+    Expands ranges [start, start + count) into one flat index array without a Python loop
+    Returns: Pair of arrays (rangeIndex, index), rangeIndex telling which range each index came from
+    """
+    rangeIndex = np.repeat(np.arange(len(starts)), counts)
+    rangeStarts = np.cumsum(counts) - counts
+    index = np.arange(len(rangeIndex)) - rangeStarts[rangeIndex] + starts[rangeIndex]
+
+    return rangeIndex, index
+
+def CountingSort(keys, numKeys):
+    """ 
+    Stable sort of integer keys in range [0, numKeys), done as a least significant digit radix sort with 16 bit digits.
+    Numpy sorts 16 bit integers with a counting sort when asked for a stable sort, so every pass is O(n).
+    Returns: Tuple (order, keyStarts, keyEnds), order sorts the keys, particles with key k are order[keyStarts[k]:keyEnds[k]]
+    """
+    order = np.arange(len(keys))
+    shift = 0
+
+    while shift == 0 or (numKeys - 1) >> shift > 0:
+        digits = ((keys[order] >> shift) & 0xFFFF).astype(np.uint16)
+        order = order[np.argsort(digits, kind="stable")]
+        shift += 16
+
+    keyCounts = np.bincount(keys, minlength=numKeys)
+    keyEnds = np.cumsum(keyCounts)
+    keyStarts = keyEnds - keyCounts
+
+    return order, keyStarts, keyEnds
+
+# Masks spreading the lower 32 bits of an integer over the even bits, one shift at a time
+mortonMasks = [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)]
+
+def GetMortonCodes(cells):
+    """
+    Interleaves the bits of the cell coordinates, shifted to start at zero, into Morton codes.
+    Sorted by their codes, cells follow a Z-order curve, so cells close in space are mostly close in the order
+    Returns: Morton codes as unsigned integer array
+    """
+    if len(cells) == 0:
+        return np.empty(0, dtype=np.uint64)
+
+    bits = (cells - cells.min(axis=0)).astype(np.uint64) & 0xFFFFFFFF
+    for shift, mask in mortonMasks:
+        bits = (bits | (bits << shift)) & mask
+
+    return bits[:, 0] | (bits[:, 1] << 1)
+
+## Dense grid, used instead of hashing when the simulation area is bounded
+def GetGridShape(width, height, cellSize):
+    """ 
+    Computes the number of cells needed to cover the area
+    Returns: Tuple (cellsX, cellsY)
+    """
+    return (max(1, math.ceil(width / cellSize)), max(1, math.ceil(height / cellSize)))
+
+def GetGridCells(points, cellSize, gridShape):
+    """ 
+    Computes cell coordinates of all points in the dense grid. Points outside the area go to the border cells,
+    which keeps every pair closer than cellSize in neighbouring cells.
+    Returns: (N, 2) integer array of cell coordinates
+    """
+    cells = np.floor(points / cellSize).astype(np.int64)
+    np.clip(cells, 0, np.array(gridShape) - 1, out=cells)
+    return cells
+
+def GetGridKeys(cells, gridShape):
+    """ 
+    Computes cell keys in the dense grid row by row, so cells next to each other in a row have consecutive keys
+    Returns: Cell keys as integer array
+    """
+    return cells[..., 1] * gridShape[0] + cells[..., 0]
+
+@functools.lru_cache(maxsize=8)
+def GetNeighbourRowKeys(gridShape):
+    """ 
+    Precomputes the neighbouring cells of every cell of the dense grid as 3 rows of consecutive keys.
+    Rows outside the grid point at the empty key after the last cell.
+    Returns: (cellsX * cellsY, 3, 2) integer array of [firstKey, lastKey] per row
+    """
+    cellsX, cellsY = gridShape
+    cellX, cellY = np.meshgrid(np.arange(cellsX), np.arange(cellsY))
+    cellX = cellX.ravel()
+    cellY = cellY.ravel()
+
+    rowKeys = np.full((cellsX * cellsY, 3, 2), cellsX * cellsY, dtype=np.int64)
+    for row, offsetY in enumerate((-1, 0, 1)):
+        neighbourY = cellY + offsetY
+        inGrid = (neighbourY >= 0) & (neighbourY < cellsY)
+        rowKeys[inGrid, row, 0] = neighbourY[inGrid] * cellsX + np.maximum(cellX[inGrid] - 1, 0)
+        rowKeys[inGrid, row, 1] = neighbourY[inGrid] * cellsX + np.minimum(cellX[inGrid] + 1, cellsX - 1)
+
+    return rowKeys
+
+def GetNeighbourRanges(points, cellSize, spatialOffsets, spatialEnds, gridShape=None):
+    """ 
+    Computes the ranges of spatial indecies holding the neighbour candidates of every point.
+    The hashed grid gives 9 ranges per point, one per neighbouring cell, each with the hash its entries must match.
+    The dense grid gives 3 ranges per point, one per row of neighbouring cells, without collisions to check.
+    Returns: Tuple (rangeStarts, rangeEnds, rangeHashes) of (N, ranges) integer arrays, rangeHashes is None for the dense grid
+    """
+    if gridShape is None:
+        rangeHashes = HashCells(GetCells(points, cellSize)[:, None, :] + offsetsArray[None, :, :])
+        rangeKeys = GetKeysFromHashes(rangeHashes, len(spatialOffsets))
+        return spatialOffsets[rangeKeys], spatialEnds[rangeKeys], rangeHashes
+
+    cellKeys = GetGridKeys(GetGridCells(points, cellSize, gridShape), gridShape)
+    rowKeys = GetNeighbourRowKeys(gridShape)[cellKeys]
+    return spatialOffsets[rowKeys[..., 0]], spatialEnds[rowKeys[..., 1]], None
+
+def GetHalfNeighbourRanges(points, cellSize, spatialIndecies, spatialOffsets, spatialEnds, gridShape=None):
+    """ 
+    Computes the ranges of spatial indecies holding the half stencil of every point, so each pair of points is found once.
+    The own cell is only read after the point's own entry, and of the 8 neighbouring cells only the 4 on one side are visited.
+    The hashed grid gives 5 ranges per point, one per cell, each with the hash its entries must match.
+    The dense grid gives 2 ranges per point: the rest of its own row up to the right cell, and the 3 cells of the row below.
+    Returns: Tuple (rangeStarts, rangeEnds, rangeHashes) of (N, ranges) integer arrays, rangeHashes is None for the dense grid
+    """
+    # Position of every point's own entry in the spatial indecies
+    entryIndecies = np.empty(len(spatialIndecies), dtype=np.int64)
+    entryIndecies[spatialIndecies[:, 0]] = np.arange(len(spatialIndecies))
+
+    if gridShape is None:
+        cellHashes = HashCells(GetCells(points, cellSize)[:, None, :] + halfOffsetsArray[None, :, :])
+        cellKeys = GetKeysFromHashes(cellHashes, len(spatialOffsets))
+
+        rangeStarts = spatialOffsets[cellKeys]
+        rangeStarts[:, 0] = entryIndecies + 1
+        return rangeStarts, spatialEnds[cellKeys], cellHashes
+
+    cells = GetGridCells(points, cellSize, gridShape)
+    rowKeys = GetNeighbourRowKeys(gridShape)[GetGridKeys(cells, gridShape)]
+
+    rangeStarts = np.stack((entryIndecies + 1, spatialOffsets[rowKeys[:, 2, 0]]), axis=1)
+    rangeEnds = np.stack((spatialEnds[rowKeys[:, 1, 1]], spatialEnds[rowKeys[:, 2, 1]]), axis=1)
+    return rangeStarts, rangeEnds, None
+
+def GatherRanges(spatialIndecies, rangeStarts, rangeEnds, rangeHashes, start=0, counters=None):
+    """ 
+    Gathers the entries of all ranges of points in one pass over whole arrays, skipping entries whose hash does not match.
+    When given a counters dictionary, adds the visited candidates and the hash mismatches to "candidatesVisited" and "hashRejections".
+    Returns: Pair of arrays (particleIndecies, candidateIndecies), ordered by particle index
+    """
+    rangeIndex, currIndex = ExpandRanges(rangeStarts.ravel(), np.maximum(rangeEnds - rangeStarts, 0).ravel())
+    particleIndecies = rangeIndex // rangeStarts.shape[1] + start
+    candidateIndecies = spatialIndecies[currIndex, 0]
+
+    if counters is not None:
+        counters["candidatesVisited"] = counters.get("candidatesVisited", 0) + len(currIndex)
+
+    if rangeHashes is None:
+        return particleIndecies, candidateIndecies
+
+    # Skip if hash does not match
+    hashMatches = spatialIndecies[currIndex, 1] == rangeHashes.ravel()[rangeIndex]
+
+    if counters is not None:
+        counters["hashRejections"] = counters.get("hashRejections", 0) + len(hashMatches) - int(np.count_nonzero(hashMatches))
+
+    return particleIndecies[hashMatches], candidateIndecies[hashMatches]
+
+def FindCandidates(points, spatialIndecies, spatialOffsets, spatialEnds, cellSize, start=0, end=None, gridShape=None, counters=None):
+    """ 
+    Gathers neighbour candidates of points[start:end] from their neighbouring cells in one pass over whole arrays.
+    With the hashed grid, candidates whose hash does not match the cell are skipped, the same check as when walking the cells one by one.
+    Returns: Pair of arrays (particleIndecies, candidateIndecies), ordered by particle index
+    """
+    end = len(points) if end is None else end
+
+    rangeStarts, rangeEnds, rangeHashes = GetNeighbourRanges(points[start:end], cellSize, spatialOffsets, spatialEnds, gridShape)
+    return GatherRanges(spatialIndecies, rangeStarts, rangeEnds, rangeHashes, start, counters)
+
+def FindHalfCandidates(points, spatialIndecies, spatialOffsets, spatialEnds, cellSize, gridShape=None, counters=None):
+    """ 
+    Gathers neighbour candidates of all points from their half stencils, so every pair of points in neighbouring cells
+    comes out once, in one direction only, and no point is paired with itself.
+    Returns: Pair of arrays (particleIndecies, candidateIndecies), ordered by particle index
+    """
+    rangeStarts, rangeEnds, rangeHashes = GetHalfNeighbourRanges(points, cellSize, spatialIndecies, spatialOffsets, spatialEnds, gridShape)
+    return GatherRanges(spatialIndecies, rangeStarts, rangeEnds, rangeHashes, counters=counters)
@@ -0,0 +1,491 @@
+import os
+import json
+import zlib
+import queue
+import struct
+import threading
+import warnings
+import numpy as np
+
+import Computing
+from Checkpoint import EncodeSetting, DecodeSetting
+
+# A trajectory file is a fixed size header, the counts and the segment directory of the index, then the chunks of frames
+# and the segments of the index in the order they were written.
+# The header is JSON after a fixed prefix. The chunk and frame tables of the index grow in segments of doubling size,
+# allocated as frames arrive, the directory holds their offsets. The index is memory-mapped, its counts are written last,
+# so a reader never sees a frame whose chunk is not written yet. Every chunk holds chunkFrames frames, only the last one
+# may hold fewer, each frame the positions and velocities of all particles as a (2, N, 2) array.
+MAGIC = b"FLUIDTRJ"
+VERSION = 2
+PREFIX = struct.Struct("<8sII") # Magic, version, byte length of the JSON header
+HEADER_SIZE = 4096
+ALIGNMENT = 64
+
+COUNTS_DTYPE = np.dtype([("frames", "<i8"), ("chunks", "<i8")])
+CHUNK_DTYPE = np.dtype([("offset", "<i8"), ("bytes", "<i8"), ("firstFrame", "<i8"), ("frames", "<i8"), ("velocityScale", "<f8")])
+FRAME_DTYPE = np.dtype([("step", "<i8"), ("time", "<f8")])
+
+# Tables of the index by name, with their row type and the rows of their first segment, segment k holds firstRows * 2 ** k rows
+TABLES = {"chunks": (CHUNK_DTYPE, 16), "frames": (FRAME_DTYPE, 256)}
+SEGMENTS = 40 # Segments per table, more rows than any recording has
+DIRECTORY_DTYPE = np.dtype([(name, "<i8", (SEGMENTS,)) for name in TABLES]) # Offsets of the segments, 0 while not allocated
+
+QUANTIZED_MAX = 32767 # Quantized values are in [-QUANTIZED_MAX, QUANTIZED_MAX]
+
+
+def Align(offset, alignment=ALIGNMENT):
+    return -(-offset // alignment) * alignment
+
+
+def GetIndexLayout():
+    """
+    Returns: A pair (offsets, dataStart), offsets of the counts and the segment directory by name, and the offset of the first chunk.
+    """
+    countsOffset = HEADER_SIZE
+    directoryOffset = Align(countsOffset + COUNTS_DTYPE.itemsize)
+    dataStart = Align(directoryOffset + DIRECTORY_DTYPE.itemsize)
+
+    return {"counts": (countsOffset, COUNTS_DTYPE), "directory": (directoryOffset, DIRECTORY_DTYPE)}, dataStart
+
+
+def MapIndex(path, mode):
+    """
+    Returns: A dictionary of the memory-mapped counts and segment directory, and the chunk and frame tables as IndexTables.
+    """
+    offsets, dataStart = GetIndexLayout()
+    index = {name: np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(1,)) for name, (offset, dtype) in offsets.items()}
+    for name, (dtype, firstRows) in TABLES.items():
+        index[name] = IndexTable(path, index["directory"][name][0], dtype, firstRows, mode)
+
+    return index
+
+
+class IndexTable:
+
+    def __init__(self, path, segmentOffsets, dtype, firstRows, mode):
+        """
+        A table of the trajectory index, stored in segments of doubling size wherever they were allocated in the file,
+        so the index grows with the recording instead of taking the room of the longest one from the start.
+        Segments are mapped on first use.
+
+        Args:
+            segmentOffsets: The memory-mapped offsets of the segments, 0 where a segment is not allocated yet.
+            firstRows: Rows of the first segment, every next segment holds twice as many.
+        """
+        self.path = path
+        self.segmentOffsets = segmentOffsets
+        self.dtype = dtype
+        self.firstRows = firstRows
+        self.mode = mode
+        self.segments = []
+
+
+    def Locate(self, row):
+        """
+        Returns: A pair (segment, rowInSegment) of a row of the table.
+        """
+        segment = (row // self.firstRows + 1).bit_length() - 1
+        return segment, row - self.firstRows * ((1 << segment) - 1)
+
+
+    def GetSegmentBytes(self, segment):
+        return (self.firstRows << segment) * self.dtype.itemsize
+
+
+    def GetSegment(self, segment):
+        while len(self.segments) <= segment:
+            nextSegment = len(self.segments)
+            offset = int(self.segmentOffsets[nextSegment])
+            if offset == 0:
+                raise IndexError(f"Segment {nextSegment} of the index is not written yet")
+            self.segments.append(np.memmap(self.path, dtype=self.dtype, mode=self.mode, offset=offset, shape=(self.firstRows << nextSegment,)))
+
+        return self.segments[segment]
+
+
+    def __getitem__(self, row):
+        segment, rowInSegment = self.Locate(row)
+        return self.GetSegment(segment)[rowInSegment]
+
+
+    def __setitem__(self, row, value):
+        segment, rowInSegment = self.Locate(row)
+        self.GetSegment(segment)[rowInSegment] = value
+
+
+    def Flush(self):
+        for segment in self.segments:
+            segment.flush()
+
+
+def QuantizeFrames(frames, box):
+    """
+    Converts frames to int16, positions relative to the box, velocities relative to the largest speed component.
+
+    Args:
+        frames: A (F, 2, N, 2) float array of positions and velocities.
+        box: The (minX, minY, maxX, maxY) bounds of the positions.
+
+    Returns: A pair (quantized, velocityScale).
+    """
+    lower = np.array(box[:2], dtype=np.float64)
+    size = np.maximum(np.array(box[2:], dtype=np.float64) - lower, 1e-9)
+    velocityScale = float(np.abs(frames[:, 1]).max(initial=0)) or 1.0
+
+    quantized = np.empty(frames.shape, dtype=np.int16)
+    positions = (frames[:, 0] - lower) * (2 * QUANTIZED_MAX / size) - QUANTIZED_MAX
+    np.rint(np.clip(positions, -QUANTIZED_MAX, QUANTIZED_MAX), out=quantized[:, 0], casting="unsafe")
+    np.rint(frames[:, 1] * (QUANTIZED_MAX / velocityScale), out=quantized[:, 1], casting="unsafe")
+
+    return quantized, velocityScale
+
+
+def DequantizeFrames(quantized, box, velocityScale):
+    """
+    Returns: The (F, 2, N, 2) float32 frames of quantized ones, see QuantizeFrames.
+    """
+    lower = np.array(box[:2], dtype=np.float32)
+    size = np.array(box[2:], dtype=np.float32) - lower
+
+    frames = np.empty(quantized.shape, dtype=np.float32)
+    np.multiply(quantized[:, 0] + np.float32(QUANTIZED_MAX), size / (2 * QUANTIZED_MAX), out=frames[:, 0])
+    frames[:, 0] += lower
+    np.multiply(quantized[:, 1], np.float32(velocityScale / QUANTIZED_MAX), out=frames[:, 1])
+
+    return frames
+
+
+def PackQuantized(quantized):
+    """
+    Prepares quantized frames for compression: every frame but the first becomes its difference to the frame before,
+    small while particles move little, then the low and high bytes of all values are grouped.
+
+    Returns: The packed bytes.
+    """
+    differences = quantized.copy()
+    differences[1:] -= quantized[:-1]
+    return differences.view(np.uint8).reshape(-1, 2).T.tobytes()
+
+
+def UnpackQuantized(buffer, shape):
+    """
+    Returns: The int16 frames of the given shape packed by PackQuantized.
+    """
+    differences = np.frombuffer(buffer, dtype=np.uint8).reshape(2, -1).T.copy().view(np.int16).reshape(shape)
+    # Wraps around like the differences did
+    return np.cumsum(differences, axis=0, dtype=np.int16)
+
+
+class TrajectoryWriter:
+
+    def __init__(self, path, numOfParticles, box, every=1, chunkFrames=64, quantize=False, compress=False, dtype=np.float32,
+                 maxFrames=None, queueFrames=256, settings=None):
+        """
+        Records every n-th step of the particles into a trajectory file. AddStep only copies the arrays into a queue,
+        a background thread groups the frames into chunks, converts and compresses them, and writes them,
+        so the physics loop never waits for the disk.
+
+        Args:
+            box: The (minX, minY, maxX, maxY) bounds of the simulation area, the range quantized positions cover.
+            every: Steps per recorded frame.
+            chunkFrames: Frames per chunk, the unit of compression and of reading.
+            quantize: Stores positions and velocities as int16, positions relative to the box, velocities relative to the
+                      largest speed component of the chunk. Positions keep about 1/65534 of the box.
+            compress: Compresses every chunk with zlib, quantized chunks as differences between frames, see PackQuantized.
+            dtype: The float type of frames that are not quantized.
+            maxFrames: Frames recorded at most, later frames are dropped. None records until closed.
+            queueFrames: Frames waiting for the thread at most. When the disk falls this far behind, frames are dropped
+                         instead of stalling the physics loop, the step numbers of the index show the gaps.
+            settings: Settings kept in the header, e.g. of Computing.GetSettings.
+        """
+        self.path = path
+        self.numOfParticles = numOfParticles
+        self.box = tuple(float(bound) for bound in box)
+        self.every = every
+        self.chunkFrames = chunkFrames
+        self.quantize = quantize
+        self.compress = compress
+        self.dtype = np.dtype(np.int16 if quantize else dtype)
+        self.maxFrames = maxFrames
+
+        self.steps = 0 # Steps seen by AddStep
+        self.queuedFrames = 0 # Frames handed to the thread
+        self.droppedFrames = 0
+        self.error = None # Exception the thread stopped with
+
+        header = {
+            "numOfParticles": numOfParticles,
+            "box": self.box,
+            "every": every,
+            "chunkFrames": chunkFrames,
+            "dtype": self.dtype.str,
+            "quantized": quantize,
+            "compression": "zlib" if compress else None,
+            "settings": {name: EncodeSetting(value) for name, value in (settings or {}).items()},
+        }
+        headerBytes = json.dumps(header).encode()
+        if PREFIX.size + len(headerBytes) > HEADER_SIZE:
+            raise ValueError("Trajectory header does not fit, too many settings")
+
+        offsets, self.dataEnd = GetIndexLayout()
+        self.capacity = self.dataEnd + 16 * self.GetChunkBytes(chunkFrames)
+
+        # Sparse until written, room for the first chunks is preallocated
+        self.file = open(path, "w+b")
+        self.file.write(PREFIX.pack(MAGIC, VERSION, len(headerBytes)) + headerBytes)
+        self.file.truncate(self.capacity)
+        self.file.flush()
+        self.index = MapIndex(path, "r+")
+
+        self.frameQueue = queue.Queue(maxsize=queueFrames)
+        self.thread = threading.Thread(target=self.WriteLoop, daemon=True)
+        self.thread.start()
+
+
+    def GetChunkBytes(self, frames):
+        return frames * 2 * self.numOfParticles * 2 * self.dtype.itemsize
+
+
+    def Reserve(self, numOfBytes):
+        """
+        Returns: The offset of numOfBytes of room after the data written so far, growing the file when it is full.
+        """
+        offset = self.dataEnd
+        if offset + numOfBytes > self.capacity:
+            self.capacity = max(2 * self.capacity, offset + numOfBytes)
+            self.file.truncate(self.capacity)
+        self.dataEnd = Align(offset + numOfBytes)
+
+        return offset
+
+
+    def GrowTable(self, table, rows):
+        """
+        Allocates the segments of an index table up to the given number of rows.
+        """
+        lastSegment, _ = table.Locate(rows - 1)
+        for segment in range(lastSegment + 1):
+            if table.segmentOffsets[segment] == 0:
+                table.segmentOffsets[segment] = self.Reserve(table.GetSegmentBytes(segment))
+
+
+    def AddStep(self, particles, simulatedTime):
+        """
+        Counts a step and queues a copy of its positions and velocities when it is a recorded one, in the order of the particle ids,
+        so every particle keeps its row in every frame while the computing module reorders them in memory.
+        Raises the error the writer thread stopped with, if any.
+        """
+        if self.error is not None:
+            raise RuntimeError(f"Writing {self.path} failed") from self.error
+
+        step = self.steps
+        self.steps += 1
+        if step % self.every != 0: return
+
+        if self.maxFrames is not None and self.queuedFrames >= self.maxFrames:
+            self.droppedFrames += 1
+            return
+
+        frame = np.empty((2, self.numOfParticles, 2), dtype=np.float64 if self.quantize else self.dtype)
+        particles.InIdOrder(particles.positions, frame[0])
+        particles.InIdOrder(particles.velocities, frame[1])
+
+        try:
+            self.frameQueue.put_nowait((step, simulatedTime, frame))
+            self.queuedFrames += 1
+        except queue.Full:
+            self.droppedFrames += 1
+
+
+    def WriteLoop(self):
+        """
+        Main function of the writer thread, groups queued frames into chunks and writes them, until a None frame.
+        """
+        pending = []
+        try:
+            while True:
+                item = self.frameQueue.get()
+                if item is not None:
+                    pending.append(item)
+
+                if pending and (item is None or len(pending) == self.chunkFrames):
+                    self.WriteChunk(pending)
+                    pending = []
+
+                if item is None:
+                    break
+        except Exception as error:
+            self.error = error
+
+
+    def WriteChunk(self, pending):
+        """
+        Converts, compresses and writes a chunk of frames, then adds it to the index.
+        """
+        frames = np.stack([frame for step, simulatedTime, frame in pending])
+
+        velocityScale = 1.0
+        if self.quantize:
+            frames, velocityScale = QuantizeFrames(frames, self.box)
+
+        if self.compress:
+            data = zlib.compress(PackQuantized(frames) if self.quantize else frames.tobytes(), 1)
+        else:
+            data = frames.tobytes()
+
+        offset = self.Reserve(len(data))
+        os.pwrite(self.file.fileno(), data, offset)
+
+        counts = self.index["counts"]
+        numOfFrames, numOfChunks = int(counts["frames"][0]), int(counts["chunks"][0])
+
+        chunkTable, frameTable = self.index["chunks"], self.index["frames"]
+        self.GrowTable(chunkTable, numOfChunks + 1)
+        self.GrowTable(frameTable, numOfFrames + len(pending))
+
+        chunkTable[numOfChunks] = (offset, len(data), numOfFrames, len(pending), velocityScale)
+        for frameIndex, (step, simulatedTime, frame) in enumerate(pending, numOfFrames):
+            frameTable[frameIndex] = (step, simulatedTime)
+
+        # Counts last, readers only see frames whose chunk is complete
+        counts["chunks"] = numOfChunks + 1
+        counts["frames"] = numOfFrames + len(pending)
+
+
+    def Close(self):
+        """
+        Writes the frames still queued, trims the file to its contents and closes it.
+        """
+        if self.file is None: return
+
+        self.frameQueue.put(None)
+        self.thread.join()
+
+        self.index["chunks"].Flush()
+        self.index["frames"].Flush()
+        self.index["counts"].flush()
+        self.index["directory"].flush()
+        self.index = None
+        self.file.truncate(self.dataEnd)
+        self.file.close()
+        self.file = None
+
+        if self.droppedFrames:
+            warnings.warn(f"{self.droppedFrames} frames of {self.path} were dropped, the disk could not keep up or maxFrames were recorded")
+        if self.error is not None:
+            raise RuntimeError(f"Writing {self.path} failed") from self.error
+
+
+class TrajectoryReader:
+
+    def __init__(self, path):
+        """
+        Opens a trajectory file for random access, reading only the chunks of the frames asked for.
+        Frames of uncompressed chunks are views into the memory-mapped file, nothing is read until used.
+        The file may still be written, NumFrames tells the frames complete so far.
+        """
+        self.path = path
+
+        with open(path, "rb") as file:
+            magic, version, headerLength = PREFIX.unpack(file.read(PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a trajectory file")
+            if version != VERSION:
+                raise ValueError(f"{path} is a version {version} trajectory, expected version {VERSION}")
+            header = json.loads(file.read(headerLength))
+
+        self.numOfParticles = header["numOfParticles"]
+        self.box = tuple(header["box"])
+        self.every = header["every"]
+        self.chunkFrames = header["chunkFrames"]
+        self.dtype = np.dtype(header["dtype"])
+        self.quantized = header["quantized"]
+        self.compression = header["compression"]
+        self.settings = {name: DecodeSetting(value) for name, value in header["settings"].items()}
+
+        self.index = MapIndex(path, "r")
+        self.data = None # Memory map of the whole file, remapped as the file grows
+        self.cachedChunk = -1
+        self.cachedFrames = None
+
+
+    @property
+    def numOfFrames(self):
+        return int(self.index["counts"]["frames"][0])
+
+
+    def __len__(self):
+        return self.numOfFrames
+
+
+    def GetFrameInfo(self, frameIndex):
+        """
+        Returns: A pair (step, simulatedTime) of the frame.
+        """
+        frame = self.index["frames"][frameIndex]
+        return int(frame["step"]), float(frame["time"])
+
+
+    def GetChunk(self, chunkIndex):
+        """
+        Returns: The (F, 2, N, 2) frames of the chunk, the last chunk asked for is kept.
+        """
+        if chunkIndex == self.cachedChunk:
+            return self.cachedFrames
+
+        offset, numOfBytes, firstFrame, numOfFrames, velocityScale = self.index["chunks"][chunkIndex].tolist()
+        if self.data is None or len(self.data) < offset + numOfBytes:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+        shape = (numOfFrames, 2, self.numOfParticles, 2)
+        data = self.data[offset:offset + numOfBytes]
+        if self.compression == "zlib" and self.quantized:
+            frames = UnpackQuantized(zlib.decompress(data), shape)
+        elif self.compression == "zlib":
+            frames = np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(shape)
+        else:
+            frames = data.view(self.dtype).reshape(shape)
+
+        if self.quantized:
+            frames = DequantizeFrames(frames, self.box, velocityScale)
+
+        self.cachedChunk = chunkIndex
+        self.cachedFrames = frames
+        return frames
+
+
+    def ReadFrame(self, frameIndex):
+        """
+        Returns: A pair (positions, velocities) of (N, 2) arrays of the frame, read only.
+        """
+        if not 0 <= frameIndex < self.numOfFrames:
+            raise IndexError(f"Frame {frameIndex} of {self.numOfFrames}")
+
+        frame = self.GetChunk(frameIndex // self.chunkFrames)[frameIndex % self.chunkFrames]
+        return frame[0], frame[1]
+
+
+    def Close(self):
+        self.index = None
+        self.data = None
+        self.cachedFrames = None
+
+
+def Record(path, **options):
+    """
+    Starts recording the steps of the computing module into a trajectory file, stopping the recording before.
+    The box is the simulation area and the settings of the computing module go into the header.
+
+    Args:
+        **options: Options of TrajectoryWriter.
+
+    Returns: The TrajectoryWriter.
+    """
+    particles = Computing.GetParticles()
+    box = (0, 0, Computing.SCREEN_SIZE[0] - Computing.GUI_SIZE[0], Computing.SCREEN_SIZE[1])
+
+    writer = TrajectoryWriter(path, len(particles), box, settings=Computing.GetSettings(), **options)
+    Computing.SetTrajectoryWriter(writer)
+
+    return writer
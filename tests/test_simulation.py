@@ -0,0 +1,218 @@
+import numpy as np
+import pytest
+
+import Checkpoint
+import Computing
+import NumbaBackend as nb
+import SpatialHash as sh
+import Trajectory
+from Particles import Particles
+
+AREA = (930, 720)
+
+
+def Setup(engine, numOfParticles=1500, seed=0, **values):
+    """
+    Initializes the computing module with randomly placed particles, none of them at the same spot,
+    so no pair gets a random direction and runs of different engines can be compared.
+
+    Returns: The particle store.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.random((numOfParticles, 2)) * AREA
+
+    settings = dict(
+        SCREEN_SIZE=AREA, GUI_SIZE=(0, AREA[1]), gravity=0.3, collisionDamping=0.5, particleSize=8, particleMass=1,
+        smoothingRadius=50, targetDensity=5 / 10000.0, pressureMultiplier=500, viscosityStrength=0.5, densityThreshhold=1e-7,
+        mouseInput=0, mouseInteractionStrength=0, mouseInteractionRadius=0, engine=engine, useVerletList=False, verletSkin=20,
+        numOfWorkers=2, useSymmetricPairs=engine in Computing.SYMMETRIC_PAIR_ENGINES, denseGridMaxCellsPerParticle=16, floatType=np.float64, deltaTime=0.3,
+        useAdaptiveTimeStep=False, reorderInterval=0,
+    )
+    settings.update(values)
+
+    np.random.seed(seed)
+    Computing.InitializeValues(**settings)
+    particles = Particles.FromPositions(positions, settings["floatType"])
+    Computing.InitializeArrays(particles)
+
+    return particles
+
+
+def RunSteps(steps):
+    try:
+        for step in range(steps):
+            Computing.SimulationStep((0, 0))
+        return {name: array.copy() for name, array in Computing.GetParticles().GetArrays().items()}
+    finally:
+        Computing.Shutdown()
+
+
+## Engines
+ENGINES = [Computing.VECTORIZED, Computing.PARALLEL] + ([Computing.NUMBA] if nb.available else [])
+
+@pytest.mark.parametrize("useSymmetricPairs", [False, True])
+def test_engines_give_the_same_positions(useSymmetricPairs):
+    results = {}
+    for engine in ENGINES:
+        # The parallel engine always gathers from both sides
+        Setup(engine, useSymmetricPairs=useSymmetricPairs and engine in Computing.SYMMETRIC_PAIR_ENGINES)
+        results[engine] = RunSteps(5)
+
+    reference = results[Computing.VECTORIZED]
+    for engine, arrays in results.items():
+        np.testing.assert_allclose(arrays["positions"], reference["positions"], rtol=0, atol=1e-9, err_msg=f"engine {engine}")
+        np.testing.assert_allclose(arrays["velocities"], reference["velocities"], rtol=0, atol=1e-9, err_msg=f"engine {engine}")
+
+
+## Spatial hash
+def BruteForcePairs(positions, radius):
+    """
+    Returns: The set of ordered pairs (i, j), i != j, closer than radius, found by comparing every particle with every other one.
+    """
+    offsets = positions[None, :, :] - positions[:, None, :]
+    close = np.einsum("ijk,ijk->ij", offsets, offsets) < radius ** 2
+    np.fill_diagonal(close, False)
+    return set(zip(*map(np.ndarray.tolist, np.nonzero(close))))
+
+
+def PairsInRadius(particleIndecies, neighbourIndecies, positions, radius):
+    offsets = positions[neighbourIndecies] - positions[particleIndecies]
+    inRadius = np.einsum("ij,ij->i", offsets, offsets) < radius ** 2
+    return list(zip(particleIndecies[inRadius].tolist(), neighbourIndecies[inRadius].tolist()))
+
+
+def test_counting_sort_is_stable():
+    keys = np.random.default_rng(1).integers(0, 70000, 5000)
+    order, keyStarts, keyEnds = sh.CountingSort(keys, 70000)
+
+    np.testing.assert_array_equal(order, np.argsort(keys, kind="stable"))
+    for key in np.unique(keys)[:50]:
+        np.testing.assert_array_equal(order[keyStarts[key]:keyEnds[key]], np.flatnonzero(keys == key))
+
+
+@pytest.mark.parametrize("denseGridMaxCellsPerParticle", [16, 0], ids=["dense", "hashed"])
+def test_spatial_hash_finds_every_pair(denseGridMaxCellsPerParticle):
+    particles = Setup(Computing.VECTORIZED, numOfParticles=800, denseGridMaxCellsPerParticle=denseGridMaxCellsPerParticle)
+    Computing.predictedPositions[:] = particles.positions
+    Computing.UpdateSpatialHash()
+    assert (Computing.spatialGridShape is None) == (denseGridMaxCellsPerParticle == 0)
+
+    particleIndecies, neighbourIndecies = sh.FindCandidates(Computing.predictedPositions, Computing.spatialIndecies, Computing.spatialOffsets,
+                                                            Computing.spatialEnds, Computing.spatialCellSize, gridShape=Computing.spatialGridShape)
+    pairs = [pair for pair in PairsInRadius(particleIndecies, neighbourIndecies, particles.positions, 50) if pair[0] != pair[1]]
+
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == BruteForcePairs(particles.positions, 50)
+
+
+@pytest.mark.parametrize("useVerletList", [False, True], ids=["fresh", "verlet"])
+@pytest.mark.parametrize("denseGridMaxCellsPerParticle", [16, 0], ids=["dense", "hashed"])
+def test_pair_list_holds_every_pair_once(denseGridMaxCellsPerParticle, useVerletList):
+    particles = Setup(Computing.VECTORIZED, numOfParticles=800, denseGridMaxCellsPerParticle=denseGridMaxCellsPerParticle, useVerletList=useVerletList)
+    Computing.predictedPositions[:] = particles.positions
+    Computing.UpdateNeighbours(symmetric=True)
+
+    pairs = list(zip(Computing.pairParticleIndecies.tolist(), Computing.pairNeighbourIndecies.tolist()))
+    unorderedPairs = {(min(pair), max(pair)) for pair in pairs}
+
+    assert len(unorderedPairs) == len(pairs)
+    assert all(first != second for first, second in pairs)
+    assert unorderedPairs == {pair for pair in BruteForcePairs(particles.positions, 50) if pair[0] < pair[1]}
+
+
+@pytest.mark.parametrize("engine", [engine for engine in ENGINES if engine in Computing.SYMMETRIC_PAIR_ENGINES])
+def test_symmetric_pairs_conserve_momentum(engine):
+    # Far from the walls and without gravity, pressure and viscosity only move momentum between particles
+    particles = Setup(engine, SCREEN_SIZE=(3000, 3000), gravity=0)
+    particles.positions += 1000
+    velocitiesBefore = particles.velocities.sum(axis=0)
+    RunSteps(1)
+
+    np.testing.assert_allclose(particles.velocities.sum(axis=0), velocitiesBefore, rtol=0, atol=1e-9)
+
+
+## Checkpoints
+@pytest.mark.parametrize("engine", [Computing.SCALAR] + [engine for engine in ENGINES if engine != Computing.PARALLEL])
+@pytest.mark.parametrize("values", [{}, {"floatType": np.float32, "useAdaptiveTimeStep": True, "reorderInterval": 3}], ids=["default", "float32-adaptive-reordered"])
+def test_checkpoint_round_trip_is_bit_exact(tmp_path, engine, values):
+    path = str(tmp_path / "state.ckpt")
+    Setup(engine, numOfParticles=300 if engine == Computing.SCALAR else 1500, **values)
+    RunSteps(4)
+    Checkpoint.SaveCheckpoint(path)
+    expected = RunSteps(4)
+    expectedTime = Computing.simulatedTime
+
+    # A different run in between, so nothing of the first one is left over
+    Setup(Computing.VECTORIZED, numOfParticles=50, seed=1)
+    RunSteps(2)
+
+    Checkpoint.LoadCheckpoint(path)
+    restored = RunSteps(4)
+
+    assert Computing.simulatedTime == expectedTime
+    for name, array in expected.items():
+        assert restored[name].dtype == array.dtype
+        np.testing.assert_array_equal(restored[name], array, err_msg=name)
+
+
+## Trajectories
+BOX = (0.0, 0.0) + AREA
+
+def GetQuantizationErrors(velocityScale):
+    """
+    Returns: The largest position and velocity errors of int16 frames, half a quantization step plus float32 rounding.
+    """
+    positionStep = max(BOX[2] - BOX[0], BOX[3] - BOX[1]) / (2 * Trajectory.QUANTIZED_MAX)
+    velocityStep = velocityScale / Trajectory.QUANTIZED_MAX
+    return positionStep * 0.5 + max(BOX[2:]) * 1e-6, velocityStep * 0.5 + velocityScale * 1e-6
+
+
+def test_quantization_error_is_bounded():
+    rng = np.random.default_rng(2)
+    frames = np.empty((8, 2, 500, 2))
+    frames[:, 0] = rng.random((8, 500, 2)) * AREA
+    frames[:, 1] = rng.normal(0, 3, (8, 500, 2))
+
+    quantized, velocityScale = Trajectory.QuantizeFrames(frames, BOX)
+    restored = Trajectory.DequantizeFrames(quantized, BOX, velocityScale)
+    positionError, velocityError = GetQuantizationErrors(velocityScale)
+
+    assert np.abs(restored[:, 0] - frames[:, 0]).max() <= positionError
+    assert np.abs(restored[:, 1] - frames[:, 1]).max() <= velocityError
+    # Differences between frames come back exactly
+    np.testing.assert_array_equal(Trajectory.UnpackQuantized(Trajectory.PackQuantized(quantized), quantized.shape), quantized)
+
+
+@pytest.mark.parametrize("quantize", [False, True], ids=["float32", "int16"])
+@pytest.mark.parametrize("compress", [False, True], ids=["raw", "zlib"])
+def test_trajectory_round_trip(tmp_path, quantize, compress):
+    path = str(tmp_path / "run.traj")
+    particles = Setup(Computing.VECTORIZED, numOfParticles=400)
+
+    # More frames than the first index segments hold, in chunks of 8
+    writer = Trajectory.TrajectoryWriter(path, len(particles), BOX, chunkFrames=8, quantize=quantize, compress=compress, queueFrames=1000)
+    expected = []
+    for step in range(300):
+        Computing.SimulationStep((0, 0))
+        writer.AddStep(particles, Computing.simulatedTime)
+        expected.append((particles.positions.copy(), particles.velocities.copy(), Computing.simulatedTime))
+    writer.Close()
+    Computing.Shutdown()
+    assert writer.droppedFrames == 0
+
+    reader = Trajectory.TrajectoryReader(path)
+    assert reader.numOfFrames == len(expected)
+
+    for frameIndex, (positions, velocities, simulatedTime) in enumerate(expected):
+        readPositions, readVelocities = reader.ReadFrame(frameIndex)
+        assert reader.GetFrameInfo(frameIndex) == (frameIndex, simulatedTime)
+
+        if quantize:
+            chunk = frameIndex // reader.chunkFrames
+            positionError, velocityError = GetQuantizationErrors(float(reader.index["chunks"][chunk]["velocityScale"]))
+            assert np.abs(readPositions - positions).max() <= positionError
+            assert np.abs(readVelocities - velocities).max() <= velocityError
+        else:
+            np.testing.assert_array_equal(readPositions, positions.astype(np.float32))
+            np.testing.assert_array_equal(readVelocities, velocities.astype(np.float32))
+    reader.Close()